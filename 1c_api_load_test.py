@@ -0,0 +1,97 @@
+# 1c_api_load_test.py
+# Нагрузочный тест получения заказов из 1С через клиент бота (api_client.OrderApiClient).
+# Пример вместе с симулятором:
+#   python 1c_api_simulator.py --catalog-size 10000 --latency lognormal --latency-ms 200 --error-rate 0.02
+#   python 1c_api_load_test.py --catalog-size 10000 --requests 5000 --concurrency 100
+import argparse
+import asyncio
+import json
+import logging
+import random
+from pathlib import Path
+from time import perf_counter
+from api_client import OrderApiClient
+from config import API_URL, API_POOL_SIZE, API_TIMEOUT
+
+
+def percentiles_ms(values):
+    values = sorted(values)
+    if not values:
+        return {}
+
+    def at(q):
+        return values[min(len(values) - 1, int(q * len(values)))] * 1000
+
+    return {'p50_ms': at(0.5), 'p90_ms': at(0.9), 'p99_ms': at(0.99), 'max_ms': values[-1] * 1000}
+
+
+async def run_load(args) -> dict:
+    client = OrderApiClient(args.url, cache_ttl=args.cache_ttl, pool_size=args.pool_size, timeout=args.timeout)
+    rng = random.Random(args.seed)
+    latencies = {'found': [], 'failed': []}
+    requests_left = args.requests
+
+    def next_order_number():
+        if args.catalog_size and rng.random() >= args.miss_rate:
+            return f"{rng.randint(1, args.catalog_size):010d}-0001"
+        return f"{rng.randint(10 ** 9, 2 * 10 ** 9)}-9999"  # номера, которых нет в 1С
+
+    async def user():
+        nonlocal requests_left
+        while requests_left > 0:
+            requests_left -= 1
+            order_number = next_order_number()
+            started = perf_counter()
+            number_of_photos, order_folder = await client.fetch_order(order_number)
+            outcome = 'found' if number_of_photos is not None else 'failed'
+            latencies[outcome].append(perf_counter() - started)
+
+    started = perf_counter()
+    try:
+        await asyncio.gather(*(user() for _ in range(args.concurrency)))
+    finally:
+        await client.close()
+    wall = perf_counter() - started
+
+    all_latencies = latencies['found'] + latencies['failed']
+    return {
+        'url': args.url,
+        'requests': len(all_latencies),
+        'concurrency': args.concurrency,
+        'cache_ttl': args.cache_ttl,
+        'pool_size': args.pool_size,
+        'wall_s': wall,
+        'throughput_rps': len(all_latencies) / wall,
+        'found': len(latencies['found']),
+        'failed': len(latencies['failed']),
+        'latency': percentiles_ms(all_latencies),
+        'latency_found': percentiles_ms(latencies['found']),
+        'latency_failed': percentiles_ms(latencies['failed']),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test of 1C order lookups through the bot's API client.")
+    parser.add_argument('--url', default=API_URL, help='URL API, к которому дописывается номер заказа.')
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=50, help='Одновременных пользователей.')
+    parser.add_argument('--catalog-size', type=int, default=0, help='Размер каталога симулятора (--catalog-size).')
+    parser.add_argument('--miss-rate', type=float, default=0.05, help='Доля запросов несуществующих заказов.')
+    parser.add_argument('--cache-ttl', type=float, default=0, help='Кэш клиента, секунд (0 - каждый запрос в 1С).')
+    parser.add_argument('--pool-size', type=int, default=API_POOL_SIZE)
+    parser.add_argument('--timeout', type=float, default=API_TIMEOUT)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--output', type=Path, default=None, help='JSON с результатами.')
+    parser.add_argument('--verbose', action='store_true', help='Показывать лог клиента (ошибки каждого запроса).')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL,
+                        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+    result = asyncio.run(run_load(args))
+    print(json.dumps(result, indent=2))
+    if args.output:
+        args.output.write_text(json.dumps(result, indent=2), encoding='utf-8')
+
+
+if __name__ == '__main__':
+    main()
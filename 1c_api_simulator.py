@@ -1,4 +1,9 @@
+import argparse
+import asyncio
+import json
+import random
 from fastapi import FastAPI
+from fastapi.responses import Response, StreamingResponse
 
 app = FastAPI()
 
@@ -9,19 +14,93 @@ orders = {
     "0131846510-0013": 1,
 }
 
+# Параметры симуляции медленной и нестабильной 1С, задаются аргументами командной строки
+settings = argparse.Namespace(
+    latency='none', latency_ms=0.0, latency_jitter_ms=0.0, latency_sigma=0.5,
+    error_rate=0.0, text_content_type_rate=0.0, invalid_json_rate=0.0,
+    slow_body_rate=0.0, slow_body_ms=0.0,
+)
+
+
+def generate_catalog(size: int, seed=None):
+    """Добавляет size сгенерированных заказов с номерами 0000000001-0001, 0000000002-0001, ..."""
+    rng = random.Random(seed)
+    for i in range(1, size + 1):
+        orders[f"{i:010d}-0001"] = rng.randint(1, 100)
+
+
+def sample_latency_ms() -> float:
+    """Задержка ответа по выбранному распределению."""
+    if settings.latency == 'fixed':
+        return settings.latency_ms
+    if settings.latency == 'uniform':
+        return random.uniform(settings.latency_ms - settings.latency_jitter_ms, settings.latency_ms + settings.latency_jitter_ms)
+    if settings.latency == 'normal':
+        return random.gauss(settings.latency_ms, settings.latency_jitter_ms)
+    if settings.latency == 'lognormal':
+        # latency_ms - медиана, latency_sigma - длина хвоста
+        return settings.latency_ms * random.lognormvariate(0, settings.latency_sigma)
+    return 0.0
+
+
+async def trickle(body: bytes, duration_ms: float, chunks=10):
+    # Медленное тело ответа: заголовки сразу, данные частями в течение duration_ms
+    chunk_size = max(1, len(body) // chunks + 1)
+    for i in range(0, len(body), chunk_size):
+        await asyncio.sleep(duration_ms / 1000 / chunks)
+        yield body[i:i + chunk_size]
+
+
 @app.get("/markets/hs/api_bot/getpath/{order_number}")
-def get_path(order_number: str):
-    if not order_number:
-        return {"result": False, "info": "Invalid request format"}
+async def get_path(order_number: str):
+    await asyncio.sleep(max(0.0, sample_latency_ms()) / 1000)
 
-    if order_number in orders:
+    if random.random() < settings.error_rate:
+        return Response("Internal 1C error", status_code=500, media_type="text/plain")
+    if random.random() < settings.invalid_json_rate:
+        return Response("<html><body>1C is restarting</body></html>", media_type="text/html")
+
+    if not order_number:
+        data = {"result": False, "info": "Invalid request format"}
+    elif order_number in orders:
         # path = f"C:\\1C\\папка для заказов\\2024-11-06\\Набор. Альбом А5_озн_{order_number}_Новый"
         path = f"orders/Набор. Альбом А5_озн_{order_number}_Новый"
         quantity = orders[order_number]
-        return {"result": True, "path": path, "quantity": quantity}
+        data = {"result": True, "path": path, "quantity": quantity}
     else:
-        return {"result": False, "info": f"The order by number {order_number} was not found"}
+        data = {"result": False, "info": f"The order by number {order_number} was not found"}
+
+    body = json.dumps(data, ensure_ascii=False).encode()
+    # 1С иногда отдаёт JSON с Content-Type text/plain
+    media_type = "text/plain; charset=utf-8" if random.random() < settings.text_content_type_rate else "application/json"
+    if random.random() < settings.slow_body_rate:
+        return StreamingResponse(trickle(body, settings.slow_body_ms), media_type=media_type)
+    return Response(body, media_type=media_type)
+
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="localhost", port=8000)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="1C order API simulator.")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--catalog-size", type=int, default=0, help="Сколько заказов сгенерировать.")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--latency", choices=["none", "fixed", "uniform", "normal", "lognormal"], default="none",
+                        help="Распределение задержки ответа.")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Задержка (для lognormal - медиана), мс.")
+    parser.add_argument("--latency-jitter-ms", type=float, default=0.0,
+                        help="Полуширина для uniform, стандартное отклонение для normal, мс.")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="Параметр хвоста для lognormal.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Доля ответов 500.")
+    parser.add_argument("--text-content-type-rate", type=float, default=0.0,
+                        help="Доля ответов JSON с Content-Type text/plain.")
+    parser.add_argument("--invalid-json-rate", type=float, default=0.0, help="Доля ответов HTML вместо JSON.")
+    parser.add_argument("--slow-body-rate", type=float, default=0.0, help="Доля ответов с медленным телом.")
+    parser.add_argument("--slow-body-ms", type=float, default=1000.0, help="За сколько мс отдаётся медленное тело.")
+    args = parser.parse_args()
+
+    vars(settings).update({key: value for key, value in vars(args).items() if hasattr(settings, key)})
+    random.seed(args.seed)
+    generate_catalog(args.catalog_size, args.seed)
+    print(f"Orders in catalog: {len(orders)}")
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
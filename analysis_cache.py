@@ -0,0 +1,104 @@
+# analysis_cache.py
+import json
+import logging
+import os
+from collections import OrderedDict
+from pathlib import Path
+from helpers import PhotoAnalysis, ANALYZER_VERSION
+from config import ANALYSIS_CACHE_SIZE, ANALYSIS_CACHE_DIR, ANALYSIS_CACHE_DISK_MAX_FILES
+
+
+logger = logging.getLogger("main")
+
+# Поля результата, которые зависят только от содержимого файла (путь и время этапов не кэшируются)
+CACHED_FIELDS = tuple(field for field in PhotoAnalysis.__slots__ if field not in ('path', 'timings'))
+
+
+class AnalysisCache:
+    """
+    Кэш результатов analyze_photo по содержимому файла: ключ - MD5 и версия анализатора.
+    Первый уровень - LRU в памяти, второй (необязательный) - JSON-файлы в cache_dir.
+    """
+
+    def __init__(self, max_items=ANALYSIS_CACHE_SIZE, cache_dir=ANALYSIS_CACHE_DIR,
+                 max_disk_items=ANALYSIS_CACHE_DISK_MAX_FILES, version=ANALYZER_VERSION):
+        """
+        :param max_items: Максимум результатов в памяти.
+        :param cache_dir: Каталог дискового кэша, None - только память.
+        :param max_disk_items: Максимум файлов в дисковом кэше, старые удаляются.
+        :param version: Версия анализатора, при её смене старые результаты не используются.
+        """
+        self.max_items = max_items
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.max_disk_items = max_disk_items
+        self.version = version
+        self._items = OrderedDict()  # md5 -> dict полей результата
+        self._disk_puts = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _disk_path(self, md5):
+        return self.cache_dir / md5[:2] / f'{md5}_v{self.version}.json'
+
+    def get(self, md5, file_path):
+        """
+        Возвращает результат для файла с указанным MD5 или None.
+
+        :param file_path: Путь, который будет записан в результат.
+        """
+        fields = self._items.get(md5)
+        if fields is not None:
+            self._items.move_to_end(md5)
+        elif self.cache_dir is not None:
+            try:
+                with open(self._disk_path(md5), encoding='utf-8') as f:
+                    fields = json.load(f)
+                self._remember(md5, fields)
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError) as e:
+                logger.error(f"Failed to read analysis cache for {md5}: {e}")
+        if fields is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        # Из кэша этапы проверки не выполнялись, времени этапов нет
+        return PhotoAnalysis(Path(file_path), **fields, timings={})
+
+    def put(self, analysis: PhotoAnalysis):
+        if analysis.error:
+            return  # неудачная проверка могла быть случайной, в следующий раз файл проверяется заново
+        fields = {field: getattr(analysis, field) for field in CACHED_FIELDS}
+        self._remember(analysis.md5, fields)
+        if self.cache_dir is not None:
+            disk_path = self._disk_path(analysis.md5)
+            try:
+                disk_path.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = disk_path.with_suffix('.tmp')
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(fields, f)
+                os.replace(tmp_path, disk_path)
+            except OSError as e:
+                logger.error(f"Failed to write analysis cache for {analysis.md5}: {e}")
+                return
+            self._disk_puts += 1
+            if self._disk_puts % 1000 == 0:
+                try:
+                    self.prune_disk()
+                except OSError as e:
+                    logger.error(f"Failed to prune analysis cache {self.cache_dir}: {e}")
+
+    def _remember(self, md5, fields):
+        self._items[md5] = fields
+        self._items.move_to_end(md5)
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+
+    def prune_disk(self):
+        """Удаляет самые старые файлы дискового кэша сверх max_disk_items."""
+        files = sorted(self.cache_dir.glob('*/*.json'), key=lambda path: path.stat().st_mtime)
+        for path in files[:max(0, len(files) - self.max_disk_items)]:
+            path.unlink(missing_ok=True)
+
+
+analysis_cache = AnalysisCache()
@@ -0,0 +1,140 @@
+# analysis_service.py
+import asyncio
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from time import perf_counter
+import metrics
+from tracing import span
+from config import ANALYSIS_POOL_SIZE, ANALYSIS_QUEUE_SIZE, ANALYSIS_TASK_TIMEOUT
+
+
+logger = logging.getLogger("main")
+
+
+ANALYSIS_TASK_SECONDS = metrics.Histogram(
+    'ideaprint_analysis_task_seconds', 'Time spent by a task inside a pool process.', ['task'])
+ANALYSIS_WAIT_SECONDS = metrics.Histogram(
+    'ideaprint_analysis_wait_seconds', 'Time a task waited for a free pool process.')
+
+
+class AnalysisBusyError(Exception):
+    """Очередь пула переполнена и место не освободилось за отведённое время."""
+
+
+def _timed_call(func, args, kwargs):
+    # Выполняется в процессе пула: время самой задачи, без ожидания в очереди
+    started = perf_counter()
+    result = func(*args, **kwargs)
+    return result, perf_counter() - started
+
+
+class AnalysisService:
+    """
+    Выполняет CPU-bound функции из helpers.py (конвертация, соотношение сторон, размытие, MD5)
+    в пуле процессов, чтобы цикл asyncio оставался свободным для остальных пользователей.
+
+    Глубина очереди ограничена: одновременно в пуле находится не больше queue_size задач,
+    остальные вызовы ждут освобождения места. Каждая задача ограничена по времени; задача,
+    которая не успела, дорабатывает в процессе пула и занимает место в очереди до своего завершения.
+    """
+
+    def __init__(self, pool_size=ANALYSIS_POOL_SIZE, queue_size=ANALYSIS_QUEUE_SIZE,
+                 task_timeout=ANALYSIS_TASK_TIMEOUT):
+        """
+        :param pool_size: Количество процессов (None - по числу ядер).
+        :param queue_size: Максимальное число задач, одновременно переданных в пул.
+        :param task_timeout: Таймаут одной задачи в секундах (None - без ограничения).
+        """
+        self.pool_size = pool_size
+        self.queue_size = queue_size
+        self.task_timeout = task_timeout
+        self._executor = None
+        self._slots = asyncio.Semaphore(queue_size)
+        self.pending = 0  # задач в очереди и в работе
+
+    def start(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.pool_size)
+            logger.info(f"Analysis pool started with {self._executor._max_workers} workers.")
+
+    def _release(self):
+        self.pending -= 1
+        self._slots.release()
+
+    def _on_task_done(self, future):
+        # Задача, которую уже не ждут (таймаут или отмена): освобождаем место, ошибку только забираем
+        if not future.cancelled():
+            future.exception()
+        self._release()
+
+    def shutdown(self, wait=False):
+        """
+        :param wait: Дождаться завершения процессов пула.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=True)
+            self._executor = None
+            logger.info("Analysis pool stopped.")
+
+    async def run(self, func, *args, timeout=None, **kwargs):
+        """
+        Выполняет func(*args, **kwargs) в пуле процессов и возвращает результат.
+        func должна быть функцией уровня модуля (её передают в дочерний процесс через pickle).
+
+        :param timeout: Таймаут задачи в секундах, по умолчанию task_timeout.
+        :raises AnalysisBusyError: Если место в очереди не освободилось за время таймаута.
+        :raises asyncio.TimeoutError: Если задача не успела выполниться.
+        """
+        timeout = self.task_timeout if timeout is None else timeout
+        self.start()
+        queued = perf_counter()
+
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout)
+        except asyncio.TimeoutError:
+            raise AnalysisBusyError(f"Analysis queue is full ({self.queue_size} tasks).")
+
+        self.pending += 1
+        executor = self._executor
+        task = None  # concurrent.futures.Future задачи в пуле
+        future = None
+        try:
+            if not metrics.enabled:
+                task = executor.submit(partial(func, *args, **kwargs))
+            else:
+                task = executor.submit(partial(_timed_call, func, args, kwargs))
+            future = asyncio.wrap_future(task)
+            with span(f'pool.{func.__name__}'):
+                # shield: таймаут или отмена вызова не отменяют future, по нему освобождается место
+                result = await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            # Ещё не начатая задача снимается с очереди пула, начатую прервать нельзя - она доработает
+            # в фоне и займёт место в очереди до своего завершения
+            task.cancel()
+            logger.error(f"Analysis task {func.__name__}{args} timed out after {timeout} s.")
+            raise
+        except BrokenProcessPool:
+            logger.error(f"Analysis pool is broken while running {func.__name__}, restarting.")
+            if self._executor is executor:
+                self._executor = None
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        finally:
+            if future is None or future.done():
+                self._release()
+            else:
+                future.add_done_callback(self._on_task_done)
+
+        if not metrics.enabled:
+            return result
+        result, seconds = result
+        ANALYSIS_TASK_SECONDS.observe(seconds, task=func.__name__)
+        ANALYSIS_WAIT_SECONDS.observe(max(0.0, perf_counter() - queued - seconds))
+        return result
+
+
+analysis_service = AnalysisService()
+metrics.Gauge('ideaprint_analysis_queue_depth', 'Tasks waiting for or running in the analysis pool.',
+              func=lambda: analysis_service.pending)
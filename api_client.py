@@ -0,0 +1,124 @@
+# api_client.py
+import asyncio
+import json
+import logging
+from pathlib import Path
+from time import monotonic
+import aiohttp
+from config import API_URL, API_CACHE_TTL, API_POOL_SIZE, API_TIMEOUT
+
+
+logger = logging.getLogger("main")
+
+
+class OrderApiClient:
+    """
+    Клиент API 1С для получения данных о заказе.
+
+    Одна долгоживущая сессия aiohttp с пулом соединений, короткий кэш успешных ответов
+    (номер заказа -> (количество фото, папка заказа)) и объединение одновременных запросов
+    одного и того же номера в один запрос к 1С.
+    """
+
+    def __init__(self, base_url=API_URL, cache_ttl=API_CACHE_TTL, pool_size=API_POOL_SIZE, timeout=API_TIMEOUT):
+        """
+        :param base_url: URL API, к которому дописывается номер заказа.
+        :param cache_ttl: Время жизни ответа в кэше, секунд (0 - без кэша).
+        :param pool_size: Максимум одновременных соединений с 1С.
+        :param timeout: Таймаут запроса, секунд.
+        """
+        self.base_url = base_url
+        self.cache_ttl = cache_ttl
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._session = None
+        self._cache = {}  # номер заказа -> (время истечения, (number_of_photos, order_folder))
+        self._inflight = {}  # номер заказа -> задача запроса к 1С
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def invalidate(self, order_number: str):
+        """Удаляет ответ для заказа из кэша (после печати или отмены заказа)."""
+        self._cache.pop(order_number, None)
+
+    async def fetch_order(self, order_number: str) -> tuple:
+        """
+        Получает данные о заказе от 1С.
+
+        :param order_number: Номер заказа.
+        :return: Кортеж (number_of_photos, order_folder) или (None, None), если произошла ошибка.
+        """
+        cached = self._cache.get(order_number)
+        if cached is not None:
+            expires, result = cached
+            if expires > monotonic():
+                logger.info(f"API 1c cache hit for order {order_number}")
+                return result
+            del self._cache[order_number]
+
+        task = self._inflight.get(order_number)
+        if task is None:
+            task = asyncio.create_task(self._request(order_number))
+            self._inflight[order_number] = task
+            task.add_done_callback(lambda _: self._inflight.pop(order_number, None))
+        else:
+            logger.info(f"API 1c request for order {order_number} joined a request in progress")
+
+        # shield: отмена одного ожидающего не отменяет запрос для остальных
+        result = await asyncio.shield(task)
+        if self.cache_ttl and result[0] is not None:
+            self._cache[order_number] = (monotonic() + self.cache_ttl, result)
+        return result
+
+    async def _request(self, order_number: str) -> tuple:
+        try:
+            async with self._get_session().get(f"{self.base_url}{order_number}") as response:
+                # Логируем HTTP-статус
+                logger.info(f"API 1c responded with status: {response.status}")
+
+                if response.status != 200:
+                    logger.error(f"Unexpected status code: {response.status}")
+                    return None, None
+
+                # Обрабатываем ответ, независимо от Content-Type
+                try:
+                    content_type = response.headers.get("Content-Type", "")
+                    if "application/json" in content_type:
+                        data = await response.json()
+                    else:
+                        # Если Content-Type не JSON, пробуем декодировать текст вручную
+                        text = await response.text()
+                        data = json.loads(text)
+
+                    logger.info(f"API 1c returned data: {data}")
+
+                    # Проверяем успешность ответа
+                    if data.get("result"):
+                        number_of_photos = data.get("quantity")
+                        order_folder = Path(data.get("path"))
+                        return number_of_photos, order_folder
+                    else:
+                        logger.warning(f"API 1c error info: {data.get('info', 'No info provided')}")
+                        return None, None
+
+                except json.JSONDecodeError as e:
+                    logger.error(f"Failed to decode JSON: {e}")
+                    return None, None
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"HTTP request to API failed: {e!r}")
+            return None, None
+
+
+api_client = OrderApiClient()
@@ -0,0 +1,319 @@
+# bench_upload_pipeline.py
+# Нагрузочный тест загрузки фото: синтетические заказы прогоняются через хэндлеры бота с подменённым Telegram.
+#
+# Запуск из папки бота (нужен .env, токен не используется):
+#   python bench_upload_pipeline.py --users 1,10,100 --photos 4 --output bench.json
+# Каждый уровень нагрузки выполняется в отдельном процессе, чтобы пиковая память (RSS) мерилась отдельно.
+import argparse
+import asyncio
+import functools
+import itertools
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+from collections import defaultdict
+from datetime import datetime
+from pathlib import Path
+from time import perf_counter
+import cv2
+import numpy as np
+from PIL import Image
+
+try:
+    import resource  # нет в Windows, тогда память не меряется
+except ImportError:
+    resource = None
+
+
+# Исходные фото: (имя, формат, мегапиксели, размыто). Повторная отправка одного файла даёт дубль
+SOURCE_SPECS = [
+    ('jpeg_2mp', 'JPEG', 2, False),
+    ('jpeg_12mp', 'JPEG', 12, False),
+    ('jpeg_12mp_blur', 'JPEG', 12, True),
+    ('heic_12mp', 'HEIF', 12, False),
+    ('png_2mp', 'PNG', 2, False),
+    ('jpeg_48mp', 'JPEG', 48, False),
+]
+SOURCE_SUFFIXES = {'JPEG': '.jpg', 'HEIF': '.heic', 'PNG': '.png'}
+
+
+def make_scene(megapixels: float, seed: int, blurred: bool) -> np.ndarray:
+    """Синтетический кадр 4:3 с градиентами, фигурами и шумом, чтобы у него были резкие края."""
+    width = int((megapixels * 1e6 * 4 / 3) ** 0.5)
+    height = width * 3 // 4
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    image = np.empty((height, width, 3), np.uint8)
+    image[..., 0] = (x * 0.7 + y * 0.3).astype(np.uint8)
+    image[..., 1] = (255 - x * 0.5 - y * 0.2).astype(np.uint8)
+    image[..., 2] = (y * 0.8).astype(np.uint8)
+    scale = width / 1000
+    for _ in range(60):
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        x1, y1 = int(rng.integers(0, width)), int(rng.integers(0, height))
+        size = int(rng.integers(10, 150) * scale)
+        if rng.random() < 0.5:
+            cv2.rectangle(image, (x1, y1), (x1 + size, y1 + size // 2), color, -1)
+        else:
+            cv2.circle(image, (x1, y1), size // 2, color, max(1, int(3 * scale)))
+    noise = rng.integers(-8, 9, (height, width, 1), dtype=np.int16)
+    image = np.clip(image.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+    if blurred:
+        sigma = 4 * width / 4000  # как расфокус ~4 px на 12 Мп
+        image = cv2.GaussianBlur(image, (0, 0), sigma)
+    return image
+
+
+def generate_sources(sources_dir: Path, max_megapixels=None):
+    """
+    Создаёт исходные фото (один раз, потом берутся готовые). Возвращает имена файлов.
+    :param max_megapixels: Пропустить фото больше этого размера.
+    """
+    sources_dir.mkdir(parents=True, exist_ok=True)
+    names = []
+    for seed, (name, image_format, megapixels, blurred) in enumerate(SOURCE_SPECS):
+        if max_megapixels is not None and megapixels > max_megapixels:
+            continue
+        path = sources_dir / f'{name}{SOURCE_SUFFIXES[image_format]}'
+        if not path.exists():
+            if image_format == 'HEIF':
+                from pillow_heif import register_heif_opener
+                register_heif_opener()
+            print(f'Generating {path.name}...', flush=True)
+            scene = Image.fromarray(make_scene(megapixels, seed, blurred))
+            tmp_path = path.with_name(f'{path.name}.part')
+            scene.save(tmp_path, image_format, quality=90)
+            tmp_path.replace(path)
+        names.append(path.name)
+    return names
+
+
+def user_photos(sources, user_index: int, photos: int):
+    """Фото, которые отправляет пользователь: по кругу из исходных, последнее (при 3+ фото) - дубль первого."""
+    names = [sources[(user_index + i) % len(sources)] for i in range(photos)]
+    if photos >= 3:
+        names[-1] = names[0]
+    return names
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {}
+
+    def at(q):
+        return values[min(len(values) - 1, int(q * len(values)))] * 1000
+
+    return {
+        'count': len(values),
+        'mean_ms': sum(values) / len(values) * 1000,
+        'p50_ms': at(0.5),
+        'p90_ms': at(0.9),
+        'p99_ms': at(0.99),
+        'max_ms': values[-1] * 1000,
+    }
+
+
+def peak_rss_mb(who):
+    if resource is None:
+        return None
+    rss = resource.getrusage(who).ru_maxrss
+    # Linux - килобайты, macOS - байты
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+
+async def run_level(users: int, photos: int, workdir: Path, tg_latency: float) -> dict:
+    """Один уровень нагрузки: users пользователей одновременно загружают по photos фото в свои заказы."""
+    import config
+    config.FSM_STORAGE_PATH = None  # состояния в памяти, рабочая база не трогается
+    from aiogram import methods, types
+    from aiogram.client.session.base import BaseSession
+    import ideaprint_bot as ib
+    import logging
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger('main').setLevel(logging.WARNING)
+
+    sources_dir = workdir / 'sources'
+    orders_dir = workdir / 'orders'
+    shutil.rmtree(orders_dir, ignore_errors=True)
+    orders_dir.mkdir(parents=True)
+    sources = generate_sources(sources_dir)
+
+    stages = defaultdict(list)
+    ids = itertools.count(1)
+
+    class FakeTelegramSession(BaseSession):
+        """Отвечает на запросы Bot API без сети, файлы "скачиваются" из sources_dir."""
+
+        async def make_request(self, bot, method, timeout=None):
+            started = perf_counter()
+            if tg_latency:
+                await asyncio.sleep(tg_latency)
+            chat = {'id': getattr(method, 'chat_id', 0) or 0, 'type': 'private'}
+            message = {'message_id': next(ids), 'date': 0, 'chat': chat}
+            photo = [{'file_id': f'sent{next(ids)}', 'file_unique_id': 'u', 'width': 1, 'height': 1}]
+            if isinstance(method, methods.GetFile):
+                result = types.File(file_id=method.file_id, file_unique_id=method.file_id,
+                                    file_path=method.file_id.split('#')[0])
+            elif isinstance(method, methods.SendMediaGroup):
+                result = [types.Message.model_validate(dict(message, message_id=next(ids), photo=photo),
+                                                       context={'bot': bot}) for _ in method.media]
+            elif isinstance(method, methods.SendPhoto):
+                result = types.Message.model_validate(dict(message, photo=photo), context={'bot': bot})
+            elif isinstance(method, (methods.SendMessage, methods.SendDocument)):
+                result = types.Message.model_validate(message, context={'bot': bot})
+            else:
+                result = True
+            stages[f'bot_api.{type(method).__name__}'].append(perf_counter() - started)
+            return result
+
+        async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+            with open(sources_dir / url.rsplit('/', 1)[-1], 'rb') as f:
+                while chunk := f.read(chunk_size):
+                    yield chunk
+
+        async def close(self):
+            pass
+
+    def timed(name, func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                stages[name].append(perf_counter() - started)
+        return wrapper
+
+    # Хэндлеры вызывают эти функции через глобальные имена модуля, поэтому замена на обёртки их меряет
+    for name in ('process_photo', 'edit_photo_block', 'send_upload_status', 'download_and_save_file',
+                 'check_aspect_ratio', 'check_print_resolution', 'check_blur', 'check_md5_matches',
+                 'check_similar_photos'):
+        setattr(ib, name, timed(name, getattr(ib, name)))
+
+    pool_run = ib.analysis_service.run
+
+    async def timed_pool_run(func, *args, **kwargs):
+        # Время задачи в пуле вместе с ожиданием свободного процесса
+        return await timed(f'pool.{func.__name__}', pool_run)(func, *args, **kwargs)
+
+    ib.analysis_service.run = timed_pool_run
+
+    async def fetch_order(order_number):
+        return photos, orders_dir / f'order_{order_number}'
+
+    ib.api_client.fetch_order = fetch_order
+    ib.ALLOWED_PATH = str(orders_dir)
+    ib.bot.session = FakeTelegramSession()
+    update_ids = itertools.count(1)
+
+    def update(user_id, **event):
+        sender = {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'}
+        chat = {'id': user_id, 'type': 'private'}
+        if 'callback_data' in event:
+            bot_message = {'message_id': next(ids), 'date': 0, 'chat': chat, 'text': '-',
+                           'from': {'id': 1, 'is_bot': True, 'first_name': 'bot'}}
+            return {'update_id': next(update_ids), 'callback_query': {
+                'id': str(next(ids)), 'chat_instance': 'bench', 'from': sender,
+                'message': bot_message, 'data': event['callback_data']}}
+        return {'update_id': next(update_ids), 'message': dict(
+            {'message_id': next(ids), 'date': 0, 'chat': chat, 'from': sender}, **event)}
+
+    async def user_session(user_index: int):
+        user_id = 1000 + user_index
+        order_number = f'{user_id}'
+        await ib.dp.feed_raw_update(ib.bot, update(user_id, text='/start'))
+        await ib.dp.feed_raw_update(ib.bot, update(user_id, text=order_number))
+        for photo_index, source in enumerate(user_photos(sources, user_index, photos)):
+            file_id = f'{source}#{user_index}-{photo_index}'
+            document = {'file_id': file_id, 'file_unique_id': file_id, 'file_name': source}
+            await ib.dp.feed_raw_update(ib.bot, update(user_id, document=document))
+        await ib.dp.feed_raw_update(ib.bot, update(user_id, callback_data=f'edit_photo_block:{order_number}:1'))
+
+    ib.analysis_service.start()
+    started = perf_counter()
+    await asyncio.gather(*(user_session(user_index) for user_index in range(users)))
+    wall = perf_counter() - started
+    ib.analysis_service.shutdown(wait=True)
+
+    saved = sum(len(list(order.glob(f'*.{ib.IMG_WORK_FORMAT}'))) for order in orders_dir.iterdir())
+    return {
+        'users': users,
+        'photos_per_user': photos,
+        'photos_sent': users * photos,
+        'photos_saved': saved,
+        'wall_s': wall,
+        'throughput_photos_per_s': users * photos / wall,
+        'peak_rss_mb': {
+            'main': peak_rss_mb(resource.RUSAGE_SELF) if resource else None,
+            'pool_processes': peak_rss_mb(resource.RUSAGE_CHILDREN) if resource else None,
+        },
+        'stages': {name: percentiles(values) for name, values in sorted(stages.items())},
+    }
+
+
+def print_level(result: dict):
+    print(f"\n{result['users']} users x {result['photos_per_user']} photos: {result['wall_s']:.2f} s, "
+          f"{result['throughput_photos_per_s']:.2f} photos/s, saved {result['photos_saved']}/{result['photos_sent']}, "
+          f"peak RSS {result['peak_rss_mb']}")
+    print(f"{'stage':32} {'count':>6} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for name, stats in result['stages'].items():
+        print(f"{name:32} {stats['count']:>6} {stats['p50_ms']:>9.1f} {stats['p90_ms']:>9.1f} "
+              f"{stats['p99_ms']:>9.1f} {stats['max_ms']:>9.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Upload pipeline benchmark with synthetic orders.')
+    parser.add_argument('--users', default='1,10,100', help='Уровни одновременных пользователей через запятую.')
+    parser.add_argument('--photos', type=int, default=4, help='Фото на пользователя (размер заказа).')
+    parser.add_argument('--tg-latency-ms', type=float, default=0, help='Задержка ответа подменённого Telegram.')
+    parser.add_argument('--workdir', type=Path, default=Path(tempfile.gettempdir()) / 'ideaprint_bench')
+    parser.add_argument('--output', type=Path, default=None, help='JSON с результатами.')
+    parser.add_argument('--level-output', type=Path, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--generate-only', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    levels = [int(users) for users in args.users.split(',')]
+
+    if args.generate_only:
+        generate_sources(args.workdir / 'sources')
+        return
+    if args.level_output:
+        # Дочерний процесс: один уровень нагрузки
+        result = asyncio.run(run_level(levels[0], args.photos, args.workdir, args.tg_latency_ms / 1000))
+        args.level_output.write_text(json.dumps(result), encoding='utf-8')
+        return
+
+    # Пиковая память наследуется дочерними процессами, поэтому большие кадры создаются тоже в отдельном процессе
+    subprocess.run([sys.executable, __file__, '--generate-only', '--workdir', str(args.workdir)], check=True)
+    results = []
+    for users in levels:
+        level_output = args.workdir / f'level_{users}.json'
+        subprocess.run([
+            sys.executable, __file__, '--users', str(users), '--photos', str(args.photos),
+            '--tg-latency-ms', str(args.tg_latency_ms), '--workdir', str(args.workdir),
+            '--level-output', str(level_output),
+        ], check=True)
+        result = json.loads(level_output.read_text(encoding='utf-8'))
+        print_level(result)
+        results.append(result)
+
+    output = args.output or Path(f'bench_upload_{datetime.now():%Y%m%d_%H%M%S}.json')
+    output.write_text(json.dumps({
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'sources': [dict(zip(('name', 'format', 'megapixels', 'blurred'), spec)) for spec in SOURCE_SPECS],
+        'tg_latency_ms': args.tg_latency_ms,
+        'levels': results,
+    }, ensure_ascii=False, indent=2), encoding='utf-8')
+    print(f'\nResults saved to {output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+# bktree.py
+
+
+def hamming_distance(hash_a: int, hash_b: int) -> int:
+    """Количество различающихся бит двух хешей."""
+    return bin(hash_a ^ hash_b).count('1')
+
+
+class BKTree:
+    """
+    BK-дерево для поиска перцептивных хешей по расстоянию Хэмминга.
+    Поиск отсекает поддеревья по неравенству треугольника и не перебирает все хеши заказа.
+
+    Узел: [хеш, множество имён файлов с этим хешем, {расстояние: дочерний узел}].
+    При удалении узел остаётся в дереве с пустым множеством имён.
+    """
+    __slots__ = ('root',)
+
+    def __init__(self):
+        self.root = None
+
+    def add(self, item_hash: int, name):
+        if self.root is None:
+            self.root = [item_hash, {name}, {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming_distance(item_hash, node[0])
+            if distance == 0:
+                node[1].add(name)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [item_hash, {name}, {}]
+                return
+            node = child
+
+    def remove(self, item_hash: int, name):
+        node = self.root
+        while node is not None:
+            distance = hamming_distance(item_hash, node[0])
+            if distance == 0:
+                node[1].discard(name)
+                return
+            node = node[2].get(distance)
+
+    def find(self, item_hash: int, max_distance: int):
+        """
+        Ищет хеши на расстоянии не больше max_distance.
+
+        :return: Список (имя, расстояние), отсортированный по расстоянию.
+        """
+        result = []
+        if self.root is None:
+            return result
+        stack = [self.root]
+        while stack:
+            node_hash, names, children = stack.pop()
+            distance = hamming_distance(item_hash, node_hash)
+            if distance <= max_distance:
+                result.extend((name, distance) for name in names)
+            for child_distance, child in children.items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        result.sort(key=lambda item: (item[1], str(item[0])))
+        return result
@@ -1,83 +1,164 @@
-from PIL import Image, ImageDraw, ImageFont
+import hashlib
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from PIL import Image, ImageDraw, ImageFont, ImageOps
+from config import CONTACT_SHEET_WIDTH, CONTACT_SHEET_THREADS, CONTACT_SHEET_FONT, CONTACT_SHEET_QUALITY, \
+    CONTACT_SHEET_COLUMNS, CONTACT_SHEET_ROWS, ORDER_SERVICE_DIR
+from order_manifest import OrderManifest
 
-# Путь к каталогу с фотографиями
-photos_dir = Path("orders/2024-10-29/1_Новый")
 
-# Получаем список файлов в каталоге, отсортированный по имени
-photo_files = sorted([f for f in photos_dir.glob("*") if f.suffix.lower() in ['.png', '.jpg', '.jpeg']])
-
-# Размер коллажа
-collage_width = 1280
 font_size_percent = 0.2  # of photo
 bg_col_byte = 200  # background color if base image
+CONTACT_SHEET_FILENAME = 'contact_sheet.jpg'
+CONTACT_SHEET_PAGES_DIR = 'contact_sheets'
+
+
+def load_font(size: int):
+    """Шрифт для порядковых номеров. Если шрифт CONTACT_SHEET_FONT не найден, используется встроенный."""
+    try:
+        return ImageFont.truetype(CONTACT_SHEET_FONT, size)
+    except OSError:
+        return ImageFont.load_default(size)
+
+
+def make_tile(photo_file, tile_size: int) -> Image.Image:
+    """
+    Делает квадратную плитку коллажа: фото, вписанное по длинной стороне.
+    JPEG декодируется сразу в уменьшенном виде (draft), остальное уменьшается через reduce перед ресемплингом,
+    поэтому фото в полном разрешении в память не загружается.
+    """
+    tile = Image.new('RGB', (tile_size, tile_size), (bg_col_byte, bg_col_byte, bg_col_byte))
+    try:
+        with Image.open(photo_file) as photo:
+            photo.draft('RGB', (tile_size, tile_size))
+            photo = ImageOps.exif_transpose(photo).convert('RGB')
+            # Масштабируем изображение по длинной стороне до размера ячейки
+            photo.thumbnail((tile_size, tile_size), Image.LANCZOS, reducing_gap=2.0)
+    except OSError:
+        photo = None
+
+    if photo is not None:
+        # Вставляем фотографию в центр плитки
+        tile.paste(photo, ((tile_size - photo.width) // 2, (tile_size - photo.height) // 2))
+    return tile
+
+
+def build_contact_sheet(order_folder, photo_files=None, output_path=None, start_number=1,
+                        collage_width=CONTACT_SHEET_WIDTH, num_cols=None, threads=CONTACT_SHEET_THREADS) -> Path:
+    """
+    Собирает коллаж-обзор заказа: все фото одним изображением с номерами, как в кнопках "Удалить фото".
+    Плитки уменьшаются параллельно в потоках и вставляются в коллаж по рядам,
+    так что в памяти одновременно только коллаж и один ряд плиток.
+
+    :param order_folder: Папка заказа.
+    :param photo_files: Фото в порядке номеров, по умолчанию все фото из манифеста заказа.
+    :param output_path: Куда сохранить коллаж, по умолчанию в служебный каталог заказа.
+    :param start_number: Номер первого фото.
+    :param num_cols: Количество столбцов, по умолчанию коллаж примерно квадратный.
+    :return: Путь к коллажу.
+    """
+    order_folder = Path(order_folder)
+    if photo_files is None:
+        photo_files = OrderManifest.load(order_folder).paths()
+    if not photo_files:
+        raise ValueError(f"No photos in order {order_folder}")
+    if output_path is None:
+        output_path = order_folder / ORDER_SERVICE_DIR / CONTACT_SHEET_FILENAME
+    output_path = Path(output_path)
+
+    # Определяем количество строк и столбцов
+    num_photos = len(photo_files)
+    if num_cols is None:
+        num_cols = int((num_photos ** 0.5) + 0.5)  # Округляем до ближайшего целого
+    num_cols = max(1, min(num_cols, num_photos))
+    num_rows = (num_photos + num_cols - 1) // num_cols  # Округляем вверх
+
+    # Фотографии квадратные
+    photo_width = collage_width // num_cols
+    font = load_font(int(photo_width * font_size_percent))
+
+    collage = Image.new('RGB', (collage_width, num_rows * photo_width), (bg_col_byte, bg_col_byte, bg_col_byte))
+    draw = ImageDraw.Draw(collage)
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for row in range(num_rows):
+            row_files = photo_files[row * num_cols:(row + 1) * num_cols]
+            tiles = executor.map(make_tile, row_files, [photo_width] * len(row_files))
+            for col, tile in enumerate(tiles):
+                x, y = col * photo_width, row * photo_width
+                collage.paste(tile, (x, y))
+                # Добавляем порядковый номер на фотографию (шрифт не потокобезопасен, поэтому не в потоках)
+                text_position = (x + photo_width // 2, y + photo_width - photo_width // 20)
+                draw.text(text_position, f"{start_number + row * num_cols + col}", font=font, fill=(255, 255, 255),
+                          anchor='md', stroke_width=max(1, photo_width // 100), stroke_fill=(0, 0, 0))
+
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = output_path.with_name(f'{output_path.name}.part')
+    collage.save(tmp_path, 'JPEG', quality=CONTACT_SHEET_QUALITY)
+    tmp_path.replace(output_path)
+    return output_path
+
+
+def contact_sheet_page_count(num_photos: int, num_cols=CONTACT_SHEET_COLUMNS, num_rows=CONTACT_SHEET_ROWS) -> int:
+    per_page = num_cols * num_rows
+    return (num_photos + per_page - 1) // per_page  # Округляем вверх
+
+
+def contact_sheet_page_key(photo_files, start_number: int, num_cols: int, collage_width: int) -> str:
+    """
+    Ключ страницы коллажа: имена, размеры и время изменения её фото, номер первого фото и сетка.
+    Если ключ не изменился, сохранённую страницу можно отправить без пересборки.
+    """
+    key = hashlib.sha1(f'{start_number}:{num_cols}:{collage_width}'.encode())
+    for photo_file in photo_files:
+        try:
+            stat = Path(photo_file).stat()
+            key.update(f'|{Path(photo_file).name}:{stat.st_size}:{stat.st_mtime_ns}'.encode())
+        except FileNotFoundError:
+            key.update(f'|{Path(photo_file).name}:-'.encode())
+    return key.hexdigest()[:16]
+
+
+def build_contact_sheet_page(order_folder, photo_files, page: int, num_cols=CONTACT_SHEET_COLUMNS,
+                             num_rows=CONTACT_SHEET_ROWS, collage_width=CONTACT_SHEET_WIDTH) -> Path:
+    """
+    Возвращает страницу коллажа-обзора большого заказа: сетка num_cols x num_rows фото, номера сквозные.
+    Память на страницу не зависит от размера заказа. Страницы кэшируются в служебном каталоге заказа,
+    пересобирается только страница, фото которой изменились (или сдвинулись номера).
+
+    :param photo_files: Все фото заказа в порядке номеров.
+    :param page: Номер страницы (с 1).
+    :raises IndexError: Если страницы с таким номером нет.
+    :return: Путь к странице коллажа.
+    """
+    order_folder = Path(order_folder)
+    per_page = num_cols * num_rows
+    total_pages = contact_sheet_page_count(len(photo_files), num_cols, num_rows)
+    if not 1 <= page <= total_pages:
+        raise IndexError(f"Contact sheet page {page} not in order {order_folder}")
+
+    start_number = (page - 1) * per_page + 1
+    page_files = photo_files[start_number - 1:start_number - 1 + per_page]
+    key = contact_sheet_page_key(page_files, start_number, num_cols, collage_width)
+    pages_dir = order_folder / ORDER_SERVICE_DIR / CONTACT_SHEET_PAGES_DIR
+    output_path = pages_dir / f'page_{page:03}_{key}.jpg'
+    if output_path.exists():
+        return output_path
+
+    # Удаляем устаревшие версии этой страницы и страницы, которых больше нет
+    for old_path in pages_dir.glob('page_*.jpg'):
+        old_page = int(old_path.name.split('_')[1])
+        if old_page == page or old_page > total_pages:
+            old_path.unlink(missing_ok=True)
+    return build_contact_sheet(order_folder, page_files, output_path, start_number, collage_width, num_cols)
 
 
-# Определяем количество строк и столбцов
-num_photos = len(photo_files)
-num_cols = int((num_photos ** 0.5) + 0.5)  # Округляем до ближайшего целого
-num_rows = (num_photos + num_cols - 1) // num_cols  # Округляем вверх
-
-# Определяем размер каждой фотографии
-photo_width = collage_width // num_cols
-photo_height = photo_width  # Мы делаем фотографии квадратными
-
-# Шрифт для порядковых номеров
-font_name = "Arial.ttf"
-try:
-    font = ImageFont.truetype(font_name, int(photo_width * font_size_percent))
-except OSError:
-    # Если шрифт Arial.ttf не найден, используем встроенный шрифт
-    font = ImageFont.load_default()
-    print(f'Using default font {font}')
-
-
-# Создаем новое изображение для коллажа
-collage_height = num_rows * photo_height
-collage = Image.new('RGB', (collage_width, collage_height), (bg_col_byte, bg_col_byte, bg_col_byte))
-
-# Координаты для размещения фотографий
-x, y = 0, 0
-
-for i, photo_file in enumerate(photo_files):
-    photo = Image.open(photo_file)
-    
-    # Масштабируем изображение по длинной стороне до размера ячейки
-    if photo.width > photo.height:
-        new_width = photo_width
-        new_height = int(photo.height * (photo_width / photo.width))
-    else:
-        new_height = photo_height
-        new_width = int(photo.width * (photo_height / photo.height))
-    
-    photo = photo.resize((new_width, new_height), Image.LANCZOS)
-    
-    # Создаем новое изображение с белыми полями, чтобы сохранить пропорции
-    resized_photo = Image.new('RGB', (photo_width, photo_height), (bg_col_byte, bg_col_byte, bg_col_byte))
-    
-    # Вычисляем координаты для вставки фотографии с сохранением пропорций
-    offset_x = (photo_width - new_width) // 2
-    offset_y = (photo_height - new_height) // 2
-    
-    # Вставляем фотографию в центр нового изображения
-    resized_photo.paste(photo, (offset_x, offset_y))
-    
-    # Добавляем порядковый номер на фотографию
-    draw = ImageDraw.Draw(resized_photo)
-    text_color = (255, 255, 255)  # Белый цвет текста (или черный, если необходимо)
-    text_position = (int(resized_photo.width/2), resized_photo.height - int(resized_photo.height * font_size_percent))
-    draw.text(text_position, f"{i+1}", font=font, fill=text_color)
-    
-    # Размещаем фотографию на коллаже
-    collage.paste(resized_photo, (x, y))
-    
-    # Обновляем координаты для следующей фотографии
-    x += photo_width
-    
-    # Если достигли конца строки, переходим на новую строку
-    if (i + 1) % num_cols == 0:
-        x = 0
-        y += photo_height
-
-# Сохраняем коллаж
-collage.save("collage.jpg")
\ No newline at end of file
+if __name__ == '__main__':
+    # python collage.py <папка заказа> [файл коллажа]
+    if len(sys.argv) < 2:
+        print(f'Usage: python {sys.argv[0]} <order folder> [collage.jpg]')
+        sys.exit(1)
+    photos_dir = Path(sys.argv[1])
+    manifest = OrderManifest.load(photos_dir)
+    manifest.scan()
+    print(build_contact_sheet(photos_dir, manifest.paths(), sys.argv[2] if len(sys.argv) > 2 else "collage.jpg"))
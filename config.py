@@ -1,3 +1,4 @@
+import os
 from dotenv import dotenv_values
 
 # Загружаем переменные окружения
@@ -7,14 +8,100 @@ config = dotenv_values(".env")
 
 BOT_TOKEN = config['BOT_API']
 API_URL = config['API_URL']
+API_CACHE_TTL = 60  # секунд хранить ответ 1С о заказе (0 - без кэша)
+API_POOL_SIZE = 10  # максимум одновременных соединений с 1С
+API_TIMEOUT = 30  # таймаут запроса к 1С, секунд
 ALLOWED_PATH = config['ALLOWED_PATH']
 ERROR_MESSAGE_FOR_USER = config['ERROR_MESSAGE_FOR_USER']
 MANAGER_TELEGRAM_ID = config['MANAGER_TELEGRAM_ID']
+# Режим получения апдейтов: 'polling' или 'webhook' (встроенный aiohttp-сервер)
+BOT_MODE = config.get('BOT_MODE', 'polling')
+WEBHOOK_HOST = config.get('WEBHOOK_HOST', '0.0.0.0')  # адрес, на котором слушает сервер
+WEBHOOK_PORT = int(config.get('WEBHOOK_PORT', 8080))
+WEBHOOK_PATH = '/webhook'
+# Публичный URL (https://домен/webhook), который бот регистрирует в Telegram; пусто - не регистрировать (локальные тесты)
+WEBHOOK_URL = config.get('WEBHOOK_URL', '')
+WEBHOOK_SECRET = config.get('WEBHOOK_SECRET', '')  # проверяется в заголовке X-Telegram-Bot-Api-Secret-Token
+# Процессов-воркеров при запуске через python supervisor.py (апдейты делятся между ними по id пользователя)
+WORKER_PROCESSES = int(config.get('WORKER_PROCESSES', os.cpu_count() or 1))
+# Метрики Prometheus на http://METRICS_HOST:METRICS_PORT/metrics; без METRICS_PORT метрики не собираются
+# При запуске через supervisor.py воркер N отдаёт метрики на METRICS_PORT + N
+METRICS_PORT = int(config['METRICS_PORT']) if config.get('METRICS_PORT') else None
+METRICS_HOST = config.get('METRICS_HOST', '127.0.0.1')
+# Трассировка (tracing.py): апдейты дольше порога пишутся в TRACE_FILE деревом этапов с временем
+TRACE_SLOW_UPDATE_SECONDS = 10.0  # None - трассировка выключена
+TRACE_FILE = 'slow_updates.jsonl'  # при запуске через supervisor.py у воркера N - slow_updates_N.jsonl
+TRACE_FILE_MAX_BYTES = 10 * 1024 * 1024  # размер файла до ротации
+TRACE_FILE_BACKUP_COUNT = 5  # сколько старых файлов хранить
 MIN_ASPECT_RATIO = 0.67
 MAX_ASPECT_RATIO = 1 / MIN_ASPECT_RATIO
+# Формат печати и минимальное разрешение для проверки, хватает ли пикселей фото
+PRINT_SIZE_MM = (148, 210)  # A5
+# MIN_PRINT_DPI = 0  # turn off check
+MIN_PRINT_DPI = 150
 # BLURR_THRESHOLD = 0.0  # turn off check
-BLURR_THRESHOLD = 100.0
+BLURR_THRESHOLD = 100.0  # порог для BLUR_MODE = 'full' (полное разрешение)
+# Режим оценки размытия:
+# 'fast' - уменьшенное декодирование до BLUR_TARGET_SIZE по длинной стороне, метрика не зависит от разрешения фото
+# 'full' - полное разрешение, как раньше (порог BLURR_THRESHOLD значит разное для разных разрешений)
+BLUR_MODE = 'fast'
+BLUR_TARGET_SIZE = 1024
+# Порог для BLUR_MODE = 'fast', откалиброван для BLUR_TARGET_SIZE = 1024 на кадрах make_scene
+# из bench_upload_pipeline.py (JPEG, качество 90, по 5 кадров на разрешение):
+#   резкие:  2 Мп 66-127, 12 Мп 59-107, 48 Мп 47-103
+#   размытие ~4 px на 12 Мп (~1 px на 1024 px): 2 Мп 9-15, 12 Мп 8-14, 48 Мп 8-14
+BLURR_THRESHOLD_FAST = 30.0
+# Порог, с которым сравнивается результат analyze_photo в текущем режиме (0 - проверка выключена)
+BLUR_THRESHOLD_ACTIVE = 0.0 if BLURR_THRESHOLD == 0 else (BLURR_THRESHOLD_FAST if BLUR_MODE == 'fast' else BLURR_THRESHOLD)
+# Максимум различающихся бит перцептивного хеша (из 64) для предупреждения о похожих фото
+# PHASH_DISTANCE_THRESHOLD = -1  # turn off check
+PHASH_DISTANCE_THRESHOLD = 6
 IMG_WORK_FORMAT = 'jpg'
+# Параметры перекодирования присланных HEIC/PNG/WebP/TIFF в IMG_WORK_FORMAT (JPEG не перекодируется)
+IMG_WORK_QUALITY = 95
+IMG_WORK_SUBSAMPLING = '4:4:4'  # без потери цветовой чёткости, '4:2:0' - меньше размер файла
+
+# Пул процессов для конвертации и проверок фотографий
+ANALYSIS_POOL_SIZE = None  # количество процессов, None - по числу ядер
+ANALYSIS_QUEUE_SIZE = 32  # максимум задач, одновременно переданных в пул, остальные ждут
+ANALYSIS_TASK_TIMEOUT = 120  # секунд на одну задачу (и на ожидание места в очереди)
+
+# Кэш результатов проверки фотографий по MD5
+ANALYSIS_CACHE_SIZE = 5000  # результатов в памяти (LRU)
+ANALYSIS_CACHE_DIR = None  # каталог дискового кэша, None - только в памяти
+ANALYSIS_CACHE_DISK_MAX_FILES = 100000  # файлов в дисковом кэше, старые удаляются
+
+DOWNLOAD_CONCURRENCY = 8  # одновременных скачиваний файлов из Telegram на весь бот
+DOWNLOAD_TIMEOUT = 300  # секунд на скачивание одного файла
+
+MEDIA_GROUP_DELAY = 1.0  # секунд ждать следующее фото альбома перед обработкой альбома целиком
+
+ORDER_SERVICE_DIR = '.ideaprint'  # служебный каталог внутри папки заказа (индексы, кэши)
+ORDER_FILES_SAVE_DELAY = 1.0  # секунд копить изменения индекса и манифеста заказа перед записью на диск
+
+# Превью фотографий для просмотра заказа (хранятся в служебном каталоге заказа)
+PREVIEW_MAX_SIDE = 800  # пикселей по длинной стороне
+PREVIEW_MAX_BYTES = 150_000
+FILE_ID_CACHE_SIZE = 10000  # file_id уже отправленных превью в памяти, повторно они не загружаются
+
+# Просмотр фото заказа: 'photos' - каждое фото отдельным сообщением со своей кнопкой удаления,
+# 'media_group' - блок одним альбомом и одно сообщение с кнопками удаления по номерам
+EDIT_VIEW_MODE = 'media_group'
+MAX_CAPTION_LENGTH = 1024  # ограничение Telegram на подпись к фото
+
+# Хранилище состояний FSM (номер и папка заказа пользователя), переживает перезапуск бота
+FSM_STORAGE_PATH = 'fsm_storage.sqlite3'  # файл SQLite, None - в памяти (MemoryStorage)
+FSM_FLUSH_INTERVAL = 1.0  # секунд между записями изменений в базу
+FSM_BUSY_TIMEOUT = 5.0  # секунд ждать, пока база занята другим процессом (воркеры супервизора)
+
+# Коллаж-обзор заказа (collage.py)
+CONTACT_SHEET_WIDTH = 1280  # ширина коллажа, пикселей
+CONTACT_SHEET_COLUMNS = 5  # сетка страницы коллажа для бота: столбцов
+CONTACT_SHEET_ROWS = 6  # и строк (30 фото на странице)
+CONTACT_SHEET_THREADS = 4  # потоков для уменьшения фото
+CONTACT_SHEET_QUALITY = 85  # качество JPEG коллажа
+CONTACT_SHEET_FONT = 'Arial.ttf'  # шрифт номеров фото, если не найден - встроенный
+
 SEND_AS_FILE_INSTRUCTION = '''Для отправки фотографии как файл в телеграм, в максимальном исходном качестве сделайте следующее:\n
 Нажмите скрепку в левом нижнем углу.\n
 Нажмите кнопку «Файл/Документ». Нажмите «Выбрать из галереи».\n
@@ -0,0 +1,227 @@
+# fake_telegram_load_test.py
+# Нагрузочный тест бота целиком, без настоящего Telegram: хэндлеры ideaprint_bot.py без изменений,
+# вместо Telegram - fake_telegram_server.py, вместо 1С - маленький сервер с заказами в этом же процессе.
+# Каждый покупатель: /start, номер заказа, альбом файлами, "Редактировать фото", блок фото,
+# удаление одного фото, повторная отправка фото. Для каждого шага меряется время от отправки
+# апдейта до ответа бота, которым шаг заканчивается.
+# Пример:
+#   python fake_telegram_load_test.py --customers 200 --album-size 5 --latency-ms 50 --flood-rate 0.01
+import argparse
+import asyncio
+import json
+import logging
+import random
+import shutil
+import tempfile
+from collections import Counter, defaultdict
+from pathlib import Path
+from time import perf_counter
+from aiohttp import web
+from bench_upload_pipeline import generate_sources, user_photos, percentiles, peak_rss_mb, resource
+from fake_telegram_server import FakeTelegramServer
+
+
+# Шаги сценария покупателя в порядке выполнения
+STEPS = ['start', 'order_number', 'album', 'edit_photo', 'edit_photo_block', 'delete_photo', 'reupload']
+
+
+def _album_done(text: str) -> bool:
+    return text.startswith('Заказ сформирован') or 'Жду ещё' in text or 'больше чем в заказе' in text
+
+
+def _block_done(text: str) -> bool:
+    return text.startswith('Удалить фото с номером') or text.startswith('Доступные действия')
+
+
+class ErrorCounter(logging.Handler):
+    """Считает ошибки в логе бота и aiogram (например, необработанные 429), чтобы не печатать их все."""
+
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.errors = Counter()
+
+    def emit(self, record: logging.LogRecord):
+        self.errors[record.exc_info[0].__name__ if record.exc_info else record.name] += 1
+
+
+async def start_order_api(orders_dir: Path, album_size: int, port: int) -> web.AppRunner:
+    """Сервер вместо 1С: любой номер заказа существует, в заказе album_size фото."""
+    async def get_path(request: web.Request):
+        order_number = request.match_info['order_number']
+        return web.json_response({'result': True, 'path': str(orders_dir / f'order_{order_number}'),
+                                  'quantity': album_size})
+
+    app = web.Application()
+    app.router.add_get('/getpath/{order_number}', get_path)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+    return runner
+
+
+async def run_load(args) -> dict:
+    import config
+    config.FSM_STORAGE_PATH = None  # состояния в памяти, рабочая база не трогается
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    import ideaprint_bot as ib
+    error_counter = ErrorCounter()
+    logging.getLogger().addHandler(error_counter)
+    if args.verbose:
+        logging.getLogger().setLevel(logging.INFO)
+    else:
+        # Ошибки только считаются, тексты ошибок не печатаются
+        for handler in logging.getLogger().handlers:
+            if handler is not error_counter:
+                handler.setLevel(logging.CRITICAL)
+        logging.getLogger('main').setLevel(logging.ERROR)
+
+    sources_dir = args.workdir / 'sources'
+    orders_dir = args.workdir / 'orders'
+    shutil.rmtree(orders_dir, ignore_errors=True)
+    orders_dir.mkdir(parents=True)
+    sources = generate_sources(sources_dir, args.max_megapixels)
+
+    server = FakeTelegramServer(args.latency_ms, args.latency_jitter_ms, args.flood_rate, args.retry_after, args.seed)
+    await server.start('127.0.0.1', args.telegram_port)
+    order_api = await start_order_api(orders_dir, args.album_size, args.api_port)
+
+    # Бот тот же, меняются только адреса Telegram и 1С
+    ib.bot.session = AiohttpSession(api=TelegramAPIServer.from_base(f'http://127.0.0.1:{args.telegram_port}'))
+    ib.api_client.base_url = f'http://127.0.0.1:{args.api_port}/getpath/'
+    ib.ALLOWED_PATH = str(orders_dir)
+    ib.analysis_service.start()
+    if args.mode == 'webhook':
+        ib.WEBHOOK_HOST, ib.WEBHOOK_PORT = '127.0.0.1', args.webhook_port
+        ib.WEBHOOK_URL = f'http://127.0.0.1:{args.webhook_port}{ib.WEBHOOK_PATH}'
+        ib.WEBHOOK_SECRET = 'load-test-secret'
+        bot_task = asyncio.create_task(ib.run_webhook())
+        while server.webhook_url is None:
+            if bot_task.done():
+                await bot_task
+            await asyncio.sleep(0.05)
+    else:
+        bot_task = asyncio.create_task(ib.dp.start_polling(ib.bot, handle_signals=False))
+
+    latencies = defaultdict(list)
+    timeouts = Counter()
+    completed = 0
+    rng = random.Random(args.seed)
+
+    async def customer(customer_index: int):
+        nonlocal completed
+        user_id = 10_000 + customer_index
+        order_number = f'{customer_index:06d}'
+        photos = [sources_dir / name for name in user_photos(sources, customer_index, args.album_size)]
+        await asyncio.sleep(rng.uniform(0, args.ramp_seconds))
+
+        async def step(name, send, predicate):
+            started = perf_counter()
+            await send
+            try:
+                await server.wait_for_message(user_id, predicate, args.step_timeout)
+            except asyncio.TimeoutError:
+                timeouts[name] += 1
+                return False
+            latencies[name].append(perf_counter() - started)
+            return True
+
+        steps = [
+            ('start', lambda: server.send_text(user_id, '/start'),
+             lambda text: text.startswith('Если вы уже оплатили')),
+            ('order_number', lambda: server.send_text(user_id, order_number),
+             lambda text: text == ib.SEND_AS_FILE_INSTRUCTION),
+            ('album', lambda: server.send_documents(user_id, photos, media_group_id=user_id), _album_done),
+            ('edit_photo', lambda: server.press_button(user_id, f'edit_photo:{order_number}'),
+             lambda text: text.startswith('Выберите блок фото')),
+            ('edit_photo_block', lambda: server.press_button(user_id, f'edit_photo_block:{order_number}:1'),
+             _block_done),
+            ('delete_photo', lambda: server.press_button(user_id, f'delete_photo:{order_number}:1'),
+             lambda text: text.startswith('Загружено') or 'не найдено' in text),
+            ('reupload', lambda: server.send_documents(user_id, photos[:1]), _album_done),
+        ]
+        for name, send, predicate in steps:
+            if not await step(name, send(), predicate):
+                return
+        completed += 1
+
+    started = perf_counter()
+    try:
+        await asyncio.gather(*(customer(customer_index) for customer_index in range(args.customers)))
+        wall = perf_counter() - started
+        await server.wait_idle()
+    finally:
+        if args.mode == 'webhook':
+            bot_task.cancel()
+        else:
+            await ib.dp.stop_polling()
+        await asyncio.gather(bot_task, return_exceptions=True)
+        ib.analysis_service.shutdown(wait=True)
+        await ib.api_client.close()
+        await order_api.cleanup()
+        await server.stop()
+
+    return {
+        'mode': args.mode,
+        'customers': args.customers,
+        'album_size': args.album_size,
+        'completed': completed,
+        'wall_s': wall,
+        'telegram': {'latency_ms': args.latency_ms, 'latency_jitter_ms': args.latency_jitter_ms,
+                     'flood_rate': args.flood_rate, 'retry_after': args.retry_after},
+        'timeouts': {name: timeouts[name] for name in STEPS if timeouts[name]},
+        'steps': {name: percentiles(latencies[name]) for name in STEPS if latencies[name]},
+        'bot_errors': dict(error_counter.errors),
+        'server': dict(sorted(server.stats.items())),
+        'peak_rss_mb': {
+            'main': peak_rss_mb(resource.RUSAGE_SELF) if resource else None,
+            'pool_processes': peak_rss_mb(resource.RUSAGE_CHILDREN) if resource else None,
+        },
+    }
+
+
+def print_result(result: dict):
+    print(f"\n{result['customers']} customers ({result['mode']}), album of {result['album_size']}: "
+          f"{result['completed']} completed in {result['wall_s']:.1f} s")
+    for name, stats in result['steps'].items():
+        print(f"  {name:18} n={stats['count']:5}  p50 {stats['p50_ms']:8.0f} ms  p90 {stats['p90_ms']:8.0f} ms  "
+              f"p99 {stats['p99_ms']:8.0f} ms  max {stats['max_ms']:8.0f} ms")
+    for name, number in result['timeouts'].items():
+        print(f"  {name:18} timeouts: {number}")
+    for name, number in result['bot_errors'].items():
+        print(f"  bot errors {name}: {number}")
+    server = result['server']
+    print(f"  429 sent: {server.get('flood_429', 0)}, photos uploaded: {server.get('uploaded_files', 0)}, "
+          f"file_id reused: {server.get('reused_file_ids', 0)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end load test of the bot against a fake Telegram Bot API.')
+    parser.add_argument('--customers', type=int, default=100)
+    parser.add_argument('--album-size', type=int, default=5, help='Фото в альбоме (и в заказе).')
+    parser.add_argument('--ramp-seconds', type=float, default=5.0, help='За сколько секунд приходят все покупатели.')
+    parser.add_argument('--mode', choices=['polling', 'webhook'], default='polling')
+    parser.add_argument('--latency-ms', type=float, default=50.0, help='Средняя задержка ответа Telegram, мс.')
+    parser.add_argument('--latency-jitter-ms', type=float, default=20.0)
+    parser.add_argument('--flood-rate', type=float, default=0.0, help='Доля ответов 429 на методы отправки.')
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--step-timeout', type=float, default=120.0, help='Сколько ждать ответа бота на шаг, секунд.')
+    parser.add_argument('--max-megapixels', type=float, default=12, help='Не отправлять фото больше этого.')
+    parser.add_argument('--telegram-port', type=int, default=8081)
+    parser.add_argument('--api-port', type=int, default=8082)
+    parser.add_argument('--webhook-port', type=int, default=8083)
+    parser.add_argument('--workdir', type=Path, default=Path(tempfile.gettempdir()) / 'ideaprint_fake_telegram')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--output', type=Path, default=None, help='JSON с результатами.')
+    parser.add_argument('--verbose', action='store_true', help='Показывать лог бота.')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+    result = asyncio.run(run_load(args))
+    print_result(result)
+    if args.output:
+        args.output.write_text(json.dumps(result, indent=2), encoding='utf-8')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,334 @@
+# fake_telegram_server.py
+# Локальная замена Telegram Bot API для нагрузочных тестов бота (см. fake_telegram_load_test.py).
+# Реализует то, чем пользуется бот: getUpdates и доставку вебхуком, getFile и скачивание файлов,
+# отправку сообщений, фото и альбомов, ответы на кнопки. Задержка ответа и ответы 429 настраиваются.
+# Бот подключается так:
+#   bot.session = AiohttpSession(api=TelegramAPIServer.from_base('http://127.0.0.1:8081'))
+import asyncio
+import json
+import logging
+import mimetypes
+import random
+from collections import Counter, defaultdict
+from itertools import count
+from pathlib import Path
+from time import time, monotonic
+from aiohttp import web, ClientSession, ClientError
+
+
+logger = logging.getLogger("main")
+
+# Методы, на которые при флуде отвечаем 429, как настоящий Telegram
+FLOOD_METHODS = {
+    'sendMessage', 'sendPhoto', 'sendDocument', 'sendMediaGroup', 'answerCallbackQuery',
+    'editMessageText', 'editMessageReplyMarkup', 'editMessageCaption', 'deleteMessage',
+}
+BOT_USER = {'id': 123456, 'is_bot': True, 'first_name': 'Fake Ideaprint', 'username': 'fake_ideaprint_bot'}
+
+
+def _ok(result):
+    return web.json_response({'ok': True, 'result': result})
+
+
+def _error(status: int, description: str, parameters=None):
+    data = {'ok': False, 'error_code': status, 'description': description}
+    if parameters:
+        data['parameters'] = parameters
+    return web.json_response(data, status=status)
+
+
+def _user(user_id: int) -> dict:
+    return {'id': user_id, 'is_bot': False, 'first_name': f'Customer {user_id}', 'language_code': 'ru'}
+
+
+def _private_chat(chat_id: int) -> dict:
+    return {'id': chat_id, 'type': 'private', 'first_name': f'Customer {chat_id}'}
+
+
+class FakeTelegramServer:
+    """
+    Сервер Bot API в памяти. Пользователи (сценарии нагрузочного теста) шлют апдейты через
+    send_text/send_documents/press_button, бот забирает их через getUpdates или получает вебхуком.
+    Все сообщения бота складываются в очередь чата, из неё их читает wait_for_message.
+    """
+
+    def __init__(self, latency_ms=0.0, latency_jitter_ms=0.0, flood_rate=0.0, retry_after=1, seed=None):
+        """
+        :param latency_ms: Средняя задержка ответа на каждый метод, мс.
+        :param latency_jitter_ms: Стандартное отклонение задержки, мс.
+        :param flood_rate: Доля ответов 429 на методы отправки (FLOOD_METHODS).
+        :param retry_after: Значение retry_after в ответах 429, секунд.
+        """
+        self.latency_ms = latency_ms
+        self.latency_jitter_ms = latency_jitter_ms
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+        self._update_ids = count(1)
+        self._message_ids = count(1)
+        self._file_ids = count(1)
+        self._updates = []  # апдейты, ещё не подтверждённые getUpdates (offset)
+        self._updates_added = asyncio.Event()
+        self.files = {}  # file_id -> путь к файлу
+        self.webhook_url = None
+        self.webhook_secret = None
+        self._webhook_session = None
+        self._deliveries = set()
+        self._chats = defaultdict(asyncio.Queue)  # chat_id -> сообщения бота
+        self.stats = Counter()
+        self._last_request = monotonic()
+        self._runner = None
+
+    # --- Сервер ---
+
+    def make_app(self) -> web.Application:
+        app = web.Application(client_max_size=100 * 1024 ** 2)
+        app.router.add_route('*', '/bot{token}/{method}', self.handle_method)
+        app.router.add_get('/file/bot{token}/{file_path:.+}', self.handle_file)
+        return app
+
+    async def start(self, host='127.0.0.1', port=8081):
+        self._runner = web.AppRunner(self.make_app(), access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logger.info(f"Fake Telegram Bot API listening on http://{host}:{port}")
+
+    async def wait_idle(self, quiet=1.0, timeout=30.0):
+        """Ждёт, пока бот quiet секунд не вызывает методы (кроме getUpdates): хэндлеры доработали."""
+        deadline = monotonic() + timeout
+        while monotonic() - self._last_request < quiet and monotonic() < deadline:
+            await asyncio.sleep(0.1)
+
+    async def stop(self):
+        if self._deliveries:
+            await asyncio.gather(*self._deliveries, return_exceptions=True)
+        if self._webhook_session is not None:
+            await self._webhook_session.close()
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def _delay(self):
+        if self.latency_ms or self.latency_jitter_ms:
+            delay_ms = self._random.gauss(self.latency_ms, self.latency_jitter_ms)
+            await asyncio.sleep(max(0.0, delay_ms) / 1000)
+
+    async def handle_method(self, request: web.Request):
+        method = request.match_info['method']
+        params = dict(await request.post())
+        if not params and request.can_read_body and request.content_type == 'application/json':
+            params = await request.json()
+        self.stats[f'method.{method}'] += 1
+
+        if method != 'getUpdates':
+            self._last_request = monotonic()
+            await self._delay()
+        if method in FLOOD_METHODS and self._random.random() < self.flood_rate:
+            self.stats['flood_429'] += 1
+            return _error(429, f'Too Many Requests: retry after {self.retry_after}',
+                          {'retry_after': self.retry_after})
+
+        handler = getattr(self, f'api_{method}', None)
+        if handler is None:
+            self.stats['not_implemented'] += 1
+            return _error(400, f'Bad Request: method {method} is not implemented by the fake server')
+        return await handler(params)
+
+    async def handle_file(self, request: web.Request):
+        path = self.files.get(request.match_info['file_path'])
+        if path is None:
+            return _error(404, 'Not Found')
+        await self._delay()
+        self.stats['downloaded_bytes'] += path.stat().st_size
+        return web.FileResponse(path)
+
+    # --- Апдейты ---
+
+    async def push_update(self, kind: str, event: dict):
+        """Добавляет апдейт: отдаёт его в getUpdates или отправляет на вебхук."""
+        update = {'update_id': next(self._update_ids), kind: event}
+        self.stats['updates'] += 1
+        if self.webhook_url:
+            task = asyncio.create_task(self._deliver(update))
+            self._deliveries.add(task)
+            task.add_done_callback(self._deliveries.discard)
+        else:
+            self._updates.append(update)
+            self._updates_added.set()
+
+    async def _deliver(self, update: dict):
+        if self._webhook_session is None:
+            self._webhook_session = ClientSession()
+        headers = {'X-Telegram-Bot-Api-Secret-Token': self.webhook_secret} if self.webhook_secret else {}
+        # Telegram повторяет доставку, пока вебхук не ответит 200
+        for attempt in range(5):
+            try:
+                async with self._webhook_session.post(self.webhook_url, json=update, headers=headers) as response:
+                    if response.status == 200:
+                        return
+                    logger.warning(f"Webhook answered {response.status} for update {update['update_id']}")
+            except ClientError as e:
+                logger.warning(f"Webhook delivery of update {update['update_id']} failed: {e!r}")
+            self.stats['webhook_retries'] += 1
+            await asyncio.sleep(0.5 * (attempt + 1))
+        self.stats['webhook_lost'] += 1
+
+    def _message(self, user_id: int, **fields) -> dict:
+        return {
+            'message_id': next(self._message_ids), 'date': int(time()),
+            'chat': _private_chat(user_id), 'from': _user(user_id), **fields,
+        }
+
+    async def send_text(self, user_id: int, text: str):
+        """Пользователь пишет боту текст (команды начинаются с /)."""
+        fields = {'text': text}
+        if text.startswith('/'):
+            fields['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        await self.push_update('message', self._message(user_id, **fields))
+
+    async def send_documents(self, user_id: int, paths, media_group_id=None):
+        """Пользователь отправляет файлы (несколько - альбомом с media_group_id)."""
+        for path in paths:
+            path = Path(path)
+            file_id = self.add_file(path)
+            fields = {'document': {
+                'file_id': file_id, 'file_unique_id': file_id, 'file_name': path.name,
+                'mime_type': mimetypes.guess_type(path.name)[0] or 'application/octet-stream', 'file_size': path.stat().st_size,
+            }}
+            if media_group_id is not None:
+                fields['media_group_id'] = str(media_group_id)
+            await self.push_update('message', self._message(user_id, **fields))
+
+    async def press_button(self, user_id: int, data: str, message_id=None):
+        """Пользователь нажимает inline-кнопку с callback_data=data."""
+        message = {
+            'message_id': message_id or next(self._message_ids), 'date': int(time()),
+            'chat': _private_chat(user_id), 'from': BOT_USER, 'text': '...',
+        }
+        await self.push_update('callback_query', {
+            'id': str(next(self._update_ids)), 'from': _user(user_id), 'chat_instance': str(user_id),
+            'message': message, 'data': data,
+        })
+
+    def add_file(self, path: Path) -> str:
+        """Регистрирует файл, который можно получить через getFile. Возвращает file_id."""
+        file_id = f'file{next(self._file_ids)}_{path.name}'
+        self.files[file_id] = path
+        return file_id
+
+    # --- Сообщения бота ---
+
+    def _record(self, chat_id, **fields) -> dict:
+        message = {
+            'message_id': next(self._message_ids), 'date': int(time()),
+            'chat': _private_chat(int(chat_id)), 'from': BOT_USER, **fields,
+        }
+        self._chats[int(chat_id)].put_nowait(message)
+        return message
+
+    async def wait_for_message(self, chat_id: int, predicate, timeout: float) -> dict:
+        """
+        Ждёт сообщение бота в чате, для которого predicate(текст или подпись) истинно.
+        Сообщения, пришедшие раньше него, пропускаются.
+        """
+        queue = self._chats[chat_id]
+
+        async def wait():
+            while True:
+                message = await queue.get()
+                if predicate(message.get('text') or message.get('caption') or ''):
+                    return message
+
+        return await asyncio.wait_for(wait(), timeout)
+
+    def _photo(self, params: dict, field='photo') -> dict:
+        value = params.get(field)
+        if isinstance(value, web.FileField):
+            size = len(value.file.read())
+            self.stats['uploaded_files'] += 1
+            self.stats['uploaded_bytes'] += size
+            file_id = f'sent{next(self._file_ids)}'
+        else:
+            size = 0
+            file_id = str(value)
+            self.stats['reused_file_ids'] += 1
+        return {'file_id': file_id, 'file_unique_id': file_id, 'width': 800, 'height': 600, 'file_size': size}
+
+    # --- Методы Bot API ---
+
+    async def api_getMe(self, params):
+        return _ok(BOT_USER)
+
+    async def api_getUpdates(self, params):
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        timeout = float(params.get('timeout') or 0)
+        if self.webhook_url:
+            return _error(409, "Conflict: can't use getUpdates method while webhook is active")
+        self._updates = [update for update in self._updates if update['update_id'] >= offset]
+        if not self._updates and timeout:
+            self._updates_added.clear()
+            try:
+                await asyncio.wait_for(self._updates_added.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return _ok(self._updates[:limit])
+
+    async def api_setWebhook(self, params):
+        self.webhook_url = params['url']
+        self.webhook_secret = params.get('secret_token')
+        # Накопленные апдейты уходят на вебхук
+        updates, self._updates = self._updates, []
+        for update in updates:
+            task = asyncio.create_task(self._deliver(update))
+            self._deliveries.add(task)
+            task.add_done_callback(self._deliveries.discard)
+        return _ok(True)
+
+    async def api_deleteWebhook(self, params):
+        self.webhook_url = self.webhook_secret = None
+        return _ok(True)
+
+    async def api_getFile(self, params):
+        file_id = params['file_id']
+        path = self.files.get(file_id)
+        if path is None:
+            return _error(400, 'Bad Request: invalid file_id')
+        return _ok({'file_id': file_id, 'file_unique_id': file_id, 'file_size': path.stat().st_size,
+                    'file_path': file_id})
+
+    async def api_sendMessage(self, params):
+        return _ok(self._record(params['chat_id'], text=params.get('text', '')))
+
+    async def api_sendPhoto(self, params):
+        return _ok(self._record(params['chat_id'], photo=[self._photo(params)], caption=params.get('caption')))
+
+    async def api_sendDocument(self, params):
+        document = self._photo(params, 'document')
+        return _ok(self._record(params['chat_id'], document=document, caption=params.get('caption')))
+
+    async def api_sendMediaGroup(self, params):
+        media = json.loads(params['media'])
+        media_group_id = str(next(self._message_ids))
+        messages = []
+        for item in media:
+            value = item['media']
+            if value.startswith('attach://'):
+                params[value] = params[value.removeprefix('attach://')]
+            messages.append(self._record(
+                params['chat_id'], photo=[self._photo(params, value)], caption=item.get('caption'),
+                media_group_id=media_group_id,
+            ))
+        return _ok(messages)
+
+    async def api_answerCallbackQuery(self, params):
+        return _ok(True)
+
+    async def api_deleteMessage(self, params):
+        return _ok(True)
+
+    async def api_editMessageText(self, params):
+        return _ok(self._record(params['chat_id'], text=params.get('text', '')))
+
+    async def api_editMessageReplyMarkup(self, params):
+        return _ok(True)
+
@@ -0,0 +1,44 @@
+# file_id_cache.py
+from collections import OrderedDict
+from config import FILE_ID_CACHE_SIZE
+
+
+class FileIdCache:
+    """
+    Кэш file_id, которые Telegram вернул при первой отправке превью фотографии.
+    Ключ - папка заказа и MD5 фотографии: повторно отправленное по file_id фото не загружается заново.
+    """
+
+    def __init__(self, max_items=FILE_ID_CACHE_SIZE):
+        """
+        :param max_items: Максимум file_id в памяти (LRU).
+        """
+        self.max_items = max_items
+        self._items = OrderedDict()  # (папка заказа, md5) -> file_id
+
+    def get(self, order_folder, md5):
+        key = (str(order_folder), md5)
+        file_id = self._items.get(key)
+        if file_id is not None:
+            self._items.move_to_end(key)
+        return file_id
+
+    def put(self, order_folder, md5, file_id):
+        key = (str(order_folder), md5)
+        self._items[key] = file_id
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+
+    def invalidate(self, order_folder, md5):
+        """Забывает file_id фотографии (после удаления файла)."""
+        self._items.pop((str(order_folder), md5), None)
+
+    def drop_order(self, order_folder):
+        """Забывает все file_id заказа (после удаления папки заказа)."""
+        order_folder = str(order_folder)
+        for key in [key for key in self._items if key[0] == order_folder]:
+            del self._items[key]
+
+
+file_id_cache = FileIdCache()
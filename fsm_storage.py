@@ -0,0 +1,156 @@
+# fsm_storage.py
+import asyncio
+import json
+import logging
+import sqlite3
+from pathlib import Path
+from typing import Any, Mapping
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
+from config import FSM_STORAGE_PATH, FSM_FLUSH_INTERVAL, FSM_BUSY_TIMEOUT
+
+
+logger = logging.getLogger("main")
+
+
+def _encode(value):
+    # Path не сериализуется в JSON, сохраняем его с пометкой
+    if isinstance(value, Path):
+        return {'__path__': str(value)}
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _decode(obj):
+    if len(obj) == 1 and '__path__' in obj:
+        return Path(obj['__path__'])
+    return obj
+
+
+def dump_data(data) -> str:
+    return json.dumps(data, default=_encode, ensure_ascii=False)
+
+
+def load_data(text: str) -> dict:
+    return json.loads(text, object_hook=_decode)
+
+
+def _key_to_str(key: StorageKey) -> str:
+    return json.dumps([key.bot_id, key.chat_id, key.user_id, key.thread_id, key.business_connection_id, key.destiny])
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    Хранилище состояний FSM в SQLite, переживающее перезапуск бота.
+
+    Все записи при старте читаются в память, чтение идёт только из памяти.
+    Изменения копятся в памяти и раз в flush_interval секунд пишутся в базу одной транзакцией
+    (при закрытии хранилища - сразу). При падении процесса теряются изменения за последний интервал.
+    Если запись не удалась (например, база занята другим процессом), изменения пишутся при следующей записи.
+    """
+
+    def __init__(self, path=FSM_STORAGE_PATH, flush_interval=FSM_FLUSH_INTERVAL, busy_timeout=FSM_BUSY_TIMEOUT):
+        """
+        :param path: Файл базы SQLite.
+        :param flush_interval: Как часто писать изменения в базу, секунд.
+        :param busy_timeout: Сколько ждать, пока база занята другим соединением, секунд.
+        """
+        self.path = Path(path)
+        self.flush_interval = flush_interval
+        self._records = {}  # ключ -> [state, data]
+        self._dirty = set()
+        self._flush_handle = None  # отложенная запись в базу
+        self._flush_task = None
+        self._flush_lock = asyncio.Lock()
+        self._connection = sqlite3.connect(self.path, timeout=busy_timeout, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS fsm (key TEXT PRIMARY KEY, state TEXT, data TEXT NOT NULL)'
+        )
+        self._load()
+
+    def _load(self):
+        for key, state, data in self._connection.execute('SELECT key, state, data FROM fsm'):
+            try:
+                self._records[key] = [state, load_data(data)]
+            except ValueError as e:
+                logger.error(f"Skipping broken FSM record {key}: {e}")
+        logger.info(f"FSM storage {self.path}: {len(self._records)} sessions restored.")
+
+    def _record(self, key: StorageKey) -> list:
+        return self._records.get(_key_to_str(key)) or [None, {}]
+
+    def _changed(self, key: StorageKey, record: list):
+        str_key = _key_to_str(key)
+        self._records[str_key] = record
+        self._dirty.add(str_key)
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.flush_interval, self._start_flush)
+
+    def _start_flush(self):
+        self._flush_handle = None
+        self._flush_task = asyncio.create_task(self.flush())
+
+    async def flush(self) -> bool:
+        """
+        Пишет накопленные изменения в базу одной транзакцией.
+
+        :return: False, если запись не удалась (изменения остаются в очереди на запись).
+        """
+        async with self._flush_lock:
+            if not self._dirty:
+                return True
+            # Изменения, сделанные во время записи, попадают уже в следующую запись
+            dirty, self._dirty = self._dirty, set()
+            upserts, deletes = [], []
+            for str_key in dirty:
+                state, data = self._records.get(str_key, (None, {}))
+                if state is None and not data:
+                    self._records.pop(str_key, None)
+                    deletes.append((str_key,))
+                else:
+                    upserts.append((str_key, state, dump_data(data)))
+            try:
+                await asyncio.to_thread(self._write, upserts, deletes)
+            except Exception as e:
+                logger.error(f"Failed to write {len(dirty)} FSM records to {self.path}, will retry: {e!r}")
+                self._dirty |= dirty
+                self._schedule_flush()
+                return False
+            return True
+
+    def _write(self, upserts, deletes):
+        with self._connection:
+            self._connection.executemany('INSERT OR REPLACE INTO fsm (key, state, data) VALUES (?, ?, ?)', upserts)
+            self._connection.executemany('DELETE FROM fsm WHERE key = ?', deletes)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        _, data = self._record(key)
+        self._changed(key, [state.state if isinstance(state, State) else state, data])
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        return self._record(key)[0]
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        # Проверяем сериализуемость сразу, а не при записи в базу
+        dump_data(data)
+        state, _ = self._record(key)
+        self._changed(key, [state, dict(data)])
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        return self._record(key)[1].copy()
+
+    async def close(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._flush_task is not None:
+            await self._flush_task
+        if not await self.flush():
+            logger.error(f"FSM storage {self.path} closed with {len(self._dirty)} unsaved records.")
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self._connection.close()
@@ -1,13 +1,13 @@
 #helpers.py
 import aiohttp
-from PIL import Image
+from PIL import Image, ImageOps, UnidentifiedImageError
 from pathlib import Path
 import cv2
 import numpy as np
 import hashlib
+import io
 from pillow_heif import register_heif_opener
-from time import time
-from collections import defaultdict
+from time import time, perf_counter
 from config import *
 import os
 import aiosmtplib
@@ -23,182 +23,530 @@ print(f'OpenCV version: {cv2.__version__}')
 
 register_heif_opener()
 
+# Режимы Pillow с глубиной больше 8 бит на канал (16-битные PNG и TIFF, TIFF с плавающей точкой)
+HIGH_BIT_DEPTH_MODES = ('I;16', 'I;16L', 'I;16B', 'I;16N', 'I', 'F')
+
+
+def to_8bit_grayscale(img: Image.Image) -> Image.Image:
+    """
+    Приводит изображение с глубиной больше 8 бит к режиму L, масштабируя значения в 0..255.
+    convert('L') или convert('RGB') такие значения просто обрезают, и 16-битное фото становится почти белым.
+    Диапазон определяется по максимуму: до 1.0 (float) - доли единицы, до 255 - уже 8 бит,
+    до 65535 - 16 бит, больше - по максимальному значению.
+    """
+    pixels = np.asarray(img, dtype=np.float64)
+    maximum = float(pixels.max()) if pixels.size else 0.0
+    if img.mode == 'F' and maximum <= 1.0:
+        scale = 255.0
+    elif maximum <= 255:
+        scale = 1.0
+    elif maximum <= 65535:
+        scale = 255.0 / 65535
+    else:
+        scale = 255.0 / maximum
+    return Image.fromarray(np.clip(pixels * scale + 0.5, 0, 255).astype(np.uint8), 'L')
+
+
 def convert_to_jpeg(file_path):
     """
-    Конвертирует файл в формат JPEG, если это необходимо, и удаляет исходный файл в случае успешной конвертации.
+    Приводит файл к рабочему формату IMG_WORK_FORMAT и удаляет исходный файл в случае успешной конвертации.
+
+    JPEG не перекодируется: при другом расширении (.jpeg, .JPG) файл только переименовывается.
+    Остальные форматы, которые открывает Pillow/pillow-heif (HEIC, PNG, WebP, TIFF, ...),
+    перекодируются с качеством IMG_WORK_QUALITY и субдискретизацией IMG_WORK_SUBSAMPLING.
+    Ориентация применяется к пикселям, EXIF и цветовой профиль ICC сохраняются.
+    16-битные и float изображения масштабируются в 8 бит. Исходный файл удаляется только после того,
+    как новый файл успешно открылся и декодировался.
 
     :param file_path: Путь к файлу.
-    :return: Путь к конвертированному файлу.
+    :return: Кортеж (путь к конвертированному файлу, перекодирован ли файл). Если файл не перекодировался,
+        его содержимое (и MD5) не изменилось.
+    :raises ValueError: Если файл не является изображением (файл удаляется)
+        или конвертация не удалась (исходный файл остаётся).
     """
     # Преобразуем путь в объект Path
     file_path = Path(file_path)
-    
-    # Проверяем, является ли файл HEIC
-    if file_path.suffix.lower() in ('.heic', '.heif'):
-        # Открываем файл с помощью PIL
-        with Image.open(file_path) as img:
-            # Создаем путь для сохранения JPEG файла
-            image_path = file_path.with_suffix(f'.{IMG_WORK_FORMAT}')
-            
-            # Сохраняем изображение в формате JPEG
-            # img.save(image_path, "JPEG")
-            img.save(image_path)
-            
-            # Удаляем исходный файл
-            file_path.unlink()
-            
-            return image_path
-    else:
-        # Если файл не является HEIC, возвращаем исходный путь
-        return file_path
+    image_path = file_path.with_suffix(f'.{IMG_WORK_FORMAT}')
+    work_format = Image.registered_extensions()[f'.{IMG_WORK_FORMAT}']
+
+    try:
+        img = Image.open(file_path)
+    except (UnidentifiedImageError, OSError) as e:
+        file_path.unlink(missing_ok=True)
+        raise ValueError(f"Файл {get_original_filename(file_path.name)} не является изображением.") from e
+
+    with img:
+        # MPO - JPEG с дополнительными кадрами (так снимают многие телефоны)
+        if img.format == work_format or (work_format == 'JPEG' and img.format == 'MPO'):
+            # Уже в рабочем формате: не перекодируем, только приводим расширение
+            if file_path != image_path:
+                img.close()
+                os.replace(file_path, image_path)
+            return image_path, False
+
+        icc_profile = img.info.get('icc_profile')
+        # Поворачиваем пиксели по EXIF, тег ориентации из EXIF при этом убирается
+        converted = ImageOps.exif_transpose(img)
+        exif = converted.getexif()
+        if converted.mode in ('RGBA', 'LA', 'PA') or (converted.mode == 'P' and 'transparency' in converted.info):
+            # Прозрачность печатаем на белом фоне
+            rgba = converted.convert('RGBA')
+            converted = Image.new('RGB', rgba.size, (255, 255, 255))
+            converted.paste(rgba, mask=rgba.getchannel('A'))
+        elif converted.mode in HIGH_BIT_DEPTH_MODES:
+            converted = to_8bit_grayscale(converted)
+        elif converted.mode not in ('RGB', 'L', 'CMYK'):
+            converted = converted.convert('RGB')
+
+        save_options = {'quality': IMG_WORK_QUALITY, 'subsampling': IMG_WORK_SUBSAMPLING, 'exif': exif.tobytes()}
+        if icc_profile:
+            save_options['icc_profile'] = icc_profile
+        if img.info.get('dpi'):
+            save_options['dpi'] = img.info['dpi']
+
+        # Пишем во временный файл, чтобы недописанный файл не попал в заказ
+        tmp_path = image_path.with_name(f'{image_path.name}.part')
+        try:
+            converted.save(tmp_path, work_format, **save_options)
+            # Проверяем, что новый файл читается целиком, прежде чем удалить исходный
+            with Image.open(tmp_path) as check:
+                check.load()
+        except Exception as e:
+            tmp_path.unlink(missing_ok=True)
+            logger.error(f"Failed to convert {file_path}: {e!r}")
+            raise ValueError(f"Не удалось сконвертировать файл {get_original_filename(file_path.name)}.") from e
+
+    os.replace(tmp_path, image_path)
+    if file_path != image_path:
+        file_path.unlink()
+    return image_path, True
+
+
+def get_preview_path(photo_path) -> Path:
+    """Путь к превью фотографии в служебном каталоге папки заказа."""
+    photo_path = Path(photo_path)
+    return photo_path.parent / ORDER_SERVICE_DIR / 'previews' / photo_path.name
+
+
+def make_preview(photo_path, preview_path=None, max_side=PREVIEW_MAX_SIDE, max_bytes=PREVIEW_MAX_BYTES):
+    """
+    Создаёт маленькое JPEG-превью фотографии для просмотра в Telegram.
+    JPEG декодируется сразу в уменьшенном виде (draft), качество снижается, пока файл не станет меньше max_bytes.
+
+    :param preview_path: Куда сохранить превью, по умолчанию get_preview_path(photo_path).
+    :return: Путь к превью.
+    """
+    preview_path = Path(preview_path) if preview_path else get_preview_path(photo_path)
+    with Image.open(photo_path) as img:
+        img.draft('RGB', (max_side, max_side))
+        preview = ImageOps.exif_transpose(img).convert('RGB')
+    preview.thumbnail((max_side, max_side), Image.LANCZOS)
+
+    for quality in (85, 75, 65, 50, 35):
+        buffer = io.BytesIO()
+        preview.save(buffer, 'JPEG', quality=quality, optimize=True)
+        if buffer.tell() <= max_bytes:
+            break
+
+    preview_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = preview_path.with_name(f'{preview_path.name}.part')
+    tmp_path.write_bytes(buffer.getvalue())
+    os.replace(tmp_path, preview_path)
+    return preview_path
+
+
+class PhotoAnalysis:
+    """Результат проверки фотографии, который используют все проверки бота."""
+    __slots__ = ('path', 'width', 'height', 'aspect_ratio', 'blur', 'md5', 'dhash', 'timings', 'error')
+
+    def __init__(self, path, width, height, aspect_ratio, blur, md5, dhash, timings=None, error=None):
+        self.path = path
+        self.width = width  # размеры с учётом EXIF-ориентации
+        self.height = height
+        self.aspect_ratio = aspect_ratio  # отношение меньшей стороны к большей
+        self.blur = blur  # дисперсия Лапласиана (1000, если проверка выключена или не удалась)
+        self.md5 = md5
+        self.dhash = dhash  # перцептивный хеш (64 бита) или None, если изображение не декодировалось
+        self.timings = timings  # время этапов проверки, секунд (у результатов из кэша - пустой словарь)
+        self.error = error  # текст ошибки, если изображение не декодировалось (размытие и dHash не проверены)
+
+    def __repr__(self):
+        return (f'PhotoAnalysis({self.path.name}, {self.width}x{self.height}, '
+                f'aspect={self.aspect_ratio:.2f}, blur={self.blur:.1f}, md5={self.md5}, dhash={self.dhash}'
+                + (f', error={self.error!r})' if self.error else ')'))
+
+
+EXIF_ORIENTATION_TAG = 0x0112
+EXIF_TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)  # повороты на 90/270 градусов, ширина и высота меняются местами
+EXIF_X_RESOLUTION_TAG = 0x011A
+EXIF_RESOLUTION_UNIT_TAG = 0x0128
+# Маркеры JPEG SOFn, в которых записаны размеры кадра (кроме DHT/JPG/DAC: C4, C8, CC)
+JPEG_SOF_MARKERS = frozenset((0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF))
+
+
+class ImageHeader:
+    """Геометрия изображения из заголовка файла, без декодирования пикселей."""
+    __slots__ = ('width', 'height', 'orientation', 'dpi')
+
+    def __init__(self, width, height, orientation=1, dpi=None):
+        self.width = width  # размеры с учётом EXIF-ориентации
+        self.height = height
+        self.orientation = orientation  # значение EXIF Orientation (1 - без поворота)
+        self.dpi = dpi  # разрешение из файла (JFIF/EXIF/PNG) или None
+
+    @property
+    def aspect_ratio(self):
+        """Отношение меньшей стороны к большей (0, если размер неизвестен)."""
+        if not self.width or not self.height:
+            return 0.0
+        return min(self.width, self.height) / max(self.width, self.height)
+
+    def __repr__(self):
+        return f'ImageHeader({self.width}x{self.height}, orientation={self.orientation}, dpi={self.dpi})'
+
+
+def _parse_exif_header(exif):
+    """Возвращает (orientation, dpi) из блока TIFF в APP1 Exif. Читается только IFD0."""
+    byte_order = {b'II': 'little', b'MM': 'big'}.get(exif[:2])
+    if byte_order is None:
+        return 1, None
+
+    def number(offset, size):
+        return int.from_bytes(exif[offset:offset + size], byte_order)
+
+    orientation, x_resolution, unit = 1, None, 2
+    ifd_offset = number(4, 4)
+    for entry in range(number(ifd_offset, 2)):
+        entry_offset = ifd_offset + 2 + entry * 12
+        if entry_offset + 12 > len(exif):
+            break
+        tag = number(entry_offset, 2)
+        if tag == EXIF_ORIENTATION_TAG:
+            orientation = number(entry_offset + 8, 2)
+        elif tag == EXIF_RESOLUTION_UNIT_TAG:
+            unit = number(entry_offset + 8, 2)
+        elif tag == EXIF_X_RESOLUTION_TAG:
+            value_offset = number(entry_offset + 8, 4)
+            numerator, denominator = number(value_offset, 4), number(value_offset + 4, 4)
+            if denominator:
+                x_resolution = numerator / denominator
+    if x_resolution and unit == 3:  # точек на сантиметр
+        x_resolution *= 2.54
+    return orientation, x_resolution or None
+
+
+def _read_jpeg_header(f):
+    """
+    Читает маркеры JPEG до кадра SOFn: размеры, EXIF-ориентацию и разрешение (JFIF или EXIF).
+    Сжатые данные не читаются. Возвращает ImageHeader или None, если файл не удалось разобрать.
+    """
+    if f.read(2) != b'\xff\xd8':
+        return None
+    orientation, dpi = 1, None
+    while True:
+        byte = f.read(1)
+        while byte == b'\xff':  # байты-заполнители перед маркером
+            byte = f.read(1)
+        if not byte:
+            return None
+        marker = byte[0]
+        if marker == 0xD9 or marker == 0xDA:  # конец файла или начало сжатых данных до SOF
+            return None
+        length_bytes = f.read(2)
+        if len(length_bytes) < 2:
+            return None
+        length = int.from_bytes(length_bytes, 'big') - 2
+        if marker in JPEG_SOF_MARKERS:
+            segment = f.read(5)
+            if len(segment) < 5:
+                return None
+            height, width = int.from_bytes(segment[1:3], 'big'), int.from_bytes(segment[3:5], 'big')
+            if orientation in EXIF_TRANSPOSED_ORIENTATIONS:
+                width, height = height, width
+            return ImageHeader(width, height, orientation, dpi)
+        if marker == 0xE0 or marker == 0xE1:
+            segment = f.read(length)
+            if marker == 0xE0 and segment[:5] == b'JFIF\x00' and len(segment) >= 12 and dpi is None:
+                units, density = segment[7], int.from_bytes(segment[8:10], 'big')
+                if units == 1:
+                    dpi = density or None
+                elif units == 2:
+                    dpi = density * 2.54 or None
+            elif marker == 0xE1 and segment[:6] == b'Exif\x00\x00':
+                orientation, exif_dpi = _parse_exif_header(segment[6:])
+                dpi = exif_dpi or dpi
+        else:
+            f.seek(length, os.SEEK_CUR)
+
+
+def read_image_header(source) -> ImageHeader:
+    """
+    Читает размеры, EXIF-ориентацию и разрешение изображения из заголовка файла, пиксели не декодируются.
+    Для JPEG разбирает маркеры самостоятельно, для остальных форматов использует ленивое открытие PIL.
 
+    :param source: Путь к файлу или открытый двоичный файл (например, io.BytesIO).
+    """
+    if isinstance(source, (str, Path)):
+        with open(source, 'rb') as f:
+            return read_image_header(f)
 
-def get_aspect_ratio(file_path: Path) -> float:
-    """Возвращает соотношение сторон изображения."""
-    with Image.open(file_path) as img:
+    start = source.tell()
+    try:
+        header = _read_jpeg_header(source)
+    except (IndexError, ValueError):
+        header = None
+    if header is not None:
+        return header
+
+    source.seek(start)
+    with Image.open(source) as img:
         width, height = img.size
-        aspect_ratio = width / height 
-        if aspect_ratio > 1:
-            aspect_ratio = 1 / aspect_ratio
-        # print(f"Aspect Ratio: {aspect_ratio:.2f}")
-        return aspect_ratio
+        orientation = img.getexif().get(EXIF_ORIENTATION_TAG, 1)
+        dpi = img.info.get('dpi')
+    if orientation in EXIF_TRANSPOSED_ORIENTATIONS:
+        width, height = height, width
+    return ImageHeader(width, height, orientation, float(dpi[0]) if dpi else None)
 
 
-# def estimate_blur_old_v(image_path):
-#     """
-#     Оценивает степень размытия изображения по заданному пути.
+def read_image_headers(file_paths):
+    """
+    Читает заголовки всех файлов заказа за один вызов (в потоке, чтобы не блокировать цикл событий).
+
+    :return: Список ImageHeader, для файлов, заголовок которых не читается, - None.
+    """
+    headers = []
+    for file_path in file_paths:
+        try:
+            headers.append(read_image_header(file_path))
+        except Exception as e:
+            logger.error(f"Failed to read image header of {file_path}: {e!r}")
+            headers.append(None)
+    return headers
+
 
-#     :param image_path: Путь к изображению.
-#     :return: Дисперсия Лапласиана изображения. Чем выше значение, тем более четким считается изображение.
-#     """
-#     if BLURR_THRESHOLD == 0:
-#         return 1000
-#     # Преобразование пути в объект Path
-#     path = Path(image_path)
+def max_print_dpi(width, height, print_size_mm=PRINT_SIZE_MM):
+    """
+    Возвращает разрешение (точек на дюйм), с которым фото заполнит формат печати.
+    Короткая сторона фото сопоставляется с короткой стороной формата, длинная - с длинной.
+    """
+    short_mm, long_mm = sorted(print_size_mm)
+    short_px, long_px = sorted((width, height))
+    return min(short_px / (short_mm / 25.4), long_px / (long_mm / 25.4))
 
-#     # Проверка существования файла
-#     if not path.exists():
-#         print(f"Файл не найден по пути: {path}")
-#         return 1000  # for look like ok, workaround when cann't open path in windows with cyrrillic symbols
 
-#     try:
-#         # Загружаем изображение в оттенках серого
-#         image = cv2.imread(str(path), cv2.IMREAD_GRAYSCALE)
+# Увеличивать при любом изменении analyze_photo, чтобы не использовать старые результаты из кэша.
+# Настройки, от которых зависит результат, входят в версию.
+ANALYZER_VERSION = f'5-{BLUR_MODE}-{BLUR_TARGET_SIZE}'
+DHASH_SIZE = 8  # хеш 8x8 = 64 бита
 
-#         if image is None:
-#             raise ValueError(f"Не удалось загрузить изображение по пути: {path}")
 
-#         # Применяем оператор Лапласа для вычисления градиента
-#         laplacian = cv2.Laplacian(image, cv2.CV_64F)
+def calculate_dhash(gray_image: np.ndarray) -> int:
+    """
+    Вычисляет разностный перцептивный хеш (dHash) изображения в оттенках серого.
+    Хеш не зависит от размера, сжатия и формата файла, поэтому похожие кадры отличаются на несколько бит.
+    """
+    small = cv2.resize(gray_image, (DHASH_SIZE + 1, DHASH_SIZE), interpolation=cv2.INTER_AREA)
+    bits = small[:, 1:] > small[:, :-1]
+    return int(np.packbits(bits).view('>u8')[0])
 
-#         # Вычисляем дисперсию Лапласиана, чем она больше тем больше резких деталей на изображении.
-#         variance = laplacian.var()
 
-#         return variance
-#     except Exception as e:
-#         print(f"Ошибка при обработке изображения: {path}, ошибка: {e}")
-#         return 1000  # for look like ok, workaround when cann't open path in windows with cyrrillic symbols
+# Флаги cv2.imdecode для уменьшенного декодирования (для JPEG - масштабирование прямо в DCT)
+REDUCED_GRAYSCALE_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+    (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+    (2, cv2.IMREAD_REDUCED_GRAYSCALE_2),
+)
 
 
-def estimate_blur(image_path):
+def decode_grayscale_reduced(content, width, height, target_size=BLUR_TARGET_SIZE):
     """
-    Проверяет размытие с использованием pathlib для работы с кириллическими путями.
+    Декодирует изображение в оттенках серого сразу в уменьшенном виде и приводит
+    длинную сторону к target_size. Память и время не зависят от разрешения исходного фото.
+
+    :param width: Ширина по заголовку файла.
+    :param height: Высота по заголовку файла.
     """
-    if BLURR_THRESHOLD == 0:  # workardound for turnoff
-        return 1000
-    
-    path = Path(image_path)
+    flag = cv2.IMREAD_GRAYSCALE
+    for factor, reduced_flag in REDUCED_GRAYSCALE_FLAGS:
+        if max(width, height) // factor >= target_size:
+            flag = reduced_flag
+            break
+    image = cv2.imdecode(np.frombuffer(content, dtype=np.uint8), flag)
+    if image is None:
+        return None
+    scale = target_size / max(image.shape)
+    if scale < 1:
+        size = (max(1, round(image.shape[1] * scale)), max(1, round(image.shape[0] * scale)))
+        image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+    return image
 
-    if not path.exists():
-        raise FileNotFoundError(f"Файл {path} не найден!")
 
-    try:
-        # cv2.imdecode для обработки путей с нелатинскими символами
-        image = cv2.imdecode(np.fromfile(str(path), dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+def laplacian_variance_fast(gray_image):
+    """
+    Дисперсия Лапласиана уменьшенного изображения в float32.
+    Перед Лапласианом шум отдельных пикселей убирается медианным фильтром 3x3: после уменьшения
+    до BLUR_TARGET_SIZE шум тем сильнее, чем меньше исходное фото, и без фильтра резкое фото 2 Мп
+    оценивалось в 2-3 раза выше такого же кадра 48 Мп. Границы объектов медианный фильтр не размывает.
+    """
+    denoised = cv2.medianBlur(gray_image, 3)
+    return float(cv2.Laplacian(denoised.astype(np.float32), cv2.CV_32F).var())
 
-        if image is None:
-            raise ValueError(f"Не удалось загрузить изображение: {path}")
 
-        laplacian = cv2.Laplacian(image, cv2.CV_64F)
-    except Exception as e:
-        print(f'Error while calculating blur: {e}')
-        return 1000  # workardound for turnoff
-    return laplacian.var()
-        
-        
-def generate_unique_filename(original_filename):
-    timestamp = int(time() * 1000)  # Метка времени в миллисекундах
-    return f"{timestamp}_{original_filename}"
+def analyze_photo(file_path, md5=None) -> PhotoAnalysis:
+    """
+    Проверяет фотографию за одно чтение файла: MD5 считается во время чтения,
+    размеры и EXIF-ориентация берутся из заголовка, для оценки размытия и перцептивного хеша
+    изображение декодируется один раз (в режиме BLUR_MODE = 'fast' - сразу в уменьшенном виде).
 
+    :param file_path: Путь к файлу.
+    :param md5: MD5 файла, если он уже посчитан при скачивании.
+    :return: PhotoAnalysis с размером, соотношением сторон, размытием, MD5 и dHash.
+        Если изображение не декодировалось, в error записана причина, а размытие и dHash не проверены
+        (если не читается и заголовок, размеры 0x0).
+    """
+    file_path = Path(file_path)
+    timings = {}
 
-def get_original_filename(unique_filename):
-    unique_filename_str = str(unique_filename)
-    # Разделяем по первому символу "_" и возвращаем оригинальное имя файла
-    return unique_filename_str.split("_", 1)[1]
+    started = perf_counter()
+    hash_md5 = hashlib.md5() if md5 is None else None
+    hash_seconds = 0.0
+    content = bytearray()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            if hash_md5 is not None:
+                hash_started = perf_counter()
+                hash_md5.update(chunk)
+                hash_seconds += perf_counter() - hash_started
+            content += chunk
+    if hash_md5 is not None:
+        md5 = hash_md5.hexdigest()
+        timings['hash'] = hash_seconds
+    timings['read'] = perf_counter() - started - hash_seconds
+
+    width, height, aspect_ratio = 0, 0, 0.0
+    blur = 1000  # workardound for turnoff
+    dhash = None
+    error = None
+    try:
+        # Размеры и ориентация из заголовка, пиксели не декодируются
+        started = perf_counter()
+        header = read_image_header(io.BytesIO(content))
+        width, height = header.width, header.height
+        aspect_ratio = header.aspect_ratio
+        timings['aspect'] = perf_counter() - started
+
+        # cv2.imdecode учитывает EXIF-ориентацию, поэтому повёрнутые копии дают тот же dHash
+        started = perf_counter()
+        if BLUR_MODE == 'fast':
+            image = decode_grayscale_reduced(content, width, height)
+        else:
+            image = cv2.imdecode(np.frombuffer(content, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+        if image is None:
+            raise ValueError(f"Не удалось загрузить изображение: {file_path}")
+        timings['decode'] = perf_counter() - started
+        started = perf_counter()
+        dhash = calculate_dhash(image)
+        timings['dhash'] = perf_counter() - started
+        if BLURR_THRESHOLD != 0:
+            started = perf_counter()
+            if BLUR_MODE == 'fast':
+                blur = laplacian_variance_fast(image)
+            else:
+                blur = float(cv2.Laplacian(image, cv2.CV_64F).var())
+            timings['blur'] = perf_counter() - started
+    except Exception as e:
+        logger.error(f'Failed to analyze {file_path}: {e!r}')
+        error = str(e) or type(e).__name__
+
+    return PhotoAnalysis(file_path, width, height, aspect_ratio, blur, md5, dhash, timings, error)
 
 
-def get_number_photo_files(directory_path: str) -> int:
+class HashingFileWriter:
+    """
+    Обёртка над открытым на запись файлом: по ходу записи считает MD5
+    и запоминает начало файла для определения формата по сигнатуре.
+    Время подсчёта MD5 копится в hash_seconds (для метрики этапа hash).
     """
-    Подсчитывает количество файлов с расширением .jpg в указанном каталоге.
 
-    :param directory_path: Путь к каталогу.
-    :return: Количество файлов с расширением .jpg.
+    def __init__(self, file, header_size=32):
+        self.file = file
+        self.header_size = header_size
+        self.header = b''
+        self.size = 0
+        self.hash_seconds = 0.0
+        self._md5 = hashlib.md5()
+
+    def write(self, chunk):
+        if len(self.header) < self.header_size:
+            self.header += chunk[:self.header_size - len(self.header)]
+        started = perf_counter()
+        self._md5.update(chunk)
+        self.hash_seconds += perf_counter() - started
+        self.size += len(chunk)
+        return self.file.write(chunk)
+
+    def flush(self):
+        self.file.flush()
+
+    def seek(self, *args):
+        return self.file.seek(*args)
+
+    def hexdigest(self):
+        return self._md5.hexdigest()
+
+
+# Расширение по сигнатуре файла -> допустимые расширения для этого формата
+IMAGE_SUFFIX_ALIASES = {
+    '.jpg': ('.jpg', '.jpeg', '.jpe', '.jfif'),
+    '.png': ('.png',),
+    '.webp': ('.webp',),
+    '.tif': ('.tif', '.tiff'),
+    '.heic': ('.heic', '.heif'),
+}
+HEIF_BRANDS = (b'heic', b'heix', b'hevc', b'hevx', b'heim', b'heis', b'mif1', b'msf1')
+
+
+def sniff_image_suffix(header: bytes):
+    """Определяет формат изображения по первым байтам файла. Возвращает расширение или None."""
+    if header.startswith(b'\xff\xd8\xff'):
+        return '.jpg'
+    if header.startswith(b'\x89PNG\r\n\x1a\n'):
+        return '.png'
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return '.webp'
+    if header[:4] in (b'II*\x00', b'MM\x00*'):
+        return '.tif'
+    if header[4:8] == b'ftyp' and header[8:12] in HEIF_BRANDS:
+        return '.heic'
+    return None
+
+
+def fix_image_suffix(file_path: Path, header: bytes) -> Path:
     """
-    # Создаем объект Path из строки пути
-    path = Path(directory_path)
-    
-    # Проверяем, существует ли каталог и является ли он каталогом
-    if not path.exists() or not path.is_dir():
-        raise ValueError(f"Путь {directory_path} не существует или не является каталогом.")
-        return None
-    
-    # Ищем все файлы с расширением .jpg в каталоге
-    jpg_files = list(path.glob(f"*.{IMG_WORK_FORMAT}"))
-    
-    # Возвращаем количество найденных файлов
-    return len(jpg_files)
+    Возвращает путь с расширением, соответствующим содержимому файла
+    (например, HEIC, присланный с именем .jpg). Если формат не определён, путь не меняется.
+    """
+    sniffed = sniff_image_suffix(header)
+    if sniffed and file_path.suffix.lower() not in IMAGE_SUFFIX_ALIASES[sniffed]:
+        return file_path.with_suffix(sniffed)
+    return file_path
 
 
-def calculate_md5(file_path):
-    """Вычисляет MD5 хеш для файла по указанному пути."""
-    hash_md5 = hashlib.md5()
-    with open(file_path, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
-
-
-def find_matching_files_by_md5(directory, target_file=None):
-    """
-    Ищет файлы с расширением .jpg в указанном каталоге и возвращает список попарных совпадений по MD5.
-    Если указан target_file, возвращает только совпадения с этим файлом.
-    """
-    # Преобразуем directory и target_file в объекты Path
-    directory = Path(directory)
-    target_file = Path(target_file) if target_file else None
-    
-    # Словарь для хранения списка файлов по их MD5-хешу
-    md5_dict = defaultdict(list)
-    matching_pairs = []
-
-    # Проходим по всем файлам в каталоге и его подкаталогах
-    for file_path in directory.rglob(f"*.{IMG_WORK_FORMAT}"):
-        file_md5 = calculate_md5(file_path)
-        md5_dict[file_md5].append(file_path)
-
-    # Если указан целевой файл, проверяем его MD5 и ищем совпадения
-    if target_file and target_file.exists():
-        target_md5 = calculate_md5(target_file)
-        if target_md5 in md5_dict:
-            matching_pairs = [(target_file, file) for file in md5_dict[target_md5] if file != target_file]
-        return matching_pairs
-
-    # Ищем все совпадения по MD5
-    for file_list in md5_dict.values():
-        if len(file_list) > 1:
-            matching_pairs.extend([(file_list[i], file_list[j]) for i in range(len(file_list)) for j in range(i + 1, len(file_list))])
-
-    return matching_pairs
+_last_timestamp = 0
+
+
+def generate_unique_filename(original_filename):
+    global _last_timestamp
+    # Метка времени в миллисекундах, строго возрастающая: фото альбома получают разные имена в порядке альбома
+    timestamp = max(int(time() * 1000), _last_timestamp + 1)
+    _last_timestamp = timestamp
+    return f"{timestamp}_{original_filename}"
+
+
+def get_original_filename(unique_filename):
+    unique_filename_str = str(unique_filename)
+    # Разделяем по первому символу "_" и возвращаем оригинальное имя файла
+    return unique_filename_str.split("_", 1)[1]
 
 
 async def send_email_async(subject: str, body: str, to_email: str, use_tls=SMTP_USE_TLS):
@@ -1,21 +1,36 @@
 # ideaprint_bot.py
 import asyncio
-import aiohttp
 import logging
+import os
 import shutil
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command
 from aiogram.client.default import DefaultBotProperties
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, InputFile, FSInputFile
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, InputFile, FSInputFile, \
+    InputMediaPhoto
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 from dotenv import dotenv_values
 from pathlib import Path
-import json
-from time import time
-from helpers import get_aspect_ratio, convert_to_jpeg, estimate_blur, find_matching_files_by_md5, \
-    generate_unique_filename, get_original_filename, get_number_photo_files, send_email_async
+from time import time, perf_counter
+from helpers import analyze_photo, convert_to_jpeg, HashingFileWriter, fix_image_suffix, \
+    read_image_headers, max_print_dpi, make_preview, get_preview_path, \
+    generate_unique_filename, get_original_filename, send_email_async
+from analysis_service import analysis_service
+from analysis_cache import analysis_cache
+from api_client import api_client
+from media_groups import media_group_collector
+from file_id_cache import file_id_cache
+from collage import build_contact_sheet_page, contact_sheet_page_count
+from fsm_storage import SQLiteStorage
+from metrics import STAGE_SECONDS, ORDERS_TOTAL, UPLOADS_IN_FLIGHT, BotApiMetricsMiddleware, start_metrics_server
+from tracing import traced, TracingMiddleware, TracingRequestMiddleware
+from order_index import get_order_index, drop_order_index, flush_order_indexes
+from order_manifest import get_order_manifest, drop_order_manifest, flush_order_manifests
 from config import *
 
 # Настройка логирования
@@ -26,8 +41,11 @@ logging.basicConfig(
 logger = logging.getLogger("main")
  
 bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode='HTML'))
-storage = MemoryStorage()
+bot.session.middleware(BotApiMetricsMiddleware())
+bot.session.middleware(TracingRequestMiddleware())
+storage = SQLiteStorage(FSM_STORAGE_PATH) if FSM_STORAGE_PATH else MemoryStorage()
 dp = Dispatcher(storage=storage)
+dp.update.outer_middleware(TracingMiddleware())
 
 # Состояния
 class OrderStates(StatesGroup):
@@ -73,50 +91,15 @@ async def new_order(callback_query: types.CallbackQuery, state: FSMContext):
     await cmd_start(callback_query.message, state)
 
 
+@traced()
 async def fetch_order_data_via_API(order_number: str) -> tuple:
     """
     Функция для получения данных о заказе от 1С.
     :param order_number: Номер заказа.
     :return: Кортеж (number_of_photos, order_folder) или (None, None), если произошла ошибка.
     """
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.get(f"{API_URL}{order_number}") as response:
-                # Логируем HTTP-статус
-                logger.info(f"API 1c responded with status: {response.status}")
-
-                if response.status != 200:
-                    logger.error(f"Unexpected status code: {response.status}")
-                    return None, None
-
-                # Обрабатываем ответ, независимо от Content-Type
-                try:
-                    content_type = response.headers.get("Content-Type", "")
-                    if "application/json" in content_type:
-                        data = await response.json()
-                    else:
-                        # Если Content-Type не JSON, пробуем декодировать текст вручную
-                        text = await response.text()
-                        data = json.loads(text)
-
-                    logger.info(f"API 1c returned data: {data}")
-
-                    # Проверяем успешность ответа
-                    if data.get("result"):
-                        number_of_photos = data.get("quantity")
-                        order_folder = Path(data.get("path"))
-                        return number_of_photos, order_folder
-                    else:
-                        logger.warning(f"API 1c error info: {data.get('info', 'No info provided')}")
-                        return None, None
-
-                except json.JSONDecodeError as e:
-                    logger.error(f"Failed to decode JSON: {e}")
-                    return None, None
-
-        except aiohttp.ClientError as e:
-            logger.error(f"HTTP request to API failed: {e}")
-            return None, None
+    with STAGE_SECONDS.time(stage='1c_lookup'):
+        return await api_client.fetch_order(order_number)
         
         
 # Хэндлер для номера заказа
@@ -146,12 +129,15 @@ async def process_order_number(message: types.Message, state: FSMContext):
         return
     
     order_folder.mkdir(parents=True, exist_ok=True)
+    # сверяем манифест и индекс хешей с папкой, если файлы меняли вне бота
+    manifest = await load_order_files(order_folder)
     
-    uploaded_photos = get_number_photo_files(order_folder)  # на случай если заказ уже существует и было с ним взаимодействие.
+    uploaded_photos = manifest.count  # на случай если заказ уже существует и было с ним взаимодействие.
     
     # Сохраняем данные заказа в состоянии
     await state.update_data(order_number=order_number, order_folder=order_folder, 
                             number_of_photos=number_of_photos, uploaded_photos=uploaded_photos)
+    ORDERS_TOTAL.inc(event='started')
     logger.info(f"Folder created: {order_folder}, for order {order_number} with {number_of_photos} number of photos.")
     
 
@@ -191,26 +177,263 @@ def generate_keyboard_cancel_order(order_number):
     return keyboard_cancel_order
 
 
+# Ограничение числа одновременных скачиваний для всех пользователей
+download_semaphore = asyncio.Semaphore(DOWNLOAD_CONCURRENCY)
+
+
 # Функция для загрузки и сохранения файла
+@traced()
 async def download_and_save_file(file_id, file_path):
-    file_info = await bot.get_file(file_id)
-    await bot.download_file(file_info.file_path, file_path)
+    """
+    Скачивает файл потоком во временный файл .part (его не видят подсчёты фото заказа),
+    по ходу считает MD5, затем атомарно переименовывает в file_path.
+    Если содержимое не соответствует расширению (например, HEIC с именем .jpg), расширение исправляется.
 
+    :return: Кортеж (путь к сохранённому файлу, MD5).
+    """
+    async with download_semaphore:
+        file_info = await bot.get_file(file_id)
+        tmp_path = file_path.with_name(f'{file_path.name}.part')
+        try:
+            with open(tmp_path, 'wb') as f:
+                writer = HashingFileWriter(f)
+                started = perf_counter()
+                await bot.download_file(file_info.file_path, writer, timeout=DOWNLOAD_TIMEOUT, seek=False)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+    # MD5 считается по ходу скачивания, его время - отдельный этап hash
+    STAGE_SECONDS.observe(perf_counter() - started - writer.hash_seconds, stage='download')
+    STAGE_SECONDS.observe(writer.hash_seconds, stage='hash')
+
+    file_path = fix_image_suffix(file_path, writer.header)
+    os.replace(tmp_path, file_path)
+    return file_path, writer.hexdigest()
+
+
+# Функция для скачивания, конвертации и проверки фотографии без сообщений пользователю
+@traced()
+async def ingest_photo(file_id, file_path, order_folder):
+    """
+    Скачивает фото в file_path, конвертирует при необходимости, проверяет
+    и добавляет в манифест и индекс заказа.
 
-# Функция для обработки фотографии
-async def process_image(img_path, order_folder, order_number, number_of_photos, message):
-    uploaded_photos = get_number_photo_files(order_folder)
-    # logger.info(f"Photo saved for user {message.from_user.id} at {img_path}. {uploaded_photos} of {number_of_photos} uploaded.")
-    
-    await check_aspect_ratio(img_path, message)
-    await check_blur(img_path, message)
-    return uploaded_photos
+    :return: PhotoAnalysis или None, если файла нет после конвертации.
+    """
+    with UPLOADS_IN_FLIGHT.track_in_progress():
+        filename_with_unique = file_path.name
+        logger.info(f'Start downloading {filename_with_unique}...')
+        file_path, md5 = await download_and_save_file(file_id, file_path)
+        logger.info(f'Downloaded {filename_with_unique}')
+
+        # Конвертируем, если это необходимо (время этапа вместе с ожиданием места в пуле)
+        with STAGE_SECONDS.time(stage='conversion'):
+            img_path, reencoded = await analysis_service.run(convert_to_jpeg, file_path)
+        if not img_path.exists():
+            logger.error(f"File {img_path} doesn't exist after image conversion.")
+            return None
+
+        # MD5 из скачивания подходит, только если файл не перекодировался (JPEG только переименовывается).
+        # Решает convert_to_jpeg по самому файлу: расширение могло не совпадать с форматом
+        analysis = await analysis_service.run(analyze_photo, img_path, None if reencoded else md5)
+        for stage, seconds in (analysis.timings or {}).items():
+            STAGE_SECONDS.observe(seconds, stage=stage)
+        analysis_cache.put(analysis)
+        register_photo(order_folder, analysis)
+        # Превью создаётся в фоне: ответ на загрузку его не ждёт, его дождётся отправка превью
+        start_preview(img_path)
+        return analysis
+
+
+# Превью, которые сейчас создаются в пуле: путь к превью -> задача
+preview_tasks = {}
+
+
+async def _make_preview(photo_path, preview_path):
+    try:
+        return await analysis_service.run(make_preview, photo_path, preview_path)
+    except Exception as e:
+        logger.error(f"Failed to make preview for {photo_path}: {e!r}")
+        return photo_path
+
+
+def start_preview(photo_path):
+    """
+    Запускает создание превью фото в пуле в фоновой задаче, если превью ещё нет.
+
+    :return: Задача создания превью или None, если превью уже есть.
+    """
+    preview_path = get_preview_path(photo_path)
+    key = str(preview_path)
+    task = preview_tasks.get(key)
+    if task is None and not preview_path.exists():
+        task = preview_tasks[key] = asyncio.create_task(_make_preview(photo_path, preview_path))
+        task.add_done_callback(lambda _: preview_tasks.pop(key, None))
+    return task
+
+
+async def get_preview(photo_path):
+    """
+    Возвращает путь к маленькому превью фото для отправки в Telegram.
+    Если превью ещё создаётся в фоне - дожидается его, если его нет - создаёт в пуле.
+    Если превью создать не удалось, возвращает само фото.
+    """
+    task = start_preview(photo_path)
+    if task is None:
+        return get_preview_path(photo_path)
+    # shield: отмена одного ожидающего не отменяет создание превью для остальных
+    return await asyncio.shield(task)
+
+
+async def send_photo_preview(message: types.Message, order_folder, photo_path, md5, caption, reply_markup=None):
+    """
+    Отправляет превью фотографии. Если превью уже отправлялось, оно отправляется по file_id без загрузки.
+    """
+    file_id = file_id_cache.get(order_folder, md5)
+    if file_id is not None:
+        try:
+            return await message.answer_photo(file_id, caption=caption[:MAX_CAPTION_LENGTH], reply_markup=reply_markup)
+        except TelegramBadRequest as e:
+            # file_id мог устареть, загружаем превью заново
+            logger.warning(f"Cached file_id for {photo_path} rejected: {e}")
+            file_id_cache.invalidate(order_folder, md5)
+
+    # Отправляем маленькое превью, а не исходный файл
+    photo_file = FSInputFile(str(await get_preview(photo_path)))
+    sent = await message.answer_photo(photo_file, caption=caption[:MAX_CAPTION_LENGTH], reply_markup=reply_markup)
+    file_id_cache.put(order_folder, md5, sent.photo[-1].file_id)
+    return sent
+
+
+async def send_photo_previews_group(message: types.Message, order_folder, photo_paths, analyses, captions):
+    """
+    Отправляет превью нескольких фотографий (от 2 до 10) одним альбомом с подписью у каждого фото.
+    Уже отправлявшиеся превью отправляются по file_id без загрузки.
+    """
+    media = []
+    for photo_path, analysis, caption in zip(photo_paths, analyses, captions):
+        file_id = file_id_cache.get(order_folder, analysis.md5)
+        photo = file_id if file_id is not None else FSInputFile(str(await get_preview(photo_path)))
+        media.append(InputMediaPhoto(media=photo, caption=caption[:MAX_CAPTION_LENGTH]))
+    try:
+        sent = await message.answer_media_group(media)
+    except TelegramBadRequest as e:
+        if all(isinstance(item.media, FSInputFile) for item in media):
+            raise
+        # Какой-то file_id устарел, загружаем все превью альбома заново
+        logger.warning(f"Cached file_ids for order {order_folder} rejected: {e}")
+        for analysis in analyses:
+            file_id_cache.invalidate(order_folder, analysis.md5)
+        media = [
+            InputMediaPhoto(media=FSInputFile(str(await get_preview(photo_path))), caption=item.caption)
+            for photo_path, item in zip(photo_paths, media)
+        ]
+        sent = await message.answer_media_group(media)
+
+    for analysis, sent_message in zip(analyses, sent):
+        file_id_cache.put(order_folder, analysis.md5, sent_message.photo[-1].file_id)
+    return sent
+
+
+async def get_contact_sheet_page(order_folder, page: int):
+    """Собирает в пуле страницу коллажа-обзора заказа (или берёт готовую из кэша страниц)."""
+    photo_paths = get_order_manifest(order_folder).paths()
+    return await analysis_service.run(build_contact_sheet_page, order_folder, photo_paths, page)
+
+
+async def send_contact_sheet(chat_id, order_folder, caption: str):
+    """
+    Отправляет в чат все страницы коллажа-обзора заказа (альбомами по 10), подпись - у первой страницы.
+    Если коллаж собрать не удалось, отправляет только текст.
+    """
+    total_pages = contact_sheet_page_count(get_order_manifest(order_folder).count)
+    try:
+        pages = await asyncio.gather(*(get_contact_sheet_page(order_folder, page) for page in range(1, total_pages + 1)))
+    except Exception as e:
+        logger.error(f"Failed to build contact sheet for {order_folder}: {e!r}")
+        pages = []
+    if not pages:
+        return await bot.send_message(chat_id, caption)
+    if len(pages) == 1:
+        return await bot.send_photo(chat_id, FSInputFile(str(pages[0])), caption=caption[:MAX_CAPTION_LENGTH])
+
+    for i in range(0, len(pages), 10):
+        media = [
+            InputMediaPhoto(media=FSInputFile(str(page_path)),
+                            caption=caption[:MAX_CAPTION_LENGTH] if i + j == 0 else None)
+            for j, page_path in enumerate(pages[i:i + 10])
+        ]
+        if len(media) == 1:
+            await bot.send_photo(chat_id, media[0].media)
+        else:
+            await bot.send_media_group(chat_id, media)
+
+
+def register_photo(order_folder, analysis):
+    """Добавляет сохранённую фотографию в манифест и индекс хешей заказа."""
+    get_order_manifest(order_folder).add(analysis.path)
+    get_order_index(order_folder).add(analysis.path, analysis.md5, analysis.dhash)
+
+
+def unregister_photo(order_folder, photo_path):
+    """Убирает удалённую фотографию из манифеста и индекса хешей заказа, удаляет её превью и file_id."""
+    index = get_order_index(order_folder)
+    md5 = index.md5_of(photo_path)
+    if md5 is not None:
+        file_id_cache.invalidate(order_folder, md5)
+    get_order_manifest(order_folder).remove(photo_path)
+    index.remove(photo_path)
+    preview_path = get_preview_path(photo_path)
+    preview_path.unlink(missing_ok=True)
+    task = preview_tasks.get(str(preview_path))
+    if task is not None:
+        # Превью ещё создаётся: удаляем его, когда оно будет готово
+        task.add_done_callback(lambda _: preview_path.unlink(missing_ok=True))
+
+
+async def load_order_files(order_folder):
+    """
+    Сверяет манифест и индекс хешей заказа с папкой, досчитывая в пуле хеши файлов,
+    которые появились или изменились вне бота.
+
+    :return: Манифест заказа.
+    """
+    manifest = get_order_manifest(order_folder)
+    manifest.scan()
+    index = get_order_index(order_folder)
+    stale = index.scan()
+    if stale:
+        logger.info(f'Order index {order_folder}: hashing {len(stale)} new or changed files...')
+        analyses = await asyncio.gather(*(analysis_service.run(analyze_photo, path) for path in stale))
+        for path, analysis in zip(stale, analyses):
+            analysis_cache.put(analysis)
+            index.add(path, analysis.md5, analysis.dhash, save=False)
+        index.save_later()
+    return manifest
+
+
+async def get_photo_analysis(order_folder, photo_path):
+    """
+    Возвращает результат проверки уже сохранённой фотографии.
+    Если MD5 файла есть в индексе заказа и результат есть в кэше, файл не читается.
+    """
+    md5 = get_order_index(order_folder).md5_of(photo_path, check_stat=True)
+    if md5:
+        analysis = analysis_cache.get(md5, photo_path)
+        if analysis is not None:
+            return analysis
+    analysis = await analysis_service.run(analyze_photo, photo_path)
+    analysis_cache.put(analysis)
+    return analysis
 
 
 # Функция для проверки и отправки сообщений о совпадениях по MD5
-async def check_md5_matches(img_path, order_folder, message):
+@traced()
+async def check_md5_matches(analysis, order_folder, message):
+    img_path = analysis.path
     logger.info(f'MD5 matches start {img_path}...')
-    matches = find_matching_files_by_md5(order_folder, img_path)
+    with STAGE_SECONDS.time(stage='duplicate_search'):
+        matches = get_order_index(order_folder).find(analysis.md5, exclude=img_path)
     logger.info(f'MD5 matches end {img_path}...')
     if matches:
         await message.answer(
@@ -223,10 +446,27 @@ async def check_md5_matches(img_path, order_folder, message):
             await message.answer(f'Совпадение с: {match_name}', reply_markup=generate_keyboard_cancel_last_img())
 
 
+# Функция для проверки и отправки сообщений о похожих фото (перцептивный хеш)
+@traced()
+async def check_similar_photos(analysis, order_folder, message):
+    if PHASH_DISTANCE_THRESHOLD < 0:
+        return
+    with STAGE_SECONDS.time(stage='duplicate_search'):
+        similar = get_order_index(order_folder).find_similar(analysis.dhash, PHASH_DISTANCE_THRESHOLD, exclude=analysis.path)
+    for similar_path, distance in similar:
+        logger.info(f'Similar photos {analysis.path.name} and {similar_path.name}, distance {distance}')
+        await message.answer(
+            f'Загруженное фото очень похоже на ранее загруженное: {similar_path.name}',
+            reply_markup=generate_keyboard_cancel_last_img()
+        )
+
+
 # Функция для проверки aspect ratio и отправки сообщения
-async def check_aspect_ratio(img_path, message):
-    aspect_ratio = get_aspect_ratio(img_path)
-    if not MAX_ASPECT_RATIO > aspect_ratio > MIN_ASPECT_RATIO:
+@traced()
+async def check_aspect_ratio(analysis, message):
+    if not analysis.width:
+        return  # размер неизвестен: файл не читается, об этом сообщает check_blur
+    if not MAX_ASPECT_RATIO > analysis.aspect_ratio > MIN_ASPECT_RATIO:
         await message.answer(
             'Фотография узкая. Мы можем ее напечатать, но при размещении на карточке '
             'будет широкое белое поле. Рекомендуем откадрировать и загрузить снова.',
@@ -234,10 +474,33 @@ async def check_aspect_ratio(img_path, message):
         )
 
 
+# Функция для проверки, хватает ли пикселей для формата печати, и отправки сообщения
+@traced()
+async def check_print_resolution(geometry, message):
+    """
+    :param geometry: Любой объект с width и height (PhotoAnalysis или ImageHeader).
+    """
+    if MIN_PRINT_DPI <= 0 or not geometry.width:
+        return
+    print_dpi = max_print_dpi(geometry.width, geometry.height)
+    if print_dpi < MIN_PRINT_DPI:
+        await message.answer(
+            f'Разрешение фотографии {geometry.width}x{geometry.height} мало для печати, '
+            f'изображение будет нечётким (~{print_dpi:.0f} dpi). Рекомендуем загрузить оригинал файлом.',
+            reply_markup=generate_keyboard_cancel_last_img()
+        )
+
+
 # Функция для проверки размытия и отправки сообщения
-async def check_blur(img_path, message):
-    blur = estimate_blur(img_path)
-    if blur < BLURR_THRESHOLD:
+@traced()
+async def check_blur(analysis, message):
+    if analysis.error:
+        await message.answer(
+            'Не удалось проверить фотографию: файл не читается как изображение. '
+            'Проверьте фото и при необходимости загрузите снова.',
+            reply_markup=generate_keyboard_cancel_last_img()
+        )
+    elif analysis.blur < BLUR_THRESHOLD_ACTIVE:
         await message.answer(
             'Обратите внимание, фотография расфокусированная. Печатать можно, но рекомендуем заменить.',
             reply_markup=generate_keyboard_cancel_last_img()
@@ -247,10 +510,19 @@ async def check_blur(img_path, message):
 # Хэндлер для получения фотографий как документ  OrderStates.waiting_for_photos
 @dp.message(F.content_type.in_({"document"}), OrderStates.waiting_for_photos)
 async def process_photo_document(message: types.Message, state: FSMContext):
+    if message.media_group_id:
+        album = await media_group_collector.collect(message)
+        if album is None:  # альбом обработает хэндлер первого сообщения
+            return
+        files = [(album_message.document.file_id, album_message.document.file_name) for album_message in album]
+        work = process_album(message, state, files)
+    else:
+        work = process_photo(message, state, is_document=True)
+
     processing_message = await message.answer("Идет обработка...")
     
     # Создаем задачу для process_photo
-    task = asyncio.create_task(process_photo(message, state, is_document=True))
+    task = asyncio.create_task(work)
     
     try:
         # Ожидаем завершения задачи
@@ -269,13 +541,23 @@ async def process_photo_document(message: types.Message, state: FSMContext):
 # Хэндлер для получения фотографий как изображения, но не как файл
 @dp.message(F.content_type.in_({"photo"}), OrderStates.waiting_for_photos)
 async def handle_photo_as_image(message: types.Message, state: FSMContext):
+    album = None
+    if message.media_group_id:
+        album = await media_group_collector.collect(message)
+        if album is None:  # альбом обработает хэндлер первого сообщения
+            return
+
     data = await state.get_data()
     order_number = data['order_number']
     ignore_warning = data.get('ignore_quality_warning', False)
     
     # Сохраняем данные фото в состояние, чтобы использовать позже при обработке callback
     # await state.update_data(last_photo=message.photo[-1].file_id)
-    await state.update_data(last_photo_id=message.photo[-1].file_id)
+    if album:
+        await state.update_data(last_photo_id=None,
+                                last_album_ids=[album_message.photo[-1].file_id for album_message in album])
+    else:
+        await state.update_data(last_photo_id=message.photo[-1].file_id, last_album_ids=None)
 
 
     # Проверяем, показывать ли предупреждение о качестве
@@ -300,6 +582,8 @@ async def handle_photo_as_image(message: types.Message, state: FSMContext):
             "Вы отправили фото не файлом, а изображением. Качество будет хуже.\nВыберите действие:",
             reply_markup=keyboard
         )
+    elif album:
+        await process_album(message, state, [(album_message.photo[-1].file_id, "photo.jpg") for album_message in album])
     else:
         await process_photo(message, state, is_document=False)
 
@@ -322,7 +606,7 @@ async def cancel_photo_as_photo(callback: types.CallbackQuery, state: FSMContext
     # order_number = callback.data.split(":")[1]
     order_folder = data['order_folder']
     photos_in_order = data['number_of_photos']
-    uploaded_photos  = get_number_photo_files(order_folder)
+    uploaded_photos  = get_order_manifest(order_folder).count
     
     await callback.answer("Фото отменено.")
     edit_keyboard = generate_edit_photo_keyboard(order_number)
@@ -330,6 +614,20 @@ async def cancel_photo_as_photo(callback: types.CallbackQuery, state: FSMContext
                            f"Загружено {uploaded_photos} фото из {photos_in_order}.\nЖду ещё", reply_markup=edit_keyboard)
 
 
+# Загрузка фото, сохранённых в состоянии до ответа на предупреждение о качестве
+async def process_saved_photos(message: types.Message, state: FSMContext):
+    data = await state.get_data()
+    album_ids = data.get('last_album_ids')
+    photo_file_id = data.get('last_photo_id')
+    await state.update_data(last_photo_id=None, last_album_ids=None)
+
+    if album_ids:
+        await process_album(message, state, [(file_id, "photo.jpg") for file_id in album_ids])
+    elif photo_file_id:
+        # Если photo_file_id есть, передаем его для обработки
+        await process_photo(message, state, is_document=False, photo_file_id=photo_file_id)
+
+
 # Обработчик кнопки "Больше не спрашивать"
 @dp.callback_query(F.data.startswith("ignore_warning"))
 async def ignore_warning(callback: types.CallbackQuery, state: FSMContext):
@@ -337,11 +635,7 @@ async def ignore_warning(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer("Больше не буду предупреждать.")
 
     # Получаем file_id фото из состояния
-    data = await state.get_data()
-    photo_file_id = data.get('last_photo_id')
-    
-    if photo_file_id:
-        await process_photo(callback.message, state, is_document=False, photo_file_id=photo_file_id)
+    await process_saved_photos(callback.message, state)
    
    
 # Обработчик кнопки "Продолжить"
@@ -349,23 +643,8 @@ async def ignore_warning(callback: types.CallbackQuery, state: FSMContext):
 async def continue_upload(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer("Продолжаю загрузку.")
 
-    await bot.send_message(
-        callback.message.chat.id, 
-        '<i>Если в одном сообщении было отправлено несколько фото, загружено только последнее.\nДля загрузки сразу нескольких нажмите "Больше не спрашивать" и повторите отправку.</i>'
-        )
-    
-    # Проверим, есть ли фото в callback.message
-    if callback.message.photo:
-        for photo in callback.message.photo:
-            await process_photo(callback.message, state, is_document=False, photo_file_id=photo.file_id)
-    else:
-        # Если фото нет, нужно взять его из состояния (если оно было сохранено ранее)
-        data = await state.get_data()
-        photo_file_id = data.get('last_photo_id')
-        
-        if photo_file_id:
-            # Если photo_file_id есть, передаем его для обработки
-            await process_photo(callback.message, state, is_document=False, photo_file_id=photo_file_id)
+    # Фото (или весь альбом) берём из состояния, они были сохранены при получении
+    await process_saved_photos(callback.message, state)
            
                 
 # Общая функция для обработки фотографии, учитывая её тип
@@ -373,8 +652,6 @@ async def process_photo(message: types.Message, state: FSMContext, is_document:
     # Получаем данные о состоянии
     data = await state.get_data()
     order_folder = Path(data['order_folder'])
-    number_of_photos = data['number_of_photos']
-    order_number = data['order_number']
 
     # Получаем файл в зависимости от типа сообщения или переданного file_id
     if is_document:
@@ -402,49 +679,127 @@ async def process_photo(message: types.Message, state: FSMContext, is_document:
     file_path = order_folder / filename_with_unique
     logger.info(f'Unique name {filename_with_unique=}')
 
-    # Скачиваем и сохраняем файл
-
-    logger.info(f'Start downloading {filename_with_unique}...')
-    await download_and_save_file(file_id, file_path)
-    logger.info(f'Downloaded {filename_with_unique}')
-
-    # Конвертируем, если это необходимо
-    # logger.info(f'Converting {filename_with_unique}')
-    img_path = convert_to_jpeg(file_path)
-    if not img_path.exists():
-        logger.error(f"File {img_path} doesn't exist after image conversion.")
+    # Скачиваем, конвертируем и проверяем фотографию
+    analysis = await ingest_photo(file_id, file_path, order_folder)
+    if analysis is None:
         return
 
-    # Обрабатываем фотографию
-    # logger.info(f'process_image {filename_with_unique}...')
-    uploaded_photos = await process_image(img_path, order_folder, order_number, number_of_photos, message)
+    await check_aspect_ratio(analysis, message)
+    await check_print_resolution(analysis, message)
+    await check_blur(analysis, message)
 
     # Проверяем совпадения по MD5
     # logger.info(f'md5 matches {filename_with_unique}...')
-    await check_md5_matches(img_path, order_folder, message)
+    await check_md5_matches(analysis, order_folder, message)
+    await check_similar_photos(analysis, order_folder, message)
+
+    await send_upload_status(message, state)
+
+
+# Обработка альбома целиком: файлы скачиваются и проверяются параллельно, ответ - одно сообщение
+async def process_album(message: types.Message, state: FSMContext, files):
+    """
+    :param files: Список (file_id, исходное имя файла) в порядке альбома.
+    """
+    data = await state.get_data()
+    order_folder = Path(data['order_folder'])
+
+    # Имена генерируем заранее, чтобы порядок фото в заказе совпадал с порядком в альбоме
+    file_paths = [order_folder / generate_unique_filename(original_filename) for _, original_filename in files]
+    logger.info(f'Album of {len(files)} files for order {data["order_number"]}')
+
+    results = await asyncio.gather(
+        *(ingest_photo(file_id, file_path, order_folder) for (file_id, _), file_path in zip(files, file_paths)),
+        return_exceptions=True
+    )
+
+    lines = []
+    manifest = get_order_manifest(order_folder)
+    for (_, original_filename), result in zip(files, results):
+        if isinstance(result, Exception):
+            logger.error(f'Album file {original_filename} failed: {result!r}')
+            lines.append(f'{original_filename}: ошибка при обработке')
+            continue
+        if result is None:
+            lines.append(f'{original_filename}: не удалось сохранить')
+            continue
+        problems = describe_photo_problems(result, order_folder)
+        if problems:
+            lines.append(f'Фото {manifest.index_of(result.path)} ({original_filename}): ' + ', '.join(problems))
+
+    saved = sum(1 for result in results if result is not None and not isinstance(result, Exception))
+    summary = f'Получил альбом: сохранено {saved} фото из {len(files)}.'
+    if lines:
+        summary += '\n' + '\n'.join(lines)
+    await send_upload_status(message, state, summary=summary)
+
+
+def describe_photo_problems(analysis, order_folder):
+    """Короткие описания замечаний к фото для сводного сообщения об альбоме."""
+    problems = []
+    if analysis.width and not MAX_ASPECT_RATIO > analysis.aspect_ratio > MIN_ASPECT_RATIO:
+        problems.append('узкая, будет широкое белое поле')
+    if analysis.width and MIN_PRINT_DPI > 0 and max_print_dpi(analysis.width, analysis.height) < MIN_PRINT_DPI:
+        problems.append(f'мало пикселей для печати ({analysis.width}x{analysis.height})')
+    if analysis.error:
+        problems.append('не удалось проверить, файл не читается как изображение')
+    elif analysis.blur < BLUR_THRESHOLD_ACTIVE:
+        problems.append('расфокусированная')
+    index = get_order_index(order_folder)
+    with STAGE_SECONDS.time(stage='duplicate_search'):
+        matches = index.find(analysis.md5, exclude=analysis.path)
+    if matches:
+        problems.append('совпадает с ' + ', '.join(match.name for match in matches))
+    if PHASH_DISTANCE_THRESHOLD >= 0:
+        with STAGE_SECONDS.time(stage='duplicate_search'):
+            similar = index.find_similar(analysis.dhash, PHASH_DISTANCE_THRESHOLD, exclude=analysis.path)
+        if similar:
+            problems.append('похожа на ' + ', '.join(similar_path.name for similar_path, _ in similar))
+    return problems
+
+
+# Сообщение о ходе загрузки заказа после обработки фото или альбома
+async def send_upload_status(message: types.Message, state: FSMContext, summary=None):
+    data = await state.get_data()
+    order_folder = Path(data['order_folder'])
+    number_of_photos = data['number_of_photos']
+    order_number = data['order_number']
+    uploaded_photos = get_order_manifest(order_folder).count
+    prefix = f'{summary}\n\n' if summary else ''
 
     # Проверяем, завершен ли процесс загрузки фотографий
     if uploaded_photos == number_of_photos:
         await state.set_state(OrderStates.order_complete)
-        logger.info(f"All photos for order {order_number} by {message.from_user.id} uploaded.")
+        logger.info(f"All photos for order {order_number} by {message.chat.id} uploaded.")
+        if summary:
+            await message.answer(summary)
 
         # Повторные проверки на соотношение сторон, качество и дубли
-        for photo in order_folder.glob("*.{IMG_WORK_FORMAT}"):
-            await check_aspect_ratio(photo, message)
-            await check_blur(photo, message)
-            await check_md5_matches(photo, order_folder, message)
+        manifest = await load_order_files(order_folder)
+        photos = manifest.paths()
+        # Геометрия всего заказа читается из заголовков файлов без декодирования. Это быстрые чтения
+        # с диска, поэтому в потоке, а не в пуле процессов, где они ждали бы очереди за конвертациями
+        headers = await asyncio.to_thread(read_image_headers, photos)
+        for photo, header in zip(photos, headers):
+            if header is not None:
+                await check_aspect_ratio(header, message)
+                await check_print_resolution(header, message)
+            photo_analysis = await get_photo_analysis(order_folder, photo)
+            await check_blur(photo_analysis, message)
+            await check_md5_matches(photo_analysis, order_folder, message)
+            await check_similar_photos(photo_analysis, order_folder, message)
         
         edit_cancel_send_keyboard = generate_edit_cancel_send_keyboard(order_number)
         await message.answer(f"Заказ сформирован. Отправляю в печать или ещё подумаете?", 
                              reply_markup=edit_cancel_send_keyboard)
     elif uploaded_photos > number_of_photos:
         only_edit_keyboard = generate_only_edit_photo_keyboard(order_number)
-        await message.answer(f'Вы загрузили фотографий больше чем в заказе.\n'
+        await message.answer(f'{prefix}Вы загрузили фотографий больше чем в заказе.\n'
                              f'Пожалуйста, нажмите "Редактировать фото" и удалите {uploaded_photos-number_of_photos} фото.', 
                              reply_markup=only_edit_keyboard)        
     else:
         edit_keyboard = generate_edit_photo_keyboard(order_number)
-        await message.answer(f"Получил {uploaded_photos} фото из {number_of_photos}. Жду ещё", reply_markup=edit_keyboard)
+        await message.answer(f"{prefix}Получил {uploaded_photos} фото из {number_of_photos}. Жду ещё", reply_markup=edit_keyboard)
         
 
 def generate_edit_cancel_send_keyboard(order_number): 
@@ -486,6 +841,41 @@ def generate_edit_photo_keyboard(order_number: str) -> InlineKeyboardMarkup:
     )
 
 
+def generate_delete_photo_keyboard(order_number: str, start_photo: int, end_photo: int) -> InlineKeyboardMarkup:
+    """
+    Генерирует клавиатуру с кнопками удаления фото с номерами от start_photo до end_photo (по 5 в ряд).
+
+    :param order_number: Номер заказа.
+    :return: Объект InlineKeyboardMarkup.
+    """
+    buttons = [
+        InlineKeyboardButton(text=str(photo_index), callback_data=f"delete_photo:{order_number}:{photo_index}")
+        for photo_index in range(start_photo, end_photo + 1)
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=[buttons[i:i + 5] for i in range(0, len(buttons), 5)])
+
+
+def generate_contact_sheet_keyboard(order_number: str, uploaded_photos: int, current_page: int) -> InlineKeyboardMarkup:
+    """
+    Генерирует клавиатуру для перехода между страницами коллажа-обзора заказа (по 3 в ряд).
+
+    :param order_number: Номер заказа.
+    :param uploaded_photos: Количество загруженных фотографий.
+    :param current_page: Номер текущей страницы, её кнопка отмечается.
+    :return: Объект InlineKeyboardMarkup.
+    """
+    per_page = CONTACT_SHEET_COLUMNS * CONTACT_SHEET_ROWS
+    buttons = []
+    for page in range(1, contact_sheet_page_count(uploaded_photos) + 1):
+        start_photo = (page - 1) * per_page + 1
+        end_photo = min(page * per_page, uploaded_photos)
+        button_text = f"Фото {start_photo}-{end_photo}"
+        if page == current_page:
+            button_text = f"· {button_text} ·"
+        buttons.append(InlineKeyboardButton(text=button_text, callback_data=f"contact_sheet_page:{order_number}:{page}"))
+    return InlineKeyboardMarkup(inline_keyboard=[buttons[i:i + 3] for i in range(0, len(buttons), 3)])
+
+
 def generate_only_edit_photo_keyboard(order_number: str) -> InlineKeyboardMarkup:
     """
     Генерирует клавиатуру с кнопкой "Редактировать фото".
@@ -520,7 +910,7 @@ def generate_photo_block_keyboard(order_number: str, uploaded_photos: int, photo
     # data = state.get_data()
     # order_folder = data['order_folder']
     # photos_in_order = data['number_of_photos']
-    # uploaded_photos  = get_number_photo_files(order_folder)
+    # uploaded_photos  = get_order_manifest(order_folder).count
 
 
     for block_number in range(1, total_blocks + 1):
@@ -530,6 +920,7 @@ def generate_photo_block_keyboard(order_number: str, uploaded_photos: int, photo
         callback_data = f"edit_photo_block:{order_number}:{block_number}"
         keyboard.append([InlineKeyboardButton(text=button_text, callback_data=callback_data)])
 
+    keyboard.append([InlineKeyboardButton(text="Все фото одним изображением", callback_data=f"contact_sheet_page:{order_number}:1")])
     keyboard.append([InlineKeyboardButton(text="Отменить всё", callback_data=f"cancel_order:{order_number}")])
     if uploaded_photos < photos_in_order:
         keyboard.append([InlineKeyboardButton(text="Отправить в работу неполный заказ", callback_data=f"send_not_full_order:{order_number}")])
@@ -541,6 +932,64 @@ def generate_photo_block_keyboard(order_number: str, uploaded_photos: int, photo
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
 
+def describe_saved_photo(order_folder, photo_path, analysis) -> str:
+    """
+    Формирует подпись к фото в режиме редактирования: имя файла и найденные проблемы.
+    """
+    # Получаем информацию о файле
+    file_name = photo_path.name
+    # file_size = photo_path.stat().st_size
+    aspect_ratio = analysis.aspect_ratio
+
+    if analysis.width and aspect_ratio < MIN_ASPECT_RATIO:
+        aspect_ratio_message = f'Внимание, фотография слишком узкая/широкая. Будут полосы при печати. Соотношение сторон: {aspect_ratio}\n'
+    else:
+        aspect_ratio_message = ''
+
+    if analysis.error:
+        blur_message = 'Не удалось проверить фотографию: файл не читается как изображение.\n'
+    elif analysis.blur < BLUR_THRESHOLD_ACTIVE and BLUR_THRESHOLD_ACTIVE != 0:
+        blur_message = f'Обратите внимание, фотография расфокусированная. Печатать можно, но рекомендуем заменить.\n'
+    else:
+        blur_message = ''
+
+    print_dpi = max_print_dpi(analysis.width, analysis.height)
+    if analysis.width and MIN_PRINT_DPI > 0 and print_dpi < MIN_PRINT_DPI:
+        resolution_message = f'Мало пикселей для печати: {analysis.width}x{analysis.height} (~{print_dpi:.0f} dpi).\n'
+    else:
+        resolution_message = ''
+
+    matches = get_order_index(order_folder).find(analysis.md5, exclude=photo_path)
+    for match in matches:
+        match_name = match.name if isinstance(match, Path) else match[0].name
+    if matches:
+        # match_message = 'Совпадения с другими файлами: ' + ', '.join(map(str, matches))
+        match_message = f'Совпадения с другими файлами: {match_name}'
+    else:
+        match_message = ''
+
+    similar = []
+    if PHASH_DISTANCE_THRESHOLD >= 0:
+        similar = get_order_index(order_folder).find_similar(analysis.dhash, PHASH_DISTANCE_THRESHOLD, exclude=photo_path)
+    if similar:
+        similar_message = '\nПохоже на: ' + ', '.join(similar_path.name for similar_path, _ in similar)
+    else:
+        similar_message = ''
+
+    # Формируем текст с информацией о файле
+    file_info = (
+        f"Имя файла: {file_name}\n" +
+        # f"Размер: {file_size} байт\n"
+        f"{aspect_ratio_message}" +
+        f"{resolution_message}" +
+        f"{blur_message}" +
+        f"{match_message}" +
+        f"{similar_message}"
+    )
+
+    return file_info
+
+
 @dp.callback_query(F.data.startswith("edit_photo:"))
 async def handle_edit_photo(callback: types.CallbackQuery, state: FSMContext):
     # Разбираем callback данные
@@ -549,7 +998,7 @@ async def handle_edit_photo(callback: types.CallbackQuery, state: FSMContext):
     # Получаем данные о состоянии
     data = await state.get_data()
     order_folder = data['order_folder']
-    uploaded_photos = get_number_photo_files(order_folder)
+    uploaded_photos = get_order_manifest(order_folder).count
     photos_in_order = data['number_of_photos']
 
     # Генерируем клавиатуру с кнопками для выбора блока фотографий
@@ -563,6 +1012,33 @@ async def handle_edit_photo(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
+@dp.callback_query(F.data.startswith("contact_sheet_page:"))
+async def handle_contact_sheet_page(callback: types.CallbackQuery, state: FSMContext):
+    # Обзор заказа: страница коллажа со сквозными номерами фото
+    _, order_number, page = callback.data.split(":")
+    data = await state.get_data()
+    order_folder = data['order_folder']
+    uploaded_photos = get_order_manifest(order_folder).count
+    total_pages = contact_sheet_page_count(uploaded_photos)
+    page = max(1, min(int(page), total_pages))
+    await callback.answer()
+    if not uploaded_photos:
+        await bot.send_message(callback.message.chat.id, "В заказе пока нет фото.")
+        return
+
+    per_page = CONTACT_SHEET_COLUMNS * CONTACT_SHEET_ROWS
+    caption = (f"Фото {(page - 1) * per_page + 1}-{min(page * per_page, uploaded_photos)} из {uploaded_photos}. "
+               f"Номера совпадают с номерами для удаления.")
+    keyboard = generate_contact_sheet_keyboard(order_number, uploaded_photos, page) if total_pages > 1 else None
+    try:
+        page_path = await get_contact_sheet_page(order_folder, page)
+    except Exception as e:
+        logger.error(f"Failed to build contact sheet page {page} for {order_folder}: {e!r}")
+        await bot.send_message(callback.message.chat.id, "Не удалось собрать обзор заказа.")
+        return
+    await bot.send_photo(callback.message.chat.id, FSInputFile(str(page_path)), caption=caption, reply_markup=keyboard)
+
+
 async def edit_photo_block(callback: types.CallbackQuery, state: FSMContext):
     # Разбираем callback данные
     _, order_number, block_number = callback.data.split(":")
@@ -571,74 +1047,46 @@ async def edit_photo_block(callback: types.CallbackQuery, state: FSMContext):
     # Получаем данные о состоянии
     data = await state.get_data()
     order_folder = data['order_folder']
-    uploaded_photos = get_number_photo_files(order_folder)
+    manifest = get_order_manifest(order_folder)
+    uploaded_photos = manifest.count
 
     # Вычисляем диапазон фотографий для текущего блока
     block_size = 10
     start_photo = (block_number - 1) * block_size + 1
     end_photo = min(block_number * block_size, uploaded_photos)
 
-    # Получаем список файлов в каталоге, отсортированный по имени (по времени загрузки)
-    photo_files = sorted(order_folder.glob(f"*.{IMG_WORK_FORMAT}"))
-
-    # print(f'{start_photo=}, {end_photo=}\n{photo_files=}')
-    # Отправляем фотографии и информацию о них
-    for i in range(start_photo - 1, end_photo):
-        if i >= len(photo_files):
-            break
-
-        photo_path = photo_files[i]
-
-        # Получаем информацию о файле
-        file_name = photo_path.name
-        # file_size = photo_path.stat().st_size
-        aspect_ratio = get_aspect_ratio(photo_path)
-        
-        if aspect_ratio < MIN_ASPECT_RATIO:
-            aspect_ratio_message = f'Внимание, фотография слишком узкая/широкая. Будут полосы при печати. Соотношение сторон: {aspect_ratio}\n'
-        else:
-            aspect_ratio_message = ''
-            
-        blur = estimate_blur(photo_path)
-        if blur < BLURR_THRESHOLD and BLURR_THRESHOLD != 0:
-            blur_message = f'Обратите внимание, фотография расфокусированная. Печатать можно, но рекомендуем заменить.\n'
-        else:
-            blur_message = ''
-            
-        matches = find_matching_files_by_md5(order_folder, photo_path)
-        for match in matches:
-            match_name = match.name if isinstance(match, Path) else match[0].name
-        if matches:
-            # match_message = 'Совпадения с другими файлами: ' + ', '.join(map(str, matches))
-            match_message = f'Совпадения с другими файлами: {match_name}'
-        else:
-            match_message = ''
-
-        # Формируем текст с информацией о файле
-        file_info = (
-            f"Имя файла: {file_name}\n" +
-            # f"Размер: {file_size} байт\n"
-            f"{aspect_ratio_message}" +
-            f"{blur_message}" +
-            f"{match_message}"
-        )
-
-        logger.info(f'Order {order_number}, edit photo: {file_info}')
-        # Создаем клавиатуру с кнопкой "удалить фото"
-        keyboard = InlineKeyboardMarkup(
-            inline_keyboard=[
-                [
-                    InlineKeyboardButton(text="Удалить фото", callback_data=f"delete_photo:{order_number}:{i + 1}")
+    # Фото в манифесте отсортированы по имени (по времени загрузки)
+    photo_paths = manifest.paths(start_photo, end_photo)
+    analyses = [await get_photo_analysis(order_folder, photo_path) for photo_path in photo_paths]
+    captions = [describe_saved_photo(order_folder, photo_path, analysis)
+                for photo_path, analysis in zip(photo_paths, analyses)]
+    for caption in captions:
+        logger.info(f'Order {order_number}, edit photo: {caption}')
+
+    if EDIT_VIEW_MODE == 'media_group' and len(photo_paths) > 1:
+        # Весь блок одним альбомом и одно сообщение с кнопками удаления
+        # Номер в подписи совпадает с номером на кнопке удаления
+        captions = [f"№{photo_index}. {caption}" for photo_index, caption in enumerate(captions, start_photo)]
+        await send_photo_previews_group(callback.message, order_folder, photo_paths, analyses, captions)
+        keyboard = generate_delete_photo_keyboard(order_number, start_photo, end_photo)
+        keyboard.inline_keyboard.extend(generate_edit_photo_keyboard(order_number).inline_keyboard)
+        await bot.send_message(callback.message.chat.id, "Удалить фото с номером:", reply_markup=keyboard)
+    else:
+        # Отправляем фотографии и информацию о них
+        for photo_index, (photo_path, analysis, caption) in enumerate(zip(photo_paths, analyses, captions), start_photo):
+            # Создаем клавиатуру с кнопкой "удалить фото"
+            keyboard = InlineKeyboardMarkup(
+                inline_keyboard=[
+                    [
+                        InlineKeyboardButton(text="Удалить фото", callback_data=f"delete_photo:{order_number}:{photo_index}")
+                    ]
                 ]
-            ]
-        )
-
-        photo_file = FSInputFile(str(photo_path))  
-        await callback.message.answer_photo(photo_file, caption=file_info, reply_markup=keyboard)
-    # await callback.message.answer("", reply_markup=generate_edit_photo_keyboard(order_number))
-    await bot.send_message(
-        callback.message.chat.id, "Доступные действия:", 
-        reply_markup=generate_edit_photo_keyboard(order_number))
+            )
+            await send_photo_preview(callback.message, order_folder, photo_path, analysis.md5, caption, keyboard)
+        # await callback.message.answer("", reply_markup=generate_edit_photo_keyboard(order_number))
+        await bot.send_message(
+            callback.message.chat.id, "Доступные действия:", 
+            reply_markup=generate_edit_photo_keyboard(order_number))
     logger.info(f'Show message with edit/cancel keyboard after edit photo block.')
 
     # Подтверждаем обработку коллбека
@@ -658,7 +1106,7 @@ async def handle_edit_photo_block(callback: types.CallbackQuery, state: FSMConte
     data = await state.get_data()
     order_folder = data['order_folder']
     number_of_photos = data['number_of_photos']
-    uploaded_photos = get_number_photo_files(order_folder)
+    uploaded_photos = get_order_manifest(order_folder).count
     if uploaded_photos < data['number_of_photos']:
         edit_keyboard = generate_edit_photo_keyboard(order_number)
         await bot.send_message(
@@ -679,13 +1127,14 @@ async def delete_photo(callback: types.CallbackQuery, state: FSMContext):
     order_folder = data['order_folder']
     number_of_photos = data['number_of_photos']
 
-    # Получаем список файлов в каталоге, отсортированный по имени (по времени загрузки)
-    photo_files = sorted(order_folder.glob(f"*.{IMG_WORK_FORMAT}"))
+    # Фото в манифесте отсортированы по имени (по времени загрузки)
+    manifest = get_order_manifest(order_folder)
 
     # Проверяем, существует ли файл с указанным индексом
-    if 1 <= photo_index <= len(photo_files):
-        photo_path = photo_files[photo_index - 1]
-        photo_path.unlink()  # Удаляем файл
+    if 1 <= photo_index <= manifest.count:
+        photo_path = manifest.photo_at(photo_index)
+        photo_path.unlink(missing_ok=True)  # Удаляем файл
+        unregister_photo(order_folder, photo_path)
         await callback.message.answer(f"Фото {photo_index} удалено.")
         logger.info(f"Photo {photo_index} deleted by user {callback.from_user.id}.")
     else:
@@ -693,7 +1142,7 @@ async def delete_photo(callback: types.CallbackQuery, state: FSMContext):
         logger.warning(f"Photo {photo_index} not found for user {callback.from_user.id}.")
 
     # Обновляем состояние заказа
-    uploaded_photos = get_number_photo_files(order_folder)
+    uploaded_photos = get_order_manifest(order_folder).count
     if uploaded_photos < data['number_of_photos']:
         await state.set_state(OrderStates.waiting_for_photos)
         await callback.message.answer("Ожидаю ещё фото.")
@@ -710,7 +1159,7 @@ async def send_not_full_order(callback: CallbackQuery, state: FSMContext):
     data = await state.get_data()
     order_folder = data['order_folder']
     photos_in_order = data['number_of_photos']
-    uploaded_photos  = get_number_photo_files(order_folder)
+    uploaded_photos  = get_order_manifest(order_folder).count
 
     # Проверяем, завершен ли процесс загрузки фотографий
     if uploaded_photos < photos_in_order:
@@ -738,7 +1187,7 @@ async def continue_load_photo(callback: CallbackQuery, state: FSMContext):
     data = await state.get_data()
     order_folder = data['order_folder']
     photos_in_order = data['number_of_photos']
-    uploaded_photos  = get_number_photo_files(order_folder)
+    uploaded_photos  = get_order_manifest(order_folder).count
 
     await state.set_state(OrderStates.waiting_for_photos)
     # await bot.send_message(callback.message.chat.id, 
@@ -762,20 +1211,18 @@ async def cancel_last_photo(callback: CallbackQuery, state: FSMContext):
     if not path.exists() or not path.is_dir():
         logger.error(f"Path {order_folder} not exist or not directory.")
     
-    jpg_files = list(path.glob(f"*.{IMG_WORK_FORMAT}"))
-    
-    # Сортируем файлы по имени
-    jpg_files.sort(key=lambda x: x.name)
+    # Фото в манифесте отсортированы по имени, последнее - последнее загруженное
+    manifest = get_order_manifest(order_folder)
+    last_file = manifest.last()
     
     # Проверяем, есть ли файлы для удаления
-    if jpg_files:
+    if last_file:
         # Удаляем последний файл в списке
-        last_file = jpg_files[-1]
-        last_file.unlink()
+        last_file.unlink(missing_ok=True)
+        unregister_photo(order_folder, last_file)
         await bot.send_message(callback.message.chat.id, 
                                f'Файл {get_original_filename(last_file.name)} отменен.')
         # callback.message.answer(f'Файл {last_file} отменен.')
-        number_uploaded_photos = get_number_photo_files(order_folder)
         logger.info(f"Удален файл по запросу пользователя: {last_file}")
         await callback.answer("Файл отменен.")
         await state.set_state(OrderStates.waiting_for_photos)
@@ -783,6 +1230,7 @@ async def cancel_last_photo(callback: CallbackQuery, state: FSMContext):
         logger.info(f"Error: В {order_folder} no {IMG_WORK_FORMAT} files")
         await callback.answer("Ошибка: В каталоге нет файлов для удаления.")
 
+    number_uploaded_photos = manifest.count
     await bot.send_message(callback.message.chat.id, 
                            f'Сейчас загружено {number_uploaded_photos} из {photos_in_order} в заказе.')
     if number_uploaded_photos < photos_in_order:
@@ -797,19 +1245,33 @@ async def process_print_order(callback: CallbackQuery, state: FSMContext):
     data = await state.get_data()
     order_folder = data['order_folder']
     photos_in_order = data['number_of_photos']
-    uploaded_photos  = get_number_photo_files(order_folder)   
+    uploaded_photos  = get_order_manifest(order_folder).count   
+    # Заказ уходит в печать: отложенные изменения манифеста и индекса пишем на диск сразу
+    get_order_manifest(order_folder).flush()
+    get_order_index(order_folder).flush()
     
     logger.info(f"Order {order_number} marked for printing by user {callback.from_user.id}")
+    api_client.invalidate(order_number)
+    ORDERS_TOTAL.inc(event='completed')
     
     await callback.message.answer("Заказ отправлен в печать.")
     await callback.answer()
-    await bot.send_message(chat_id=MANAGER_TELEGRAM_ID, text=f"Сообщение менеджеру: Заказ {order_number} собран и подтверджен, надо печатать.")
+    manager_text = f"Сообщение менеджеру: Заказ {order_number} собран и подтверджен, надо печатать."
+    try:
+        await send_contact_sheet(MANAGER_TELEGRAM_ID, order_folder, manager_text)
+    except Exception as e:
+        # Покупателю уже ответили: без коллажа менеджер получает текст, заказ обрабатывается дальше
+        logger.error(f"Failed to send contact sheet of order {order_number}: {e!r}")
+        try:
+            await bot.send_message(chat_id=MANAGER_TELEGRAM_ID, text=manager_text)
+        except Exception as e:
+            logger.error(f"Failed to notify manager about order {order_number}: {e!r}")
     # if "_янд_" in str(order_folder):
     #     print("Папка связана с Яндексом.")
     # if "_озн_" in str(order_folder):
     #     pass
     for mask, special_manager_telegram_id in ORDER_COMPLETE_SEND_TO.items():
-            if mask in order_folder:
+            if mask in str(order_folder):
                 await bot.send_message(
                     chat_id=special_manager_telegram_id, 
                     text=f"Заказ {order_number} собран и подтверджен, надо печатать.\n" \
@@ -836,6 +1298,8 @@ async def process_print_order(callback: CallbackQuery, state: FSMContext):
 async def process_cancel_order(callback: CallbackQuery, state: FSMContext):
     order_number = callback.data.split(":")[1]
     logger.info(f"Order {order_number} canceled by user {callback.from_user.id}")
+    api_client.invalidate(order_number)
+    ORDERS_TOTAL.inc(event='cancelled')
     await state.set_state(OrderStates.waiting_for_order_number)
     # await callback.message.answer("Данные заказа сброшены.")
     await callback.answer()
@@ -848,6 +1312,9 @@ async def process_cancel_order(callback: CallbackQuery, state: FSMContext):
             try:
                 # Удаляем каталог
                 shutil.rmtree(order_folder_path)
+                drop_order_index(order_folder_path)
+                drop_order_manifest(order_folder_path)
+                file_id_cache.drop_order(order_folder_path)
                 logger.info(f"Order folder {order_folder_path} removed.")
             except Exception as e:
                 logger.error(f"Failed to remove order folder {order_folder_path}: {e}")
@@ -862,9 +1329,90 @@ async def process_cancel_order(callback: CallbackQuery, state: FSMContext):
     
 
 # Запуск бота
+async def run_webhook():
+    """
+    Принимает апдейты через встроенный aiohttp-сервер на WEBHOOK_HOST:WEBHOOK_PORT и WEBHOOK_PATH.
+    На каждый апдейт сразу отвечает 200, обработка идёт в фоновой задаче.
+    Для локальной проверки можно отправить POST с JSON апдейта (и заголовком секрета, если он задан).
+    """
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp, bot=bot, handle_in_background=True, secret_token=WEBHOOK_SECRET or None
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+        logger.info(f"Webhook server listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        if WEBHOOK_URL:
+            await bot.set_webhook(
+                WEBHOOK_URL, secret_token=WEBHOOK_SECRET or None,
+                allowed_updates=dp.resolve_used_update_types()
+            )
+            logger.info(f"Webhook registered: {WEBHOOK_URL}")
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        await bot.session.close()
+
+
+async def run_worker(updates_queue, metrics_port=METRICS_PORT):
+    """
+    Обрабатывает апдейты из очереди супервизора (supervisor.py) до получения None.
+    Каждый апдейт обрабатывается в своей задаче, как при polling.
+
+    :param metrics_port: Порт метрик этого воркера.
+    """
+    analysis_service.start()
+    metrics_runner = await start_metrics_server(metrics_port)
+    tasks = set()
+
+    async def process_update(update: dict):
+        try:
+            await dp.feed_raw_update(bot, update)
+        except Exception as e:
+            logger.exception(f"Failed to process update {update.get('update_id')}: {e!r}")
+
+    try:
+        while True:
+            update = await asyncio.to_thread(updates_queue.get)
+            if update is None:
+                break
+            task = asyncio.create_task(process_update(update))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks)
+    finally:
+        analysis_service.shutdown()
+        flush_order_indexes()
+        flush_order_manifests()
+        await api_client.close()
+        await storage.close()
+        await bot.session.close()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+
+
 async def main():
-    logger.info(f"Starting {__name__}...")
-    await dp.start_polling(bot)
+    logger.info(f"Starting {__name__} in {BOT_MODE} mode...")
+    analysis_service.start()
+    metrics_runner = await start_metrics_server()
+    try:
+        if BOT_MODE == 'webhook':
+            await run_webhook()
+        else:
+            # Если раньше был включён вебхук, getUpdates без его удаления не работает
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
+    finally:
+        analysis_service.shutdown()
+        flush_order_indexes()
+        flush_order_manifests()
+        await api_client.close()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,51 @@
+# media_groups.py
+import asyncio
+from aiogram import types
+from config import MEDIA_GROUP_DELAY
+from tracing import span
+
+
+class MediaGroupCollector:
+    """
+    Собирает сообщения одного альбома (одинаковый media_group_id).
+    Telegram присылает каждое фото альбома отдельным апдейтом, а обработать альбом нужно целиком.
+
+    Хэндлер первого сообщения альбома ждёт, пока приходят остальные, и получает весь альбом,
+    хэндлеры остальных сообщений получают None и ничего не делают.
+    Требует параллельной обработки апдейтов (по умолчанию в aiogram так и есть).
+    """
+
+    def __init__(self, delay=MEDIA_GROUP_DELAY):
+        """
+        :param delay: Сколько секунд ждать следующее сообщение альбома.
+        """
+        self.delay = delay
+        self._groups = {}  # media_group_id -> список сообщений
+
+    async def collect(self, message: types.Message):
+        """
+        Добавляет сообщение в альбом.
+
+        :return: Все сообщения альбома в порядке отправки для первого сообщения, иначе None.
+        """
+        group = self._groups.get(message.media_group_id)
+        if group is not None:
+            group.append(message)
+            return None
+
+        group = self._groups[message.media_group_id] = [message]
+        try:
+            # Ждём, пока в альбом перестанут приходить сообщения
+            with span('media_group_collect') as collect_span:
+                while True:
+                    size = len(group)
+                    await asyncio.sleep(self.delay)
+                    if len(group) == size:
+                        break
+                collect_span.set_attribute('messages', len(group))
+        finally:
+            del self._groups[message.media_group_id]
+        return sorted(group, key=lambda album_message: album_message.message_id)
+
+
+media_group_collector = MediaGroupCollector()
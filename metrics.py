@@ -0,0 +1,223 @@
+# metrics.py
+# Метрики в текстовом формате Prometheus на http://METRICS_HOST:METRICS_PORT/metrics.
+# Если METRICS_PORT не задан, метрики не собираются: observe/inc/таймеры сразу возвращаются.
+import logging
+from bisect import bisect_left
+from time import perf_counter
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiohttp import web
+from config import METRICS_HOST, METRICS_PORT
+
+
+logger = logging.getLogger("main")
+
+enabled = METRICS_PORT is not None
+
+# Границы корзин гистограмм, секунд: от быстрых проверок до скачивания больших файлов
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+_registry = []
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labels=()):
+        """
+        :param name: Имя метрики.
+        :param documentation: Описание (строка HELP).
+        :param labels: Имена меток, значения передаются именованными аргументами.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}  # значения меток -> значение метрики
+        _registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def _format_labels(self, key: tuple, extra=()) -> str:
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+    def samples(self):
+        """Строки значений: (суффикс имени, метки, значение)."""
+        for key, value in sorted(self._values.items()):
+            yield '', self._format_labels(key), value
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {_escape(self.documentation)}', f'# TYPE {self.name} {self.type}']
+        for suffix, labels, value in self.samples():
+            lines.append(f'{self.name}{suffix}{labels} {_format_value(value)}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        if not enabled:
+            return
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labels=(), func=None):
+        """
+        :param func: Функция без аргументов, значение которой читается при каждом запросе метрик.
+        """
+        super().__init__(name, documentation, labels)
+        self.func = func
+
+    def set(self, value, **labels):
+        if enabled:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        if not enabled:
+            return
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def track_in_progress(self, **labels):
+        """Увеличивает значение на время блока: with UPLOADS_IN_FLIGHT.track_in_progress(): ..."""
+        return _InProgress(self, labels)
+
+    def samples(self):
+        if self.func is not None:
+            yield '', '', self.func()
+        else:
+            yield from super().samples()
+
+
+class _InProgress:
+    __slots__ = ('gauge', 'labels')
+
+    def __init__(self, gauge, labels):
+        self.gauge = gauge
+        self.labels = labels
+
+    def __enter__(self):
+        self.gauge.inc(**self.labels)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.gauge.dec(**self.labels)
+
+
+class _Timer:
+    """Контекстный менеджер, который записывает время выполнения блока в гистограмму."""
+    __slots__ = ('histogram', 'labels', 'started')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.started = None
+
+    def __enter__(self):
+        if enabled:
+            self.started = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.started is not None:
+            self.histogram.observe(perf_counter() - self.started, **self.labels)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        if not enabled:
+            return
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            # количество по корзинам (последняя - больше всех границ), сумма, количество
+            state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    def time(self, **labels) -> _Timer:
+        """Замер времени блока: with STAGE_SECONDS.time(stage='download'): ..."""
+        return _Timer(self, labels)
+
+    def samples(self):
+        for key, (counts, total, number) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                yield '_bucket', self._format_labels(key, [('le', _format_value(bound))]), cumulative
+            yield '_sum', self._format_labels(key), total
+            yield '_count', self._format_labels(key), number
+
+
+def render_metrics() -> str:
+    return '\n'.join(metric.render() for metric in _registry) + '\n'
+
+
+# Этапы обработки: 1c_lookup, get_file, download, hash (MD5 содержимого), conversion, read, aspect, decode,
+# dhash (перцептивный хеш), blur, duplicate_search, reply_send
+STAGE_SECONDS = Histogram('ideaprint_stage_seconds', 'Duration of photo pipeline stages.', ['stage'])
+ORDERS_TOTAL = Counter('ideaprint_orders_total', 'Orders by event: started, completed, cancelled.', ['event'])
+UPLOADS_IN_FLIGHT = Gauge('ideaprint_uploads_in_flight', 'Photos being downloaded, converted or checked.')
+
+# Методы Bot API, которые не относятся к ответам пользователю
+SERVICE_METHODS = {'GetUpdates', 'GetMe', 'SetWebhook', 'DeleteWebhook', 'GetWebhookInfo', 'Close', 'LogOut'}
+
+
+class BotApiMetricsMiddleware(BaseRequestMiddleware):
+    """Замеряет запросы бота к Telegram: getFile - этап get_file, отправки и ответы - этап reply_send."""
+
+    async def __call__(self, make_request, bot, method):
+        method_name = type(method).__name__
+        if not enabled or method_name in SERVICE_METHODS:
+            return await make_request(bot, method)
+        with STAGE_SECONDS.time(stage='get_file' if method_name == 'GetFile' else 'reply_send'):
+            return await make_request(bot, method)
+
+
+async def handle_metrics(request: web.Request):
+    return web.Response(body=render_metrics().encode(),
+                        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+async def start_metrics_server(port=METRICS_PORT, host=METRICS_HOST):
+    """
+    Запускает HTTP-сервер метрик. Если метрики выключены, ничего не делает.
+
+    :return: web.AppRunner (остановить через cleanup()) или None.
+    """
+    if not enabled or port is None:
+        return None
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Metrics available at http://{host}:{port}/metrics")
+    return runner
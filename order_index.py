@@ -0,0 +1,244 @@
+# order_index.py
+import asyncio
+import json
+import logging
+import os
+from collections import defaultdict
+from pathlib import Path
+from bktree import BKTree
+from config import IMG_WORK_FORMAT, ORDER_SERVICE_DIR, ORDER_FILES_SAVE_DELAY
+
+
+logger = logging.getLogger("main")
+
+ORDER_INDEX_FILENAME = 'md5_index.json'
+
+
+class OrderHashIndex:
+    """
+    Индекс хешей фотографий заказа: имя файла -> MD5 и dHash и обратно.
+    Хранится в служебном каталоге папки заказа и обновляется по одному файлу,
+    поэтому поиск дублей не перечитывает все фото заказа. Изменения пишутся на диск
+    не сразу, а одной записью через ORDER_FILES_SAVE_DELAY секунд (save_later).
+    Перцептивные хеши лежат в BK-дереве для поиска похожих фото по расстоянию Хэмминга.
+    Файл индекса могут менять и другие процессы (воркеры супервизора): get_order_index перечитывает
+    изменённый файл, а save перед записью добавляет чужие записи (см. changed_on_disk).
+    """
+
+    def __init__(self, order_folder):
+        self.order_folder = Path(order_folder)
+        self.index_path = self.order_folder / ORDER_SERVICE_DIR / ORDER_INDEX_FILENAME
+        self.files = {}  # имя файла -> {'md5': ..., 'dhash': ..., 'size': ..., 'mtime': ...}
+        self.by_md5 = defaultdict(set)  # md5 -> имена файлов
+        self.dhash_tree = BKTree()
+        self._save_handle = None  # отложенная запись на диск
+        self._disk_stamp = None  # (mtime_ns, размер) файла индекса после последнего чтения или записи
+
+    def _stat_disk(self):
+        try:
+            stat = self.index_path.stat()
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def changed_on_disk(self) -> bool:
+        """True, если файл индекса после последнего чтения или записи изменил другой процесс."""
+        return self._stat_disk() != self._disk_stamp
+
+    @classmethod
+    def load(cls, order_folder):
+        """Читает индекс с диска. Отсутствующий или повреждённый индекс считается пустым."""
+        index = cls(order_folder)
+        index._disk_stamp = index._stat_disk()
+        for name, entry in index._read_disk().items():
+            index._insert(name, entry)
+        return index
+
+    def _read_disk(self) -> dict:
+        try:
+            with open(self.index_path, encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.error(f"Failed to read order index {self.index_path}: {e}")
+            return {}
+
+    def _insert(self, name, entry):
+        self.files[name] = entry
+        self.by_md5[entry['md5']].add(name)
+        if entry.get('dhash') is not None:
+            self.dhash_tree.add(entry['dhash'], name)
+
+    def _merge_disk(self):
+        """
+        Объединяет индекс с файлом, который изменил другой процесс: добавляет чужие записи о фото,
+        которые есть в папке, и убирает записи о фото, которых в папке уже нет.
+        """
+        for name, entry in self._read_disk().items():
+            if name not in self.files and (self.order_folder / name).exists():
+                self._insert(name, entry)
+        for name in [name for name in self.files if not (self.order_folder / name).exists()]:
+            self._discard(name)
+
+    def save(self):
+        """Сохраняет индекс атомарно (через временный файл своего процесса)."""
+        if self.changed_on_disk():
+            self._merge_disk()
+        self.index_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.index_path.with_name(f'{self.index_path.name}.{os.getpid()}.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.files, f, ensure_ascii=False)
+        os.replace(tmp_path, self.index_path)
+        self._disk_stamp = self._stat_disk()
+
+    def save_later(self):
+        """Запоминает, что индекс изменился. Вне цикла событий сохраняет сразу."""
+        if self._save_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.save()
+            return
+        self._save_handle = loop.call_later(ORDER_FILES_SAVE_DELAY, self.flush)
+
+    def flush(self):
+        """Сохраняет отложенные изменения, если они есть."""
+        if self._save_handle is None:
+            return
+        self._save_handle.cancel()
+        self._save_handle = None
+        try:
+            self.save()
+        except OSError as e:
+            logger.error(f"Failed to save order index {self.index_path}: {e}")
+
+    def cancel_save(self):
+        """Отменяет отложенную запись (папка заказа удалена)."""
+        if self._save_handle is not None:
+            self._save_handle.cancel()
+            self._save_handle = None
+
+    def add(self, file_path, md5, dhash=None, save=True):
+        """Добавляет или обновляет файл в индексе."""
+        file_path = Path(file_path)
+        self._discard(file_path.name)
+        stat = file_path.stat()
+        self._insert(file_path.name, {'md5': md5, 'dhash': dhash, 'size': stat.st_size, 'mtime': stat.st_mtime})
+        if save:
+            self.save_later()
+
+    def remove(self, file_path, save=True):
+        """Удаляет файл из индекса."""
+        if self._discard(Path(file_path).name) and save:
+            self.save_later()
+
+    def _discard(self, name):
+        entry = self.files.pop(name, None)
+        if entry is None:
+            return False
+        names = self.by_md5[entry['md5']]
+        names.discard(name)
+        if not names:
+            del self.by_md5[entry['md5']]
+        if entry.get('dhash') is not None:
+            self.dhash_tree.remove(entry['dhash'], name)
+        return True
+
+    def md5_of(self, file_path, check_stat=False):
+        """
+        Возвращает MD5 файла из индекса или None.
+
+        :param check_stat: Вернуть None, если размер или время изменения файла не совпадают с индексом.
+        """
+        file_path = Path(file_path)
+        entry = self.files.get(file_path.name)
+        if entry is None:
+            return None
+        if check_stat:
+            try:
+                stat = file_path.stat()
+            except FileNotFoundError:
+                return None
+            if entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+                return None
+        return entry['md5']
+
+    def find(self, md5, exclude=None):
+        """
+        Возвращает файлы заказа с указанным MD5.
+
+        :param exclude: Файл, который не нужно включать в результат (обычно проверяемый).
+        :return: Список Path, отсортированный по имени.
+        """
+        exclude_name = Path(exclude).name if exclude else None
+        return [self.order_folder / name for name in sorted(self.by_md5.get(md5, ())) if name != exclude_name]
+
+    def find_similar(self, dhash, max_distance, exclude=None):
+        """
+        Возвращает похожие фото заказа, у которых dHash отличается не больше чем на max_distance бит.
+        Побайтовые копии (тот же MD5, что у exclude) не включаются, о них сообщает поиск по MD5.
+
+        :param exclude: Проверяемый файл.
+        :return: Список (Path, расстояние), отсортированный по расстоянию.
+        """
+        if dhash is None:
+            return []
+        exclude_name = Path(exclude).name if exclude else None
+        exclude_md5 = self.md5_of(exclude) if exclude else None
+        return [(self.order_folder / name, distance)
+                for name, distance in self.dhash_tree.find(dhash, max_distance)
+                if name != exclude_name and (exclude_md5 is None or self.files[name]['md5'] != exclude_md5)]
+
+    def scan(self):
+        """
+        Сверяет индекс с содержимым папки заказа. Удалённые вне бота файлы убираются из индекса.
+
+        :return: Список новых или изменённых вне бота файлов, для которых нужно посчитать хеши.
+        """
+        stale = []
+        on_disk = set()
+        for file_path in self.order_folder.glob(f"*.{IMG_WORK_FORMAT}"):
+            on_disk.add(file_path.name)
+            entry = self.files.get(file_path.name)
+            stat = file_path.stat()
+            if (entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime
+                    or 'dhash' not in entry):
+                stale.append(file_path)
+        removed = [name for name in self.files if name not in on_disk]
+        for name in removed:
+            self._discard(name)
+        if removed:
+            logger.info(f"Order index {self.order_folder}: {len(removed)} files removed outside the bot.")
+            self.save_later()
+        return stale
+
+
+# Индексы заказов, загруженные в этом процессе
+_order_indexes = {}
+
+
+def get_order_index(order_folder) -> OrderHashIndex:
+    """
+    Возвращает индекс заказа, при первом обращении читает его с диска.
+    Если файл индекса изменил другой процесс, а своих несохранённых изменений нет, индекс перечитывается.
+    """
+    key = str(order_folder)
+    index = _order_indexes.get(key)
+    if index is None or (index._save_handle is None and index.changed_on_disk()):
+        index = _order_indexes[key] = OrderHashIndex.load(order_folder)
+    return index
+
+
+def drop_order_index(order_folder):
+    """Забывает индекс заказа (например, после удаления папки заказа)."""
+    index = _order_indexes.pop(str(order_folder), None)
+    if index is not None:
+        index.cancel_save()
+
+
+def flush_order_indexes():
+    """Сохраняет отложенные изменения всех индексов (при остановке бота)."""
+    for index in _order_indexes.values():
+        index.flush()
@@ -0,0 +1,193 @@
+# order_manifest.py
+import asyncio
+import json
+import logging
+import os
+from bisect import bisect_left, insort
+from pathlib import Path
+from config import IMG_WORK_FORMAT, ORDER_SERVICE_DIR, ORDER_FILES_SAVE_DELAY
+
+
+logger = logging.getLogger("main")
+
+ORDER_MANIFEST_FILENAME = 'manifest.json'
+
+
+class OrderManifest:
+    """
+    Упорядоченный список фотографий заказа в памяти.
+    Порядок - по имени файла (имя начинается с метки времени загрузки), как в sorted(glob).
+    Номера фото (с 1) совпадают с номерами в кнопках "Удалить фото".
+    Хранится в служебном каталоге папки заказа и обновляется по одному файлу.
+    Изменения пишутся на диск одной записью через ORDER_FILES_SAVE_DELAY секунд (save_later).
+    Файл манифеста могут менять и другие процессы (воркеры супервизора): get_order_manifest перечитывает
+    изменённый файл, а save перед записью поверх чужих изменений сверяет список с папкой.
+    """
+
+    def __init__(self, order_folder):
+        self.order_folder = Path(order_folder)
+        self.manifest_path = self.order_folder / ORDER_SERVICE_DIR / ORDER_MANIFEST_FILENAME
+        self.photos = []  # имена файлов, отсортированные по имени
+        self._save_handle = None  # отложенная запись на диск
+        self._disk_stamp = None  # (mtime_ns, размер) файла манифеста после последнего чтения или записи
+
+    def _stat_disk(self):
+        try:
+            stat = self.manifest_path.stat()
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def changed_on_disk(self) -> bool:
+        """True, если файл манифеста после последнего чтения или записи изменил другой процесс."""
+        return self._stat_disk() != self._disk_stamp
+
+    def _folder_photos(self):
+        return sorted(file_path.name for file_path in self.order_folder.glob(f"*.{IMG_WORK_FORMAT}"))
+
+    @classmethod
+    def load(cls, order_folder):
+        """Читает манифест с диска. Если манифеста нет, он строится по содержимому папки."""
+        manifest = cls(order_folder)
+        manifest._disk_stamp = manifest._stat_disk()
+        try:
+            with open(manifest.manifest_path, encoding='utf-8') as f:
+                manifest.photos = sorted(json.load(f)['photos'])
+        except FileNotFoundError:
+            manifest.scan()
+        except (OSError, ValueError, KeyError) as e:
+            logger.error(f"Failed to read order manifest {manifest.manifest_path}: {e}")
+            manifest.scan()
+        return manifest
+
+    def save(self):
+        """Сохраняет манифест атомарно (через временный файл своего процесса)."""
+        if self.changed_on_disk():
+            # Манифест менял другой процесс: список фото берём из папки, чтобы не затереть его изменения
+            self.photos = self._folder_photos()
+        self.manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.manifest_path.with_name(f'{self.manifest_path.name}.{os.getpid()}.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'photos': self.photos}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.manifest_path)
+        self._disk_stamp = self._stat_disk()
+
+    def save_later(self):
+        """Запоминает, что манифест изменился. Вне цикла событий сохраняет сразу."""
+        if self._save_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.save()
+            return
+        self._save_handle = loop.call_later(ORDER_FILES_SAVE_DELAY, self.flush)
+
+    def flush(self):
+        """Сохраняет отложенные изменения, если они есть."""
+        if self._save_handle is None:
+            return
+        self._save_handle.cancel()
+        self._save_handle = None
+        try:
+            self.save()
+        except OSError as e:
+            logger.error(f"Failed to save order manifest {self.manifest_path}: {e}")
+
+    def cancel_save(self):
+        """Отменяет отложенную запись (папка заказа удалена)."""
+        if self._save_handle is not None:
+            self._save_handle.cancel()
+            self._save_handle = None
+
+    @property
+    def count(self) -> int:
+        return len(self.photos)
+
+    def __contains__(self, file_path):
+        name = Path(file_path).name
+        position = bisect_left(self.photos, name)
+        return position < len(self.photos) and self.photos[position] == name
+
+    def photo_at(self, photo_index: int) -> Path:
+        """
+        Возвращает путь к фото по номеру (с 1).
+
+        :raises IndexError: Если фото с таким номером нет.
+        """
+        if not 1 <= photo_index <= len(self.photos):
+            raise IndexError(f"Photo {photo_index} not in order {self.order_folder}")
+        return self.order_folder / self.photos[photo_index - 1]
+
+    def index_of(self, file_path):
+        """Возвращает номер фото (с 1) или None, если фото нет в заказе."""
+        name = Path(file_path).name
+        position = bisect_left(self.photos, name)
+        if position < len(self.photos) and self.photos[position] == name:
+            return position + 1
+        return None
+
+    def paths(self, start=1, end=None):
+        """Возвращает пути к фото с номерами от start до end включительно."""
+        end = len(self.photos) if end is None else end
+        return [self.order_folder / name for name in self.photos[start - 1:end]]
+
+    def last(self):
+        return self.order_folder / self.photos[-1] if self.photos else None
+
+    def add(self, file_path, save=True):
+        name = Path(file_path).name
+        if file_path not in self:
+            insort(self.photos, name)
+            if save:
+                self.save_later()
+
+    def remove(self, file_path, save=True):
+        photo_index = self.index_of(file_path)
+        if photo_index is not None:
+            del self.photos[photo_index - 1]
+            if save:
+                self.save_later()
+
+    def scan(self):
+        """
+        Сверяет манифест с содержимым папки заказа (файлы могли добавить или удалить вне бота).
+
+        :return: True, если манифест изменился.
+        """
+        photos = self._folder_photos()
+        if photos == self.photos:
+            return False
+        logger.info(f"Order manifest {self.order_folder}: {len(self.photos)} -> {len(photos)} photos after scan.")
+        self.photos = photos
+        self.save_later()
+        return True
+
+
+# Манифесты заказов, загруженные в этом процессе
+_order_manifests = {}
+
+
+def get_order_manifest(order_folder) -> OrderManifest:
+    """
+    Возвращает манифест заказа, при первом обращении читает его с диска.
+    Если файл манифеста изменил другой процесс, а своих несохранённых изменений нет, манифест перечитывается.
+    """
+    key = str(order_folder)
+    manifest = _order_manifests.get(key)
+    if manifest is None or (manifest._save_handle is None and manifest.changed_on_disk()):
+        manifest = _order_manifests[key] = OrderManifest.load(order_folder)
+    return manifest
+
+
+def drop_order_manifest(order_folder):
+    """Забывает манифест заказа (например, после удаления папки заказа)."""
+    manifest = _order_manifests.pop(str(order_folder), None)
+    if manifest is not None:
+        manifest.cancel_save()
+
+
+def flush_order_manifests():
+    """Сохраняет отложенные изменения всех манифестов (при остановке бота)."""
+    for manifest in _order_manifests.values():
+        manifest.flush()
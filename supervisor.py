@@ -0,0 +1,195 @@
+# supervisor.py
+# Запуск бота в нескольких процессах: python supervisor.py
+import asyncio
+import logging
+import multiprocessing
+import os
+from pathlib import Path
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.utils.backoff import Backoff, BackoffConfig
+from aiohttp import web
+from config import BOT_TOKEN, BOT_MODE, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_URL, WEBHOOK_SECRET, \
+    WORKER_PROCESSES, ANALYSIS_POOL_SIZE, METRICS_PORT
+
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+)
+logger = logging.getLogger("main")
+
+
+def update_user_id(update: dict):
+    """Возвращает id пользователя, от которого пришёл апдейт (JSON Bot API), или None."""
+    for key, event in update.items():
+        if key == 'update_id' or not isinstance(event, dict):
+            continue
+        user = event.get('from') or event.get('user')
+        if isinstance(user, dict) and 'id' in user:
+            return user['id']
+        chat = event.get('chat')
+        if isinstance(chat, dict) and 'id' in chat:
+            return chat['id']
+    return None
+
+
+def worker_process(worker_index: int, updates_queue, pool_size):
+    """Точка входа процесса-воркера: обычный бот, который берёт апдейты из очереди."""
+    import ideaprint_bot
+    import tracing
+    ideaprint_bot.analysis_service.pool_size = pool_size
+    if tracing.trace_file:
+        trace_file = Path(tracing.trace_file)
+        tracing.trace_file = str(trace_file.with_name(f'{trace_file.stem}_{worker_index}{trace_file.suffix}'))
+    logger.info(f"Worker {worker_index} started, pid {os.getpid()}.")
+    # У каждого воркера свои метрики на своём порту
+    metrics_port = METRICS_PORT + worker_index if METRICS_PORT is not None else None
+    asyncio.run(ideaprint_bot.run_worker(updates_queue, metrics_port))
+
+
+class Supervisor:
+    """
+    Получает апдейты (long polling или вебхук, по BOT_MODE) и раздаёт их процессам-воркерам
+    по id пользователя. Апдейты одного пользователя всегда попадают в один воркер,
+    поэтому состояние FSM, альбомы и кэши его заказа живут в одном процессе.
+    Воркеры используют общее хранилище FSM (SQLite). Манифест и индекс заказа каждый воркер держит
+    в памяти и пишет на диск с задержкой; если заказ открыл воркер другого пользователя с тем же
+    номером заказа, изменённые другим воркером файлы перечитываются, а при записи сверяются с папкой заказа.
+    Упавшие воркеры перезапускаются.
+    """
+
+    def __init__(self, workers=WORKER_PROCESSES):
+        """
+        :param workers: Количество процессов-воркеров.
+        """
+        self.workers = workers
+        # Пул анализа фото каждого воркера получает свою долю ядер
+        self.pool_size = ANALYSIS_POOL_SIZE or max(1, (os.cpu_count() or 1) // workers)
+        self._context = multiprocessing.get_context('spawn')
+        self._queues = [self._context.Queue() for _ in range(workers)]
+        self._processes = [None] * workers
+
+    def start(self):
+        for worker_index in range(self.workers):
+            self._start_worker(worker_index)
+
+    def _start_worker(self, worker_index: int):
+        process = self._context.Process(
+            target=worker_process, args=(worker_index, self._queues[worker_index], self.pool_size),
+            name=f'ideaprint-worker-{worker_index}',
+        )
+        process.start()
+        self._processes[worker_index] = process
+
+    def check_workers(self):
+        """Перезапускает воркеры, которые завершились. Апдейты в их очередях не теряются."""
+        for worker_index, process in enumerate(self._processes):
+            if process is not None and not process.is_alive():
+                logger.error(f"Worker {worker_index} exited with code {process.exitcode}, restarting.")
+                self._start_worker(worker_index)
+
+    def route(self, update: dict):
+        """Отправляет апдейт воркеру, который отвечает за его пользователя."""
+        user_id = update_user_id(update)
+        worker_index = user_id % self.workers if isinstance(user_id, int) else 0
+        self._queues[worker_index].put(update)
+
+    def stop(self, timeout=30):
+        """Просит воркеры доработать текущие апдейты и завершиться."""
+        for updates_queue in self._queues:
+            updates_queue.put(None)
+        for worker_index, process in enumerate(self._processes):
+            if process is None:
+                continue
+            process.join(timeout)
+            if process.is_alive():
+                logger.warning(f"Worker {worker_index} did not stop in {timeout} s, terminating.")
+                process.terminate()
+
+    async def run_polling(self, bot: Bot):
+        # Если раньше был включён вебхук, getUpdates без его удаления не работает
+        await bot.delete_webhook()
+        offset = None
+        # Как в aiogram (Dispatcher._listen_updates): любая ошибка getUpdates (сеть, 5xx, конфликт)
+        # не останавливает бота, запрос повторяется с растущей задержкой
+        backoff = Backoff(config=BackoffConfig(min_delay=1.0, max_delay=5.0, factor=1.3, jitter=0.1))
+        failed = False
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=30)
+            except TelegramRetryAfter as e:
+                failed = True
+                logger.warning(f"Flood control on getUpdates, sleeping {e.retry_after} s")
+                await asyncio.sleep(e.retry_after)
+                continue
+            except Exception as e:
+                failed = True
+                logger.error(f"Failed to get updates - {type(e).__name__}: {e}. "
+                             f"Retrying in {backoff.next_delay:.1f} s (tryings = {backoff.counter})")
+                await backoff.asleep()
+                continue
+            if failed:
+                logger.info(f"Getting updates restored (tryings = {backoff.counter})")
+                backoff.reset()
+                failed = False
+            for update in updates:
+                self.route(update.model_dump(mode='json', by_alias=True, exclude_none=True))
+                offset = update.update_id + 1
+            self.check_workers()
+
+    async def run_webhook(self, bot: Bot):
+        async def handle_update(request: web.Request):
+            if WEBHOOK_SECRET and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+                return web.Response(status=401)
+            self.route(await request.json())
+            return web.json_response({})
+
+        async def check_workers_periodically():
+            while True:
+                await asyncio.sleep(5)
+                self.check_workers()
+
+        app = web.Application()
+        app.router.add_post(WEBHOOK_PATH, handle_update)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        checker = asyncio.create_task(check_workers_periodically())
+        try:
+            await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+            logger.info(f"Supervisor webhook server listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+            if WEBHOOK_URL:
+                await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET or None)
+                logger.info(f"Webhook registered: {WEBHOOK_URL}")
+            await asyncio.Event().wait()
+        finally:
+            checker.cancel()
+            await runner.cleanup()
+
+    async def run(self):
+        """Получает апдейты от Telegram в режиме BOT_MODE и раздаёт их воркерам."""
+        bot = Bot(token=BOT_TOKEN)
+        try:
+            if BOT_MODE == 'webhook':
+                await self.run_webhook(bot)
+            else:
+                await self.run_polling(bot)
+        finally:
+            await bot.session.close()
+
+
+def run_supervisor(workers=WORKER_PROCESSES):
+    logger.info(f"Starting supervisor with {workers} workers in {BOT_MODE} mode...")
+    supervisor = Supervisor(workers)
+    supervisor.start()
+    try:
+        asyncio.run(supervisor.run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        supervisor.stop()
+        logger.info("Supervisor stopped.")
+
+
+if __name__ == '__main__':
+    run_supervisor()
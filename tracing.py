@@ -0,0 +1,188 @@
+# tracing.py
+# Трассировка апдейтов: у каждого апдейта дерево этапов (span) с временем выполнения.
+# Апдейты дольше TRACE_SLOW_UPDATE_SECONDS целиком пишутся в TRACE_FILE (JSONL, с ротацией)
+# с номером заказа и id пользователя, чтобы разобрать, на что ушло время.
+import functools
+import json
+import logging
+from contextvars import ContextVar
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+from time import perf_counter
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from config import TRACE_SLOW_UPDATE_SECONDS, TRACE_FILE, TRACE_FILE_MAX_BYTES, TRACE_FILE_BACKUP_COUNT
+
+
+logger = logging.getLogger("main")
+
+# Файл медленных апдейтов, воркеры супервизора пишут каждый в свой
+trace_file = TRACE_FILE
+
+_current_span = ContextVar('current_span', default=None)
+_trace_logger = None
+
+
+class Span:
+    """Этап обработки апдейта. Вложенные этапы (в том числе из параллельных задач) попадают в children."""
+    __slots__ = ('name', 'attributes', 'started', 'duration', 'error', 'children', '_token')
+
+    def __init__(self, name: str, attributes=None):
+        self.name = name
+        self.attributes = attributes or {}
+        self.started = None
+        self.duration = None
+        self.error = None
+        self.children = []
+        self._token = None
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def __enter__(self):
+        parent = _current_span.get()
+        if parent is not None:
+            parent.children.append(self)
+        self.started = perf_counter()
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = perf_counter() - self.started
+        if exc is not None:
+            self.error = repr(exc)
+        _current_span.reset(self._token)
+
+    def to_dict(self, origin: float) -> dict:
+        """
+        :param origin: Начало апдейта, от него считается start_ms.
+        """
+        data = {
+            'name': self.name,
+            'start_ms': round((self.started - origin) * 1000, 3),
+            'duration_ms': round(self.duration * 1000, 3) if self.duration is not None else None,
+        }
+        if self.attributes:
+            data['attributes'] = self.attributes
+        if self.error:
+            data['error'] = self.error
+        if self.children:
+            data['children'] = [child.to_dict(origin) for child in self.children]
+        return data
+
+
+class _NoSpan:
+    """Заглушка вне трассируемого апдейта: ничего не замеряет."""
+    __slots__ = ()
+
+    def set_attribute(self, key, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+def span(name: str, **attributes):
+    """
+    Этап внутри текущего апдейта: with span('download', file=name): ...
+    Вне апдейта (или при выключенной трассировке) ничего не делает.
+    """
+    if _current_span.get() is None:
+        return _NO_SPAN
+    return Span(name, attributes)
+
+
+def traced(name=None):
+    """Декоратор асинхронной функции: каждый вызов - этап с именем функции (или name)."""
+    def decorator(func):
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if _current_span.get() is None:
+                return await func(*args, **kwargs)
+            with Span(span_name):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _get_trace_logger() -> logging.Logger:
+    global _trace_logger
+    if _trace_logger is None:
+        _trace_logger = logging.getLogger("trace")
+        _trace_logger.propagate = False
+        _trace_logger.setLevel(logging.INFO)
+        handler = RotatingFileHandler(trace_file, maxBytes=TRACE_FILE_MAX_BYTES,
+                                      backupCount=TRACE_FILE_BACKUP_COUNT, encoding='utf-8')
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        _trace_logger.addHandler(handler)
+    return _trace_logger
+
+
+def write_trace(root: Span, user_id=None, order_number=None):
+    record = {
+        'time': datetime.now().isoformat(timespec='milliseconds'),
+        'user_id': user_id,
+        'order_number': order_number,
+        'duration_ms': round(root.duration * 1000, 3),
+        'trace': root.to_dict(root.started),
+    }
+    _get_trace_logger().info(json.dumps(record, ensure_ascii=False, default=str))
+
+
+async def _order_number(event, data) -> str | None:
+    # Номер заказа из состояния FSM, а если его там уже нет (заказ отменён) - из кнопки
+    state = data.get('state')
+    if state is not None:
+        order_number = (await state.get_data()).get('order_number')
+        if order_number:
+            return order_number
+    callback_query = getattr(event, 'callback_query', None)
+    if callback_query is not None and callback_query.data and ':' in callback_query.data:
+        return callback_query.data.split(':')[1] or None
+    return None
+
+
+class TracingMiddleware(BaseMiddleware):
+    """
+    Внешний middleware апдейтов: открывает корневой этап апдейта, после обработки
+    записывает дерево этапов, если апдейт обрабатывался дольше slow_seconds.
+    """
+
+    def __init__(self, slow_seconds=TRACE_SLOW_UPDATE_SECONDS):
+        """
+        :param slow_seconds: Порог записи апдейта, секунд (None - трассировка выключена).
+        """
+        self.slow_seconds = slow_seconds
+
+    async def __call__(self, handler, event, data):
+        if self.slow_seconds is None or not trace_file:
+            return await handler(event, data)
+        root = Span('update', {'update_id': event.update_id, 'type': event.event_type})
+        try:
+            with root:
+                return await handler(event, data)
+        finally:
+            if root.duration >= self.slow_seconds:
+                user = data.get('event_from_user')
+                try:
+                    write_trace(root, user.id if user else None, await _order_number(event, data))
+                except Exception as e:
+                    logger.error(f"Failed to write trace of update {event.update_id}: {e!r}")
+
+
+class TracingRequestMiddleware(BaseRequestMiddleware):
+    """Каждый запрос бота к Telegram внутри апдейта - отдельный этап bot_api.<Метод>."""
+
+    async def __call__(self, make_request, bot, method):
+        if _current_span.get() is None:
+            return await make_request(bot, method)
+        with Span(f'bot_api.{type(method).__name__}'):
+            return await make_request(bot, method)